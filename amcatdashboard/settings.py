@@ -60,7 +60,9 @@ LOGIN_EXEMPT_URLS = [
     '^login/$',
     '^dashboard/token_setup$',
     '^dashboard/amcat',
-    '^dashboard/cron-trigger/\w+$'
+    '^dashboard/cron-trigger/\w+$',
+    '^dashboard/cron-run/\d+/\w+$',
+    '^dashboard/metrics/\w+$'
 ]
 
 MIGRATION_MODULES = {
@@ -95,6 +97,7 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'dashboard.middleware.ProfilingMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -168,17 +171,107 @@ CACHES = {
         'LOCATION': 'dashboard-cache',
     },
 
-    # FileBasedCache isn't particularly fast, and it is recommended to a configure a different caching backend instead.
+    # Filtered query results. DiskCache is shared by all processes on a host, see dashboard.util.disk_cache.
     'query': {
-        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
-        'LOCATION': 'cache/dashboard/queries',
+        'BACKEND': 'dashboard.util.disk_cache.DiskCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache/dashboard/queries'),
         'OPTIONS': {
-            'eviction_policy': 'least-recently-used'
-        }
+            'EVICTION_POLICY': 'least-recently-used',
+            'MAX_SIZE': 512 * 1024 ** 2,
+            'MAX_ENTRIES': 10000,
+            'CULL_FREQUENCY': 10,
+        },
+        # Entries are outdated once the unfiltered result is refreshed, but may be pre-warmed well before use
+        'TIMEOUT': 24 * 3600,
+    },
+
+    # Shared tier of the saved query result cache, see dashboard.util.result_cache. This must be shared between
+    # worker processes, as invalidations are only propagated through this cache.
+    'results': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache/dashboard/results'),
     },
 
 }
 
+# Per-process LRU in front of the 'results' cache
+DASHBOARD_RESULT_CACHE_ALIAS = 'results'
+DASHBOARD_RESULT_CACHE_MAX_BYTES = 64 * 1024 ** 2
+DASHBOARD_RESULT_CACHE_TIMEOUT = 300
+
+# Serve outdated results up to this age while they are refreshed in the background (stale-while-revalidate).
+# Set to None to make viewers wait for the refresh instead.
+DASHBOARD_STALE_WHILE_REVALIDATE = timedelta(days=7)
+
+# After revalidating a result in the background failed, requests for it don't try again for this long
+DASHBOARD_REVALIDATE_BACKOFF = timedelta(minutes=5)
+
+# After a scheduled refresh, compute this many of the most popular filter combinations of each page, among
+# those requested within DASHBOARD_PREWARM_WINDOW. Set to 0 to disable (and stop recording them).
+DASHBOARD_PREWARM_VARIANTS = 5
+DASHBOARD_PREWARM_WINDOW = timedelta(days=14)
+
+# Maximum number of keep-alive connections per AmCAT host, in each process
+DASHBOARD_API_POOL_SIZE = 10
+
+# Give up waiting for an AmCAT task after this many seconds
+DASHBOARD_POLL_TIMEOUT = 600
+
+# Give up on a single request to AmCAT after this many seconds without a response
+DASHBOARD_API_TIMEOUT = 60
+
+# Stop sending requests to an AmCAT host after this many failed (or slow) requests in a row, and serve the
+# last results we have instead. A request is let through every DASHBOARD_BREAKER_RESET seconds to see whether
+# the host is back. See dashboard.util.api.CircuitBreaker.
+DASHBOARD_BREAKER_FAILURES = 5
+DASHBOARD_BREAKER_SLOW_REQUEST = 10
+DASHBOARD_BREAKER_RESET = 30
+
+# Let `manage.py worker` processes refresh results instead of the web workers (see dashboard.models.job).
+# Failed jobs are retried after DASHBOARD_JOB_BACKOFF seconds, doubled after every attempt.
+DASHBOARD_JOB_QUEUE = os.environ.get("DASHBOARD_JOB_QUEUE", "N") in ("1", "Y", "ON")
+DASHBOARD_JOB_BACKOFF = 10
+
+# Scheduled refreshes of a query are delayed by a fixed part (derived from its id) of this many seconds, or of
+# the time between its refreshes if that is shorter, so that queries with the same schedule don't all start
+# at once. 3600 spreads hourly refreshes evenly over the hour, but also delays daily ones by up to an hour.
+# Off by default: refreshes run right on schedule.
+DASHBOARD_REFRESH_JITTER = 0
+
+# Number of threads refreshing the results of a cron trigger at the same time (see dashboard.models.RefreshRun)
+DASHBOARD_REFRESH_WORKERS = 4
+
+# Limits on the load on each AmCAT host, across all workers (see dashboard.util.limiter): concurrent tasks,
+# and requests per second with bursts up to DASHBOARD_API_BURST. Background work (cron, warm-up) can't use the
+# share reserved for viewers. Set DASHBOARD_API_MAX_TASKS or DASHBOARD_API_RATE to None to disable either.
+DASHBOARD_API_MAX_TASKS = 8
+DASHBOARD_API_RATE = 20
+DASHBOARD_API_BURST = 40
+DASHBOARD_API_INTERACTIVE_RESERVE = 0.25
+DASHBOARD_API_QUEUE_TIMEOUT = 60
+DASHBOARD_API_HOST_LIMITS = {}
+
+# Maximum number of database connections each process uses to check the above limits (besides one per task
+# slot it holds), and keeps open while idle
+DASHBOARD_API_LIMITER_CONNECTIONS = 4
+
+# Metrics of all worker processes on this host are collected in this file, and served (in the Prometheus
+# format) at dashboard/metrics/<CRON_SECRET>. Set to None to disable.
+DASHBOARD_METRICS_PATH = os.path.join(BASE_DIR, 'cache/dashboard/metrics.sqlite3')
+
+# Report where the time of each request goes (SQL, AmCAT, caches, compression) in a Server-Timing header
+# (see dashboard.util.profiling). A fraction of requests, and all requests slower than DASHBOARD_PROFILING_SLOW
+# seconds, are logged as JSON lines to DASHBOARD_PROFILING_LOG, which is rotated at DASHBOARD_PROFILING_LOG_SIZE bytes.
+DASHBOARD_PROFILING = os.environ.get("DASHBOARD_PROFILING", "N") in ("1", "Y", "ON")
+DASHBOARD_PROFILING_SAMPLE_RATE = 0.01
+DASHBOARD_PROFILING_SLOW = 2
+DASHBOARD_PROFILING_LOG = os.path.join(BASE_DIR, 'cache/dashboard/profiling.log')
+DASHBOARD_PROFILING_LOG_SIZE = 10 * 1024 ** 2
+DASHBOARD_PROFILING_LOG_BACKUPS = 5
+
+# Queue a `manage.py warm_cache` job after `manage.py migrate`, i.e. on every deploy. Requires DASHBOARD_JOB_QUEUE.
+DASHBOARD_WARM_CACHE_AFTER_MIGRATE = os.environ.get("DASHBOARD_WARM_CACHE_AFTER_MIGRATE", 'N') in ("1", "Y", "ON")
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.8/topics/i18n/
 
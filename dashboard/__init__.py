@@ -1 +1,2 @@
 import dashboard.checks
+import dashboard.hooks
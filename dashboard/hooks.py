@@ -0,0 +1,24 @@
+import logging
+
+from django.conf import settings
+from django.db.models.signals import post_migrate
+from django.dispatch import receiver
+
+log = logging.getLogger(__name__)
+
+
+@receiver(post_migrate)
+def warm_cache_after_migrate(sender, **kwargs):
+    """
+    Queue a warm-up of the result cache after every deploy (i.e., migrate), if DASHBOARD_WARM_CACHE_AFTER_MIGRATE
+    is set. Migrating doesn't wait for (or fail with) AmCAT: the warm-up is done by the workers of the job queue.
+    """
+    if sender.name != "dashboard" or not getattr(settings, "DASHBOARD_WARM_CACHE_AFTER_MIGRATE", False):
+        return
+
+    from dashboard.models.job import Job, queue_enabled
+    if not queue_enabled():
+        log.warning("Not warming the cache after migrate, as DASHBOARD_JOB_QUEUE is off: run `manage.py warm_cache` "
+                    "after deploying instead")
+        return
+    Job.enqueue("warm_cache", key="warm-cache")
@@ -0,0 +1,68 @@
+import threading
+
+from django.core.management import BaseCommand, CommandError
+from django.db import connection
+
+from dashboard.models import System
+from dashboard.util.fake_amcat import FakeAmcatConfig, FakeAmcatServer
+
+
+class Command(BaseCommand):
+    help = "Run a fake AmCAT server (see dashboard.util.fake_amcat), for development and benchmarks without AmCAT."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1", help="Address to listen on (default: 127.0.0.1)")
+        parser.add_argument("--port", type=int, default=8765, help="Port to listen on (default: 8765)")
+        parser.add_argument("--token", default="fake-token", help="Token to accept (default: fake-token)")
+        parser.add_argument("--task-duration", type=float, default=1.0,
+                            help="Seconds until a task is done (default: 1)")
+        parser.add_argument("--result-size", type=int, help="Approximate size of task results in bytes")
+        parser.add_argument("--error-rate", type=float, default=0.0,
+                            help="Fraction of requests that fail with 500 Internal Server Error")
+        parser.add_argument("--failure-rate", type=float, default=0.0, help="Fraction of tasks that fail")
+        parser.add_argument("--throttle-rate", type=float, default=0.0,
+                            help="Fraction of requests that are throttled with 429 Too Many Requests")
+        parser.add_argument("--retry-after", type=int, default=1, help="Retry-After of throttled requests (default: 1)")
+        parser.add_argument("--seed", type=int, help="Random seed, for reproducible errors and throttling")
+        parser.add_argument("--system", type=int,
+                            help="Point the system with this id to the fake server, and synchronise its queries")
+
+    def handle(self, *args, host, port, token, system, **options):
+        for rate in ("error_rate", "failure_rate", "throttle_rate"):
+            if not 0 <= options[rate] <= 1:
+                raise CommandError("--{} must be between 0 and 1".format(rate.replace("_", "-")))
+        if system is not None:
+            try:
+                system = System.objects.get(pk=system)
+            except System.DoesNotExist:
+                raise CommandError("No system with id {}".format(system))
+
+        config = FakeAmcatConfig(token=token, task_duration=options["task_duration"],
+                                 result_size=options["result_size"], error_rate=options["error_rate"],
+                                 failure_rate=options["failure_rate"], throttle_rate=options["throttle_rate"],
+                                 retry_after=options["retry_after"], seed=options["seed"])
+        server = FakeAmcatServer(config, address=(host, port))
+        self.stdout.write("Fake AmCAT running at {} (token: {})".format(server.url, token))
+
+        if system is not None:
+            # The server is listening already, so its requests wait until we start serving below
+            threading.Thread(target=self.use_server, args=(system, server, token), daemon=True).start()
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+    def use_server(self, system: System, server: FakeAmcatServer, token):
+        try:
+            system.hostname, system.amcat_token = server.url, token
+            system.project_id = system.project_id or 1
+            system.save()
+            system.synchronise_queries()
+            self.stdout.write("Pointed {} to the fake server".format(system))
+        except Exception as e:
+            self.stderr.write("Could not point {} to the fake server: {}".format(system, e))
+        finally:
+            connection.close()
@@ -0,0 +1,116 @@
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from django.core.management import BaseCommand, CommandError, call_command
+from django.db import connection
+from django.utils import timezone
+
+from dashboard.models import Page, QueryCache
+from dashboard.models.query import refresh_caches
+from dashboard.util import async_api, limiter
+
+
+def get_page_caches(pages):
+    """Returns the distinct QueryCaches of all cells on the given pages, creating missing ones."""
+    query_caches = OrderedDict()
+    for page in pages:
+        for cells in page.get_cells(select_related=("row", "query__system")).values():
+            for cell in cells:
+                if (cell.query_id, page.id) in query_caches:
+                    continue
+                query_cache, _ = QueryCache.objects.select_related("result").get_or_create(query=cell.query, page=page)
+                query_cache.query, query_cache.page = cell.query, page
+                query_caches[cell.query_id, page.id] = query_cache
+    return list(query_caches.values())
+
+
+def get_invalid_caches(query_caches):
+    """Groups the QueryCaches without a valid result (or one we can attach) by their tag."""
+    caches_by_tag = OrderedDict()
+    for query_cache in query_caches:
+        if query_cache.is_valid() or query_cache.attach_result():
+            continue
+        caches_by_tag.setdefault(query_cache.get_query_tag(), []).append(query_cache)
+    return caches_by_tag
+
+
+def warm_cache():
+    """Warm the tiles of all visible pages. This is the handler of 'warm_cache' jobs (see dashboard.hooks)."""
+    call_command("warm_cache")
+
+
+class Command(BaseCommand):
+    help = "Refresh the invalid results of all tiles on visible pages, so that they are cached before users arrive."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--concurrency", type=int, default=4,
+                            help="Maximum number of AmCAT tasks to run at the same time (default: 4)")
+        parser.add_argument("--system", type=int, help="Only warm pages of the system with this id")
+        parser.add_argument("--all-pages", action="store_true", help="Include pages that are not visible")
+        parser.add_argument("--asyncio", action="store_true",
+                            help="Run all tasks from a single thread with asyncio (requires aiohttp)")
+
+    def handle(self, *args, concurrency, system, all_pages, asyncio, **options):
+        if concurrency < 1:
+            raise CommandError("--concurrency must be at least 1")
+        if asyncio and async_api.aiohttp is None:
+            raise CommandError("--asyncio requires aiohttp, which is not installed (pip install aiohttp)")
+
+        start, requested = time.monotonic(), timezone.now()
+        pages = Page.objects.select_related("system")
+        if not all_pages:
+            pages = pages.filter(visible=True)
+        if system is not None:
+            pages = pages.filter(system_id=system)
+
+        query_caches = get_page_caches(pages)
+        caches_by_tag = get_invalid_caches(query_caches)
+        self.stdout.write("{} tiles, {} distinct results to refresh".format(len(query_caches), len(caches_by_tag)))
+
+        if asyncio:
+            self._refresh_async(caches_by_tag, concurrency, requested)
+        else:
+            self._refresh_threaded(caches_by_tag, concurrency, requested)
+        self.stdout.write("Done in {:.1f}s".format(time.monotonic() - start))
+
+    def _refresh_async(self, caches_by_tag, concurrency, requested):
+        query_caches = [query_cache for tag_caches in caches_by_tag.values() for query_cache in tag_caches]
+        errors = async_api.refresh_caches(query_caches, concurrency=concurrency, requested=requested)
+        for tag, error in errors.items():
+            self.stderr.write("{} failed: {}".format(caches_by_tag[tag][0].query.amcat_name, error))
+        if errors:
+            raise CommandError("{} of {} results could not be refreshed".format(len(errors), len(caches_by_tag)))
+
+    def _refresh_threaded(self, caches_by_tag, concurrency, requested):
+        failed = 0
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = {}
+            for tag, tag_caches in caches_by_tag.items():
+                futures[executor.submit(self._refresh, tag_caches, requested)] = tag_caches
+
+            for n, future in enumerate(as_completed(futures), start=1):
+                tag_caches = futures[future]
+                query = tag_caches[0].query
+                try:
+                    duration = future.result()
+                except Exception as e:
+                    failed += 1
+                    self.stderr.write("[{}/{}] {} failed: {}".format(n, len(futures), query.amcat_name, e))
+                else:
+                    self.stdout.write("[{}/{}] {} ({} tiles) refreshed in {:.1f}s".format(
+                        n, len(futures), query.amcat_name, len(tag_caches), duration))
+
+        if failed:
+            raise CommandError("{} of {} results could not be refreshed".format(failed, len(caches_by_tag)))
+
+    def _refresh(self, query_caches, requested):
+        start = time.monotonic()
+        try:
+            with limiter.priority(limiter.BACKGROUND):
+                # Results refreshed since we started (e.g. by cron) don't need another task
+                refresh_caches(query_caches, requested=requested)
+        finally:
+            # Every thread of the pool has its own database connection
+            connection.close()
+        return time.monotonic() - start
@@ -0,0 +1,105 @@
+import datetime
+import logging
+import os
+import signal
+import socket
+import threading
+
+from django.core.management import BaseCommand, CommandError
+from django.db import connection
+
+from dashboard.models import Job
+from dashboard.util import limiter
+
+log = logging.getLogger(__name__)
+
+# Finished jobs are kept this long, for inspection
+KEEP_FINISHED = datetime.timedelta(days=7)
+
+
+class Worker:
+    """Runs jobs from the queue on `threads` threads, and renews their leases until they are done."""
+
+    def __init__(self, threads, lease, poll_interval, burst=False):
+        self.name = "{}:{}".format(socket.gethostname(), os.getpid())
+        self.threads = threads
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.burst = burst
+
+        self.stopping = threading.Event()
+        self.running = {}  # thread name -> job id
+        self._lock = threading.Lock()
+        self.done = self.failed = 0
+
+    def run(self):
+        Job.delete_finished(KEEP_FINISHED)
+        threads = [threading.Thread(target=self._work, name="{}-{}".format(self.name, i)) for i in range(self.threads)]
+        for thread in threads:
+            thread.start()
+
+        # Renew the leases of our jobs well before they expire
+        while any(thread.is_alive() for thread in threads):
+            with self._lock:
+                job_ids = list(self.running.values())
+            if job_ids:
+                Job.heartbeat(self.name, job_ids, self.lease)
+            for thread in threads:
+                thread.join(self.lease / 3 / len(threads))
+        connection.close()
+        limiter.close_connections()
+
+    def stop(self):
+        self.stopping.set()
+
+    def _work(self):
+        try:
+            while not self.stopping.is_set():
+                job = Job.claim(self.name, self.lease)
+                if job is None:
+                    if self.burst:
+                        return
+                    self.stopping.wait(self.poll_interval)
+                    continue
+
+                with self._lock:
+                    self.running[threading.current_thread().name] = job.id
+                succeeded = False
+                try:
+                    succeeded = job.run()
+                finally:
+                    with self._lock:
+                        del self.running[threading.current_thread().name]
+                        if succeeded:
+                            self.done += 1
+                        else:
+                            self.failed += 1
+        finally:
+            # Every thread has its own database connection
+            connection.close()
+
+
+class Command(BaseCommand):
+    help = "Run jobs from the job queue (see dashboard.models.job) until stopped."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--threads", type=int, default=4, help="Number of jobs to run at the same time (default: 4)")
+        parser.add_argument("--lease", type=int, default=60,
+                            help="Seconds after which other workers may take over the job of a worker that stopped "
+                                 "renewing it (default: 60)")
+        parser.add_argument("--poll-interval", type=float, default=1,
+                            help="Seconds to wait before looking again when the queue is empty (default: 1)")
+        parser.add_argument("--burst", action="store_true", help="Stop when no job is due")
+
+    def handle(self, *args, threads, lease, poll_interval, burst, **options):
+        if threads < 1:
+            raise CommandError("--threads must be at least 1")
+
+        worker = Worker(threads, lease, poll_interval, burst=burst)
+        # Finish the jobs that are running, but don't start new ones
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *_: worker.stop())
+
+        self.stdout.write("Worker {} running jobs on {} threads".format(worker.name, threads))
+        worker.run()
+        self.stdout.write("Stopped: {} jobs done, {} failed".format(worker.done, worker.failed))
@@ -0,0 +1,59 @@
+import json
+from io import StringIO
+from unittest import mock
+
+from django.core.management import CommandError, call_command
+from django.apps import apps
+from django.test import TestCase, override_settings
+
+from dashboard.hooks import warm_cache_after_migrate
+from dashboard.models import Job, System, Page, Query, QueryCache, QueryResult
+from dashboard.models.dashboard import Row, Cell
+
+PARAMETERS = {"script": "aggregation", "articlesets": [1], "output_type": "application/json"}
+
+
+class TestWarmCache(TestCase):
+    def setUp(self):
+        self.system = System.objects.create(hostname="http://amcat.test", project_id=1, project_name="test")
+        self.queries = [
+            Query.objects.create(system=self.system, amcat_query_id=i, amcat_name=str(i), amcat_archived=False,
+                                 amcat_parameters=json.dumps(dict(PARAMETERS, articlesets=[i])))
+            for i in range(3)
+        ]
+        row = Row.objects.create(ordernr=0)
+        for visible in (True, False):
+            page = Page.objects.create(system=self.system, name=str(visible), ordernr=0, visible=visible)
+            for i, query in enumerate(self.queries):
+                Cell.objects.create(query=query, page=page, row=row, width=4, ordernr=i)
+
+    @mock.patch("dashboard.management.commands.warm_cache.refresh_caches")
+    def test_warm_cache(self, refresh_caches):
+        # A valid result for one of the queries
+        query_cache = QueryCache.objects.create(query=self.queries[0], page=Page.objects.get(visible=True))
+        QueryResult.store(query_cache.get_query_tag(), "uuid", "[1]", "application/json")
+
+        call_command("warm_cache", concurrency=2, stdout=StringIO())
+
+        refreshed = sorted(c.query_id for args, _ in refresh_caches.call_args_list for c in args[0])
+        self.assertEqual(refreshed, [q.id for q in self.queries[1:]])
+        self.assertEqual(QueryCache.objects.count(), 3)
+
+    @mock.patch("dashboard.management.commands.warm_cache.Command.handle")
+    def test_after_migrate(self, handle):
+        sender = apps.get_app_config("dashboard")
+        with override_settings(DASHBOARD_WARM_CACHE_AFTER_MIGRATE=True, DASHBOARD_JOB_QUEUE=False):
+            warm_cache_after_migrate(sender)
+        self.assertFalse(Job.objects.exists())
+
+        # Migrate only queues the warm-up, which the workers run
+        with override_settings(DASHBOARD_WARM_CACHE_AFTER_MIGRATE=True, DASHBOARD_JOB_QUEUE=True):
+            warm_cache_after_migrate(sender)
+            warm_cache_after_migrate(sender)
+        self.assertFalse(handle.called)
+        self.assertEqual(list(Job.objects.values_list("kind", flat=True)), ["warm_cache"])
+
+    @mock.patch("dashboard.util.async_api.aiohttp", None)
+    def test_asyncio_without_aiohttp(self):
+        with self.assertRaises(CommandError):
+            call_command("warm_cache", asyncio=True, stdout=StringIO())
@@ -0,0 +1,37 @@
+import json
+from io import StringIO
+from unittest import mock
+
+from django.core.management import call_command
+from django.test import TransactionTestCase
+
+from dashboard.models import Job, System, Page, Query, QueryCache
+from dashboard.models.job import PRIORITY_USER
+from dashboard.models.query import enqueue_refresh
+
+PARAMETERS = {"script": "aggregation", "articlesets": [1], "output_type": "application/json"}
+
+
+class TestWorker(TransactionTestCase):
+    def setUp(self):
+        system = System.objects.create(hostname="http://amcat.test", project_id=1, project_name="test")
+        pages = [Page.objects.create(system=system, name=str(i), ordernr=i) for i in range(2)]
+        queries = [Query.objects.create(system=system, amcat_query_id=i, amcat_name=str(i), amcat_archived=False,
+                                        amcat_parameters=json.dumps(dict(PARAMETERS, articlesets=[i])))
+                   for i in range(2)]
+        self.query_caches = [QueryCache.objects.create(query=query, page=page) for query in queries for page in pages]
+
+    @mock.patch("dashboard.models.query.refresh_caches")
+    def test_worker(self, refresh_caches):
+        # One job per distinct set of parameters, deduplicated by its cache tag
+        jobs = enqueue_refresh(self.query_caches, priority=PRIORITY_USER)
+        self.assertEqual(len(jobs), 2)
+        self.assertEqual(enqueue_refresh(self.query_caches[:1], priority=PRIORITY_USER), jobs[:1])
+
+        out = StringIO()
+        call_command("worker", threads=2, burst=True, stdout=out)
+        self.assertIn("2 jobs done, 0 failed", out.getvalue())
+        self.assertEqual(set(Job.objects.values_list("state", flat=True)), {Job.DONE})
+
+        refreshed = sorted(c.id for args, _ in refresh_caches.call_args_list for c in args[0])
+        self.assertEqual(refreshed, sorted(c.id for c in self.query_caches))
@@ -1,9 +1,15 @@
+import random
 import re
+import time
+
+from django.core.exceptions import MiddlewareNotUsed
 from django.core.urlresolvers import reverse
+from django.db import connection
 from django.http import HttpResponseRedirect
 from django.conf import settings
 from django.shortcuts import redirect
 from dashboard.models import System, Page
+from dashboard.util import profiling
 
 from urllib.parse import urlencode
 
@@ -83,4 +89,45 @@ class MethodOverrideMiddleware(object):
 
     def _get_method_override(self, request):
         method = request.META.get(self.http_header)
-        return method and method.upper()
\ No newline at end of file
+        return method and method.upper()
+
+
+class ProfilingMiddleware:
+    """
+    Reports where the time of each request went (see dashboard.util.profiling) in a Server-Timing
+    header, and logs a sample of them. Enable with DASHBOARD_PROFILING; it should come first in
+    MIDDLEWARE_CLASSES to include the time spent in other middleware.
+    """
+    def __init__(self):
+        if not getattr(settings, "DASHBOARD_PROFILING", False):
+            raise MiddlewareNotUsed()
+
+    def process_request(self, request):
+        request._profile_context = profiling.profile()
+        request._profile = request._profile_context.__enter__()
+
+        # Let Django record the SQL queries of this request (connection.queries keeps the last 9000)
+        request._profile_debug_cursor = connection.force_debug_cursor
+        connection.force_debug_cursor = True
+        request._profile_queries = len(connection.queries_log)
+
+    def process_response(self, request, response):
+        profile = getattr(request, "_profile", None)
+        if profile is None:
+            return response
+
+        connection.force_debug_cursor = request._profile_debug_cursor
+        queries = list(connection.queries_log)[request._profile_queries:]
+        if queries:
+            profile.add("db", sum(float(query["time"]) for query in queries), len(queries))
+        request._profile_context.__exit__(None, None, None)
+
+        total = time.monotonic() - profile.start
+        response["Server-Timing"] = profile.server_timing(total)
+
+        slow = getattr(settings, "DASHBOARD_PROFILING_SLOW", None)
+        if random.random() < getattr(settings, "DASHBOARD_PROFILING_SAMPLE_RATE", 0) or (slow and total > slow):
+            size = len(response.content) if not response.streaming else None
+            profiling.log_profile(profile, method=request.method, path=request.path, status=response.status_code,
+                                  size=size, total_ms=round(total * 1000, 1), time=round(time.time(), 3))
+        return response
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 11:22
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def compress_caches(apps, schema_editor):
+    from dashboard.util.compression import compress
+    QueryCache = apps.get_model("dashboard", "QueryCache")
+    for query_cache in QueryCache.objects.exclude(cache=None).only("id", "cache").iterator():
+        query_cache.cache_gzip, query_cache.cache_brotli, query_cache.cache_length = compress(query_cache.cache)
+        query_cache.save(update_fields=["cache_gzip", "cache_brotli", "cache_length"])
+
+
+def decompress_caches(apps, schema_editor):
+    from dashboard.util.compression import CompressedContent, decompress
+    QueryCache = apps.get_model("dashboard", "QueryCache")
+    for query_cache in QueryCache.objects.exclude(cache_gzip=None).iterator():
+        content = CompressedContent(query_cache.cache_gzip, query_cache.cache_brotli, query_cache.cache_length)
+        query_cache.cache = decompress(content).decode("utf-8")
+        query_cache.save(update_fields=["cache"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0031_system_dashboard_name'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='querycache',
+            name='cache_brotli',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AddField(
+            model_name='querycache',
+            name='cache_gzip',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AddField(
+            model_name='querycache',
+            name='cache_length',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(compress_caches, decompress_caches),
+        migrations.RemoveField(
+            model_name='querycache',
+            name='cache',
+        ),
+    ]
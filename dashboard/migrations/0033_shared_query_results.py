@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 11:25
+from __future__ import unicode_literals
+
+import datetime
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def share_results(apps, schema_editor):
+    QueryCache = apps.get_model("dashboard", "QueryCache")
+    QueryResult = apps.get_model("dashboard", "QueryResult")
+
+    # Caches with equal tags hold the same result: keep the newest one.
+    caches = QueryCache.objects.exclude(cache_tag=None).order_by("cache_tag", "-cache_timestamp")
+    result = None
+    for query_cache in caches.iterator():
+        if result is None or result.tag != query_cache.cache_tag:
+            result = QueryResult.objects.create(
+                tag=query_cache.cache_tag,
+                uuid=query_cache.cache_uuid,
+                timestamp=query_cache.cache_timestamp,
+                mimetype=query_cache.cache_mimetype,
+                gzip=query_cache.cache_gzip,
+                brotli=query_cache.cache_brotli,
+                length=query_cache.cache_length
+            )
+        query_cache.result = result
+        query_cache.save(update_fields=["result"])
+
+
+def unshare_results(apps, schema_editor):
+    QueryCache = apps.get_model("dashboard", "QueryCache")
+    for query_cache in QueryCache.objects.exclude(result=None).select_related("result").iterator():
+        result = query_cache.result
+        query_cache.cache_tag = result.tag
+        query_cache.cache_uuid = result.uuid
+        query_cache.cache_timestamp = result.timestamp
+        query_cache.cache_mimetype = result.mimetype
+        query_cache.cache_gzip = result.gzip
+        query_cache.cache_brotli = result.brotli
+        query_cache.cache_length = result.length
+        query_cache.save()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0032_compress_query_cache'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueryResult',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tag', models.TextField(max_length=36, unique=True)),
+                ('uuid', models.TextField(null=True)),
+                ('timestamp', models.DateTimeField(default=datetime.datetime(1970, 1, 1, 0, 0))),
+                ('mimetype', models.TextField(null=True)),
+                ('gzip', models.BinaryField(null=True)),
+                ('brotli', models.BinaryField(null=True)),
+                ('length', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='querycache',
+            name='result',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='query_caches', to='dashboard.QueryResult'),
+        ),
+        migrations.RunPython(share_results, unshare_results),
+        migrations.RemoveField(
+            model_name='querycache',
+            name='cache_brotli',
+        ),
+        migrations.RemoveField(
+            model_name='querycache',
+            name='cache_gzip',
+        ),
+        migrations.RemoveField(
+            model_name='querycache',
+            name='cache_length',
+        ),
+        migrations.RemoveField(
+            model_name='querycache',
+            name='cache_mimetype',
+        ),
+        migrations.RemoveField(
+            model_name='querycache',
+            name='cache_tag',
+        ),
+        migrations.RemoveField(
+            model_name='querycache',
+            name='cache_timestamp',
+        ),
+        migrations.RemoveField(
+            model_name='querycache',
+            name='cache_uuid',
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 11:32
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0033_shared_query_results'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='system',
+            name='filters_version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 11:36
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0034_system_filters_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FilterVariant',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.TextField()),
+                ('query_override', models.TextField(null=True)),
+                ('extra_filters', django.contrib.postgres.fields.jsonb.JSONField(default=dict)),
+                ('date_override', models.TextField(null=True)),
+                ('hits', models.PositiveIntegerField(default=0)),
+                ('last_access', models.DateTimeField(default=django.utils.timezone.now)),
+                ('page', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='filter_variants', to='dashboard.Page')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='filtervariant',
+            unique_together=set([('page', 'key')]),
+        ),
+    ]
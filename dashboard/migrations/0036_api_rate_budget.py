@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 11:44
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0035_filter_variants'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ApiRateBudget',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hostname', models.TextField(unique=True)),
+                ('tokens', models.FloatField()),
+                ('updated', models.FloatField(help_text='Unix time of the last update of tokens')),
+            ],
+        ),
+    ]
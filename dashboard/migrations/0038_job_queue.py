@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 12:02
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0037_refresh_run'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.TextField()),
+                ('arguments', models.TextField(default='{}')),
+                ('key', models.TextField(null=True)),
+                ('priority', models.IntegerField(default=0)),
+                ('state', models.TextField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='queued')),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('max_attempts', models.PositiveIntegerField(default=5)),
+                ('run_after', models.DateTimeField(default=django.utils.timezone.now)),
+                ('worker', models.TextField(null=True)),
+                ('lease_expires', models.DateTimeField(null=True)),
+                ('error', models.TextField(null=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('finished', models.DateTimeField(null=True)),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='job',
+            index_together=set([('state', 'priority', 'run_after')]),
+        ),
+        # Deduplication: at most one queued or running job per key
+        migrations.RunSQL(
+            "CREATE UNIQUE INDEX dashboard_job_active_key ON dashboard_job (key) "
+            "WHERE state IN ('queued', 'running')",
+            "DROP INDEX dashboard_job_active_key"
+        ),
+    ]
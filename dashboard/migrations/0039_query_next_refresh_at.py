@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 12:04
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.utils import timezone
+
+from dashboard.util.cron import Schedule
+
+
+def schedule_refreshes(apps, schema_editor):
+    Query = apps.get_model("dashboard", "Query")
+    now = timezone.localtime(timezone.now()).replace(tzinfo=None)
+    for query in Query.objects.exclude(refresh_interval=None).exclude(refresh_interval="").iterator():
+        try:
+            next_refresh = Schedule.parse(query.refresh_interval).next_after(now)
+        except ValueError:
+            # These never worked: cron-trigger failed on them
+            continue
+        query.next_refresh_at = timezone.make_aware(next_refresh, is_dst=False)
+        query.save(update_fields=["next_refresh_at"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0038_job_queue'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='query',
+            name='next_refresh_at',
+            field=models.DateTimeField(db_index=True, null=True),
+        ),
+        migrations.RunPython(schedule_refreshes, migrations.RunPython.noop),
+    ]
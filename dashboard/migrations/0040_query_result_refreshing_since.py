@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 12:15
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0039_query_next_refresh_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='queryresult',
+            name='refreshing_since',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 12:36
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0040_query_result_refreshing_since'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='querycache',
+            name='revalidation_failed',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
@@ -1,7 +1,9 @@
 from __future__ import absolute_import
 
-from dashboard.models.query import Query, QueryCache
+from dashboard.models.query import Query, QueryCache, QueryResult
 from dashboard.models.user import User
-from dashboard.models.dashboard import Page, Row, Cell
+from dashboard.models.dashboard import Page, Row, Cell, FilterVariant
 from dashboard.models.highcharts_theme import HighchartsTheme
-from dashboard.models.system import System
\ No newline at end of file
+from dashboard.models.system import System
+from dashboard.models.refresh import RefreshRun
+from dashboard.models.job import Job
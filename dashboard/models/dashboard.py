@@ -4,14 +4,19 @@ import copy
 import itertools
 import json
 import re
+import threading
+import time
 from collections import OrderedDict, namedtuple, defaultdict
 
 from django.contrib.postgres.fields import JSONField
 from django.core.validators import RegexValidator
-from django.db import models
+from django.db import IntegrityError, models
 from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
 
-from dashboard.models.query import Query
+from dashboard.models.query import Query, QueryCache
+from dashboard.util import result_cache
 from dashboard.util.validators import HighchartsCustomizationValidator
 
 
@@ -22,6 +27,16 @@ class Filter(models.Model):
     field = models.CharField(validators=[RegexValidator(field_re, flags=re.IGNORECASE)], max_length=100)
     value = models.CharField(max_length=200)
 
+    def save(self, *args, **kwargs):
+        from dashboard.models.system import System
+        super().save(*args, **kwargs)
+        System.increment_filters_version(self.system_id)
+
+    def delete(self, *args, **kwargs):
+        from dashboard.models.system import System
+        super().delete(*args, **kwargs)
+        System.increment_filters_version(self.system_id)
+
     class Meta:
         app_label = "dashboard"
         ordering = ("field", "value")
@@ -46,6 +61,11 @@ class Page(models.Model):
     def serialise(self):
         return dict(name=self.name, icon=self.icon, visible=self.visible)
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        # Page filters are part of the cache tags of its tiles
+        result_cache.invalidate_many(QueryCache.objects.filter(page=self))
+
     def get_cells(self, select_related=("row",)):
         """
         Efficiently determine a mapping from row to cells.
@@ -88,6 +108,12 @@ class Page(models.Model):
 
         Cell.objects.bulk_create(cells)
         Row.objects.bulk_create(rows)
+
+        # Start with the results of this page, which are shared as long as the parameters are equal
+        QueryCache.objects.bulk_create(
+            QueryCache(query_id=query_cache.query_id, page=page, result_id=query_cache.result_id)
+            for query_cache in QueryCache.objects.filter(page=self).only("query_id", "result_id")
+        )
         return page, cells, rows
 
     def get_unique_copy_name(self):
@@ -108,6 +134,87 @@ class Page(models.Model):
         ordering = ["ordernr"]
 
 
+class FilterVariant(models.Model):
+    """
+    How often the tiles of a page were requested with a combination of filters (q, m and d in the
+    dashboard), so that popular combinations can be computed before they are asked for.
+
+    Requests are counted in memory, and written every FLUSH_INTERVAL seconds or FLUSH_REQUESTS requests
+    (see flush), so filtered tiles don't each cost a write. Counts of a process that stops are lost.
+    """
+    FLUSH_INTERVAL = 60
+    FLUSH_REQUESTS = 100
+
+    page = models.ForeignKey(Page, related_name="filter_variants", on_delete=models.CASCADE)
+    key = models.TextField()
+
+    query_override = models.TextField(null=True)
+    extra_filters = JSONField(default=dict)
+    date_override = models.TextField(null=True)
+
+    hits = models.PositiveIntegerField(default=0)
+    last_access = models.DateTimeField(default=timezone.now)
+
+    @staticmethod
+    def get_key(query_override, extra_filters, date_override):
+        return json.dumps([query_override, extra_filters, date_override], sort_keys=True)
+
+    @classmethod
+    def record(cls, page_id, query_override, extra_filters, date_override):
+        """Count a request for the tiles of a page with the given filters."""
+        key = cls.get_key(query_override, extra_filters, date_override)
+        with _pending_lock:
+            hits, _, _ = _pending_variants.get((page_id, key), (0, None, None))
+            variant = (query_override, extra_filters, date_override)
+            _pending_variants[(page_id, key)] = (hits + 1, timezone.now(), variant)
+            requests = sum(hits for hits, _, _ in _pending_variants.values())
+            due = requests >= cls.FLUSH_REQUESTS or time.monotonic() - _pending_since >= cls.FLUSH_INTERVAL
+        if due:
+            cls.flush()
+
+    @classmethod
+    def flush(cls):
+        """Write the requests counted by this process."""
+        global _pending_variants, _pending_since
+        with _pending_lock:
+            pending, _pending_variants = _pending_variants, {}
+            _pending_since = time.monotonic()
+
+        for (page_id, key), (hits, last_access, (query_override, extra_filters, date_override)) in pending.items():
+            updates = dict(hits=F("hits") + hits, last_access=last_access)
+            if cls.objects.filter(page_id=page_id, key=key).update(**updates):
+                continue
+            try:
+                with transaction.atomic():
+                    cls.objects.create(page_id=page_id, key=key, query_override=query_override,
+                                       extra_filters=extra_filters, date_override=date_override, hits=hits,
+                                       last_access=last_access)
+            except IntegrityError:
+                # Created by another process
+                cls.objects.filter(page_id=page_id, key=key).update(**updates)
+
+    @classmethod
+    def delete_stale(cls, window):
+        """Delete variants that were not requested within `window`, as they won't be prewarmed anymore."""
+        return cls.objects.filter(last_access__lt=timezone.now() - window).delete()
+
+    @classmethod
+    def get_popular(cls, page_id, n, window):
+        """Returns the `n` most requested variants of a page among those requested within `window`."""
+        variants = cls.objects.filter(page_id=page_id, last_access__gte=timezone.now() - window)
+        return variants.order_by("-hits", "-last_access")[:n]
+
+    class Meta:
+        app_label = "dashboard"
+        unique_together = ("page", "key")
+
+
+# (page id, key) -> (hits, last access, (query_override, extra_filters, date_override)) not yet written
+_pending_variants = {}
+_pending_since = time.monotonic()
+_pending_lock = threading.Lock()
+
+
 class Row(models.Model):
     ordernr = models.PositiveSmallIntegerField(db_index=True)
 
@@ -0,0 +1,184 @@
+"""
+A job queue in a plain Postgres table, so that heavy work (refreshing results, cron runs) is done by
+`manage.py worker` processes instead of the web workers. Enabled with DASHBOARD_JOB_QUEUE; without it,
+this work runs in the web process as before.
+
+* Jobs with a higher priority are claimed first. Workers claim them with SELECT ... FOR UPDATE SKIP LOCKED,
+  so they never wait for each other.
+* A claimed job is leased to its worker, which renews the lease while it runs (a heartbeat). Jobs whose
+  lease expired, because their worker died, are claimed again.
+* Failed jobs are retried after an exponential backoff, up to `max_attempts` times.
+* Jobs with a `key` (the cache tag of the result they compute) are deduplicated: while a job with that key
+  is queued or running, enqueueing another one returns the existing job.
+
+A job calls the function HANDLERS[kind] with its arguments, which must be JSON serialisable.
+"""
+import datetime
+import json
+import logging
+import random
+import traceback
+
+from django.conf import settings
+from django.db import IntegrityError, models, transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from dashboard.util import limiter
+
+log = logging.getLogger(__name__)
+
+# A viewer is waiting for the result
+PRIORITY_INTERACTIVE = 100
+# Users will see the result later: a refresh asked for by an editor, or revalidating an outdated result
+PRIORITY_USER = 50
+# Scheduled refreshes and warm-up
+PRIORITY_BACKGROUND = 0
+
+HANDLERS = {
+    "refresh": "dashboard.models.query.refresh_query_caches",
+    "revalidate": "dashboard.views.dashboard_view.revalidate_cache",
+    "refresh_run": "dashboard.views.cron.run_scheduled",
+    "prewarm": "dashboard.views.dashboard_view.prewarm_filter_variants",
+    "warm_cache": "dashboard.management.commands.warm_cache.warm_cache",
+}
+
+
+def queue_enabled():
+    return getattr(settings, "DASHBOARD_JOB_QUEUE", False)
+
+
+class Job(models.Model):
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STATES = ((QUEUED, "Queued"), (RUNNING, "Running"), (DONE, "Done"), (FAILED, "Failed"))
+    ACTIVE_STATES = (QUEUED, RUNNING)
+
+    kind = models.TextField()
+    arguments = models.TextField(default="{}")
+    # Only one queued or running job per key (enforced by a partial unique index)
+    key = models.TextField(null=True)
+    priority = models.IntegerField(default=PRIORITY_BACKGROUND)
+
+    state = models.TextField(choices=STATES, default=QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    run_after = models.DateTimeField(default=timezone.now)
+    worker = models.TextField(null=True)
+    lease_expires = models.DateTimeField(null=True)
+    error = models.TextField(null=True)
+
+    created = models.DateTimeField(auto_now_add=True)
+    finished = models.DateTimeField(null=True)
+
+    @classmethod
+    def enqueue(cls, kind, arguments=None, key=None, priority=PRIORITY_BACKGROUND, max_attempts=5):
+        """Queue a job, or return the queued or running job with the same key (raising its priority if needed)."""
+        if kind not in HANDLERS:
+            raise ValueError("Unknown job kind: {}".format(kind))
+
+        if key is not None:
+            existing = cls._get_active(key, priority)
+            if existing is not None:
+                return existing
+
+        try:
+            with transaction.atomic():
+                return cls.objects.create(kind=kind, arguments=json.dumps(arguments or {}), key=key,
+                                          priority=priority, max_attempts=max_attempts)
+        except IntegrityError:
+            # Someone else queued it in the meantime
+            existing = cls._get_active(key, priority)
+            if existing is None:
+                raise
+            return existing
+
+    @classmethod
+    def _get_active(cls, key, priority):
+        job = cls.objects.filter(key=key, state__in=cls.ACTIVE_STATES).first()
+        if job is not None and job.priority < priority:
+            cls.objects.filter(pk=job.pk, priority__lt=priority).update(priority=priority)
+            job.priority = priority
+        return job
+
+    @classmethod
+    def claim(cls, worker, lease):
+        """Lease the next job that is due to `worker` for `lease` seconds. Returns None if there is none."""
+        now = timezone.now()
+        due = Q(state=cls.QUEUED, run_after__lte=now) | Q(state=cls.RUNNING, lease_expires__lt=now)
+        with transaction.atomic():
+            job = cls.objects.select_for_update(skip_locked=True).filter(due).order_by("-priority", "run_after").first()
+            if job is None:
+                return None
+            if job.state == cls.RUNNING:
+                log.warning("Lease of {!r} on {} expired".format(job, job.worker))
+                if job.attempts >= job.max_attempts:
+                    # Don't let a job that kills its workers take down the next one as well
+                    job.state, job.finished, job.error = cls.FAILED, now, "Lease expired on {}".format(job.worker)
+                    job.save(update_fields=["state", "finished", "error"])
+                    return cls.claim(worker, lease)
+            job.state = cls.RUNNING
+            job.attempts += 1
+            job.worker = worker
+            job.lease_expires = now + datetime.timedelta(seconds=lease)
+            job.save(update_fields=["state", "attempts", "worker", "lease_expires"])
+        return job
+
+    @classmethod
+    def heartbeat(cls, worker, job_ids, lease):
+        """Renew the leases of the given jobs of `worker`."""
+        expires = timezone.now() + datetime.timedelta(seconds=lease)
+        return cls.objects.filter(id__in=job_ids, worker=worker, state=cls.RUNNING).update(lease_expires=expires)
+
+    @classmethod
+    def delete_finished(cls, age: datetime.timedelta):
+        return cls.objects.filter(state__in=(cls.DONE, cls.FAILED), finished__lt=timezone.now() - age).delete()
+
+    def get_arguments(self):
+        return json.loads(self.arguments)
+
+    def run(self):
+        """Run this (claimed) job, and record whether it succeeded. Returns True if it did."""
+        try:
+            handler = import_string(HANDLERS[self.kind])
+            interactive = self.priority >= PRIORITY_INTERACTIVE
+            with limiter.priority(limiter.INTERACTIVE if interactive else limiter.BACKGROUND):
+                handler(**self.get_arguments())
+        except Exception:
+            log.exception("{!r} failed".format(self))
+            self._failed(traceback.format_exc())
+            return False
+
+        self._update(state=self.DONE, finished=timezone.now(), error=None)
+        return True
+
+    def get_backoff(self):
+        """Seconds to wait before the next attempt: DASHBOARD_JOB_BACKOFF, doubled after each failure."""
+        base = getattr(settings, "DASHBOARD_JOB_BACKOFF", 10)
+        return min(base * 2 ** (self.attempts - 1), 3600) * random.uniform(1, 1.25)
+
+    def _failed(self, error):
+        if self.attempts < self.max_attempts:
+            run_after = timezone.now() + datetime.timedelta(seconds=self.get_backoff())
+            self._update(state=self.QUEUED, run_after=run_after, error=error, worker=None, lease_expires=None)
+        else:
+            self._update(state=self.FAILED, finished=timezone.now(), error=error)
+
+    def _update(self, **fields):
+        # Only if we still hold the lease: otherwise, another worker has taken over
+        updated = Job.objects.filter(pk=self.pk, worker=self.worker, state=self.RUNNING).update(**fields)
+        if not updated:
+            log.warning("{!r} was taken over by another worker".format(self))
+        for name, value in fields.items():
+            setattr(self, name, value)
+
+    def __repr__(self):
+        return "<{} {} {} key={} attempt={}>".format(self.__class__.__name__, self.id, self.kind, self.key,
+                                                      self.attempts)
+
+    class Meta:
+        app_label = "dashboard"
+        index_together = (("state", "priority", "run_after"),)
@@ -3,33 +3,24 @@ from __future__ import absolute_import
 import datetime
 import json
 import re
+import time
 from _sha512 import sha512
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from io import StringIO
 from urllib.parse import urlencode
 
-from django.db import models
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import models, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
 from dashboard.models.user import EPOCH
-from dashboard.util import itertools
-from dashboard.util.api import get_session, poll
-
-
-def cron_to_set(cron_item):
-    if cron_item.isdigit():
-        return [int(cron_item)]
-    
-    if cron_item == "*":
-        return range(100)
-
-    if "," in cron_item:
-        return map(int, cron_item.split(","))
-
-    if "/" in cron_item:
-        _, stepsize = cron_item.split("/")
-        return range(0, 100, int(stepsize))
-
-    raise ValueError("Invalid cron item: {}".format(cron_item))
+from dashboard.util import itertools, limiter, result_cache
+from dashboard.util.api import FORM_HEADERS, get_session, iter_content, poll
+from dashboard.util.compression import CompressedContent, compress, compress_chunks, decompress
+from dashboard.util.cron import Schedule
+from dashboard.util.lru import LRUCache
 
 
 class Query(models.Model):
@@ -43,29 +34,70 @@ class Query(models.Model):
 
     amcat_options = models.TextField(null=True)
 
+    # Cron expression (see dashboard.util.cron), and the next time it matches
     refresh_interval = models.TextField(null=True)
+    next_refresh_at = models.DateTimeField(null=True, db_index=True)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Deferred fields are not in __dict__, so this does not trigger an extra query
+        self._saved_parameters = self.__dict__.get("amcat_parameters")
+        self._saved_interval = self.__dict__.get("refresh_interval")
 
     @staticmethod
     def get_scheduled():
         return Query.objects.filter(refresh_interval__isnull=False)
 
     @classmethod
-    def get_scheduled_for(cls, timestamp):
-        for query in cls.get_scheduled().only("refresh_interval"):
-            if query.is_scheduled(timestamp):
-                yield query
+    def get_due(cls, timestamp):
+        """Returns the queries with a scheduled refresh at or before `timestamp`."""
+        return cls.objects.filter(next_refresh_at__lte=timestamp)
 
-    def is_scheduled(self, timestamp: datetime.datetime):
-        if not self.refresh_interval:
-            return False
+    def get_schedule(self):
+        """The compiled refresh_interval, or None if this query is not refreshed automatically."""
+        return Schedule.parse(self.refresh_interval) if self.refresh_interval else None
 
-        m, h, dom, mon, dow = map(cron_to_set, self.refresh_interval.split())
+    def clean(self):
+        try:
+            self.get_schedule()
+        except ValueError as e:
+            raise ValidationError({"refresh_interval": str(e)})
 
-        return (timestamp.minute in m and
-                timestamp.hour in h and
-                timestamp.day in dom and
-                timestamp.month in mon and
-                timestamp.weekday() in dow)
+    def is_scheduled(self, timestamp: datetime.datetime):
+        """Whether the schedule matches `timestamp` (a naive local time)."""
+        schedule = self.get_schedule()
+        return schedule is not None and schedule.matches(timestamp)
+
+    def schedule_next(self, after=None):
+        """
+        Set next_refresh_at to the first time after `after` (default: now) the schedule matches, plus the
+        jitter of this query (see get_jitter). Missed times are not repeated: they add up to a single refresh.
+        """
+        schedule = self.get_schedule()
+        if schedule is None:
+            self.next_refresh_at = None
+            return
+        # Schedules are in local time
+        after = timezone.localtime(after or timezone.now()).replace(tzinfo=None)
+        jitter = self.get_jitter(schedule, after)
+        slot = schedule.next_after(after - jitter)
+        self.next_refresh_at = timezone.make_aware(slot, is_dst=False) + jitter
+
+    def get_jitter(self, schedule, after):
+        """
+        Delay of the refreshes of this query after their scheduled time, so that queries with the same schedule
+        don't all start at once. The delay is a fixed fraction (derived from the id) of DASHBOARD_REFRESH_JITTER
+        seconds, or of the time between two refreshes if that is shorter. Hourly refreshes are thus spread evenly
+        over the hour.
+        """
+        window = getattr(settings, "DASHBOARD_REFRESH_JITTER", 0)
+        if not window or self.id is None:
+            return datetime.timedelta(0)
+        first = schedule.next_after(after)
+        interval = (schedule.next_after(first) - first).total_seconds()
+        fraction = int(sha512(str(self.id).encode("ascii")).hexdigest()[:8], 16) / 16 ** 8
+        # Whole minutes, as cron-trigger runs every minute
+        return datetime.timedelta(minutes=int(fraction * min(window, interval) / 60))
 
     @property
     def amcat_project_id(self):
@@ -116,8 +148,21 @@ class Query(models.Model):
         newdate = date_override
         return newdate
 
+    def get_compiled_parameters(self) -> 'CompiledParameters':
+        system = self.system
+        key = (system.id, system.hostname, system.project_id, system.filters_version, self.amcat_parameters)
+        compiled = _compiled_parameters.get(key)
+        if compiled is None:
+            compiled = CompiledParameters(self.amcat_parameters, system.get_global_filters())
+            _compiled_parameters.set(key, compiled)
+        return compiled
+
     def get_parameters(self, query_override=None, extra_options=None, date_override=None):
-        parameters = json.loads(self.amcat_parameters)
+        compiled = self.get_compiled_parameters()
+        if not (query_override or extra_options or date_override):
+            return dict(compiled.parameters, filters=compiled.filters_json)
+
+        parameters = dict(compiled.parameters)
         if query_override:
             parameters['query'] = self._apply_query_override(parameters['query'], query_override)
         if extra_options:
@@ -130,12 +175,15 @@ class Query(models.Model):
                 del parameters['end_date']
             if 'start_date' in parameters:
                 del parameters['start_date']
-        try:
-            filters = json.loads(parameters['filters'])
-        except (KeyError, json.JSONDecodeError):
-            filters = {}
-        filters.update(self.system.get_global_filters())
-        return dict(parameters, filters=json.dumps(filters))
+        if extra_options and 'filters' in extra_options:
+            filters_json = json.dumps(_with_global_filters(parameters, compiled.global_filters))
+        else:
+            filters_json = compiled.filters_json
+        return dict(parameters, filters=filters_json)
+
+    def get_filters(self):
+        """Filters of this query, including the global filters of its system. Do not modify."""
+        return self.get_compiled_parameters().filters
 
     def get_url_kwargs(self):
         return {
@@ -148,16 +196,16 @@ class Query(models.Model):
         }
 
     def get_articleset_ids(self):
-        return list(map(int, self.get_parameters()["articlesets"]))
+        return list(map(int, self.get_compiled_parameters().parameters["articlesets"]))
 
     def get_codingjob_ids(self):
-        return list(map(int, self.get_parameters().get("codingjobs", [])))
+        return list(map(int, self.get_compiled_parameters().parameters.get("codingjobs", [])))
 
     def get_script(self):
-        return self.get_parameters()["script"]
+        return self.get_compiled_parameters().parameters["script"]
 
     def get_output_type(self):
-        return self.get_parameters()["output_type"]
+        return self.get_compiled_parameters().parameters["output_type"]
 
     def get_options(self):
         if self.amcat_options is None:
@@ -169,21 +217,40 @@ class Query(models.Model):
             return None
 
     def refresh_cache(self):
-        for cache in QueryCache.objects.filter(query=self):
-            cache.refresh_cache()
+        refresh_caches(QueryCache.objects.filter(query=self).select_related("result"))
 
     def clear_cache(self):
-        QueryCache.objects.filter(query=self).update(
-            cache_uuid=None,
-            cache_timestamp=EPOCH,
-            cache_tag=None,
-            cache=None,
-        )
+        """Invalidate the results of this query. Their content is kept, so it can still be served as stale."""
+        result_cache.invalidate_many(QueryCache.objects.filter(query=self))
+        QueryResult.objects.filter(query_caches__query=self).update(uuid=None)
 
     def update(self):
         self.update_params()
         self.update_options()
 
+    def save(self, *args, **kwargs):
+        parameters = self.__dict__.get("amcat_parameters")
+
+        interval = self.__dict__.get("refresh_interval")
+        adding = self._state.adding
+        if interval != self._saved_interval:
+            self.schedule_next()
+            if kwargs.get("update_fields") is not None:
+                kwargs["update_fields"] = set(kwargs["update_fields"]) | {"next_refresh_at"}
+
+        super().save(*args, **kwargs)
+        self._saved_interval = interval
+
+        # The jitter of new queries depends on their id
+        if adding and interval:
+            self.schedule_next()
+            super().save(update_fields=["next_refresh_at"])
+
+        # Changed parameters change the cache tags of our results
+        if parameters != self._saved_parameters:
+            result_cache.invalidate_many(QueryCache.objects.filter(query=self))
+            self._saved_parameters = parameters
+
     def update_params(self):
         url = "{host}/api/v4/projects/{project}/querys/{query}/?format=json"
         url = url.format(
@@ -214,6 +281,37 @@ class Query(models.Model):
     class Meta:
         unique_together = ("system", "amcat_query_id")
 
+
+def _with_global_filters(parameters, global_filters):
+    try:
+        filters = json.loads(parameters['filters'])
+    except (KeyError, json.JSONDecodeError):
+        filters = {}
+    filters.update(global_filters)
+    return filters
+
+
+class CompiledParameters:
+    """
+    The amcat_parameters of a Query, parsed and merged with the global filters of its system. These are
+    compiled once per revision of both, and shared by all instances of that query in this process.
+    Treat all attributes as read-only.
+    """
+
+    def __init__(self, amcat_parameters, global_filters):
+        self.parameters = json.loads(amcat_parameters)
+        self.global_filters = dict(global_filters)
+        self.filters = _with_global_filters(self.parameters, global_filters)
+        self.filters_json = json.dumps(self.filters)
+
+        # QueryCache tags without overrides, by page filters
+        self.tags = {}
+
+
+# (system id, hostname, project id, filters version, amcat_parameters) -> CompiledParameters
+_compiled_parameters = LRUCache(1024, sizeof=lambda compiled: 1)
+
+
 def merge_filters(*filtersets):
     filters = {}
     for filterset in filtersets:
@@ -228,27 +326,156 @@ def merge_filters(*filtersets):
 
 
 
+class QueryResult(models.Model):
+    """
+    The result of an AmCAT query task. Results are addressed by the cache tag of the parameters they
+    were computed with, and are shared by all QueryCaches with those parameters.
+    """
+    tag = models.TextField(unique=True, max_length=36)
+    uuid = models.TextField(null=True)
+    timestamp = models.DateTimeField(default=EPOCH)
+    mimetype = models.TextField(null=True)
+
+    gzip = models.BinaryField(null=True)
+    brotli = models.BinaryField(null=True)
+    length = models.PositiveIntegerField(default=0)
+
+    # Set while a refresh of this result is running, see claim_refresh
+    refreshing_since = models.DateTimeField(null=True)
+
+    @property
+    def content(self) -> CompressedContent:
+        """The result in its stored, compressed, form."""
+        # BinaryFields are read from the database as memoryviews
+        return CompressedContent(
+            gzip=bytes(self.gzip) if self.gzip is not None else None,
+            brotli=bytes(self.brotli) if self.brotli is not None else None,
+            length=self.length
+        )
+
+    @content.setter
+    def content(self, content: CompressedContent):
+        self.gzip, self.brotli, self.length = content
+
+    @property
+    def is_complete(self):
+        """
+        False if this result was cleared, or its task has not finished yet. Stale content is kept. Note that
+        an empty result (length 0) is complete as well.
+        """
+        return self.uuid is not None and self.length is not None
+
+    def is_refreshing(self):
+        """Whether a refresh of this result is running. Claims of refreshes that died expire after a while."""
+        return self.refreshing_since is not None and self.refreshing_since > timezone.now() - get_refresh_timeout()
+
+    @classmethod
+    def claim_refresh(cls, tag, since):
+        """
+        Claim the refresh of the result for `tag`, locking its row only while doing so. Returns the result, with
+        `claimed` set if the caller should refresh it. It is not claimed if it was refreshed at or after
+        `since`, or if someone else is refreshing it (see is_refreshing).
+        """
+        with transaction.atomic():
+            result, _ = cls.objects.select_for_update().get_or_create(tag=tag)
+            refreshed = result.is_complete and result.timestamp >= since
+            result.claimed = not refreshed and not result.is_refreshing()
+            if result.claimed:
+                result.refreshing_since = timezone.now()
+                result.save(update_fields=["refreshing_since"])
+        return result
+
+    def release(self):
+        """Give up the refresh claimed with claim_refresh, e.g. because it failed."""
+        QueryResult.objects.filter(pk=self.pk, refreshing_since=self.refreshing_since).update(refreshing_since=None)
+
+    @classmethod
+    def store(cls, tag, uuid, content, mimetype):
+        """
+        Store the result of task `uuid` for all caches with the given tag, ending a refresh claimed with
+        claim_refresh. The content can be given as a string, or already compressed.
+        """
+        if not isinstance(content, CompressedContent):
+            content = compress(content)
+        result, created = cls.objects.update_or_create(tag=tag, defaults=dict(
+            uuid=uuid,
+            content=content,
+            mimetype=mimetype,
+            timestamp=timezone.now(),
+            refreshing_since=None
+        ))
+        result_cache.invalidate_many(QueryCache.objects.filter(result=result))
+        return result
+
+    @classmethod
+    def delete_unused(cls, ids=None):
+        """
+        Delete the results (of the given ids, or all) that no QueryCache points to anymore. Results that
+        are being refreshed, or were just stored, are kept: their caches will point to them soon.
+        """
+        recent = timezone.now() - get_refresh_timeout()
+        unused = cls.objects.filter(query_caches=None)
+        unused = unused.exclude(refreshing_since__gt=recent).exclude(timestamp__gt=recent)
+        if ids is not None:
+            unused = unused.filter(id__in=ids)
+        return unused.delete()
+
+    def __repr__(self):
+        return "<{} {} tag={}>".format(self.__class__.__name__, self.id, self.tag)
+
+    class Meta:
+        app_label = "dashboard"
+
+
 class QueryCache(models.Model):
     """ A persistent cache for queries. Does not expire or get evicted. """
 
     query = models.ForeignKey(Query, on_delete=models.CASCADE)
     page = models.ForeignKey('dashboard.Page', on_delete=models.CASCADE)
-
-    cache = models.TextField(null=True)
-    cache_tag = models.TextField(null=True, max_length=36)
-    cache_timestamp = models.DateTimeField(default=EPOCH)
-    cache_mimetype = models.TextField(null=True)
-    cache_uuid = models.TextField(null=True, db_index=True)
+    result = models.ForeignKey(QueryResult, null=True, on_delete=models.SET_NULL, related_name="query_caches")
 
     refresh_interval = models.TextField(null=True)
 
+    # When revalidating in the background last failed, see revalidation_failed_recently
+    revalidation_failed = models.DateTimeField(null=True)
+
     @property
     def system(self):
         return self.query.system
 
+    @property
+    def cache_tag(self):
+        return self.result.tag if self.result is not None else None
+
+    @property
+    def cache_timestamp(self):
+        return self.result.timestamp if self.result is not None else EPOCH
+
+    @property
+    def cache_mimetype(self):
+        return self.result.mimetype if self.result is not None else None
+
+    @property
+    def cache_uuid(self):
+        return self.result.uuid if self.result is not None else None
+
+    @property
+    def content(self) -> CompressedContent:
+        """The cached result in its stored, compressed, form."""
+        if self.result is None:
+            return CompressedContent(None, None, 0)
+        return self.result.content
+
+    @property
+    def cache(self):
+        """The cached result as a string. Prefer `content` where the compressed form can be used."""
+        if self.result is None or self.result.gzip is None and self.result.brotli is None:
+            return None
+        return decompress(self.content).decode("utf-8")
+
     def get_filters(self, extra_filters=None):
-        query_filters = json.loads(self.query.get_parameters()['filters'])
-        global_filters = self.query.system.get_global_filters()
+        query_filters = self.query.get_filters()
+        global_filters = self.query.get_compiled_parameters().global_filters
 
         page_filters = self.page.filters
 
@@ -266,14 +493,74 @@ class QueryCache(models.Model):
         return query_params
 
     def get_query_tag(self, query_override=None, extra_filters=None, date_override=None):
-        """ Creates a unique tag for these parameters."""
+        """
+        Creates a unique tag for the AmCAT request made with these parameters. Caches with equal tags
+        (e.g., the same query on multiple pages) share their QueryResult.
+        """
+        if query_override or extra_filters or date_override:
+            return self._get_query_tag(query_override, extra_filters, date_override)
+
+        # Without overrides, the tag only depends on the compiled parameters and the page filters
+        tags = self.query.get_compiled_parameters().tags
+        page_filters = json.dumps(self.page.filters, sort_keys=True)
+        try:
+            return tags[page_filters]
+        except KeyError:
+            tag = tags[page_filters] = self._get_query_tag()
+            return tag
+
+    def _get_query_tag(self, query_override=None, extra_filters=None, date_override=None):
         url = self.Urls.task.format(**self.query.get_url_kwargs())
         query_params = self.get_parameters(query_override=query_override, extra_filters=extra_filters, date_override=date_override)
-        key = json.dumps((self.query_id, url, query_params), ensure_ascii=True, sort_keys=True).encode('ascii')
+        key = json.dumps((url, query_params), ensure_ascii=True, sort_keys=True).encode('ascii')
         return sha512(key).hexdigest()[:36]
 
     def is_valid(self, query_override=None, date_override=None):
-        return self.cache_uuid and self.cache and self.cache_tag == self.get_query_tag(query_override=query_override, date_override=date_override)
+        return (self.result is not None and self.result.is_complete and
+                self.result.tag == self.get_query_tag(query_override=query_override, date_override=date_override))
+
+    def can_serve_stale(self):
+        """
+        Whether the content of an invalid result may be served while this cache is revalidated, which is
+        configured by DASHBOARD_STALE_WHILE_REVALIDATE (the maximum age of such content, or None).
+        """
+        max_age = getattr(settings, "DASHBOARD_STALE_WHILE_REVALIDATE", None)
+        if max_age is None or self.result is None or not self.result.length:
+            return False
+        return self.result.timestamp >= timezone.now() - max_age
+
+    def revalidation_failed_recently(self):
+        """
+        Whether revalidating in the background failed less than DASHBOARD_REVALIDATE_BACKOFF ago. Requests
+        for the outdated result don't try again until then.
+        """
+        backoff = getattr(settings, "DASHBOARD_REVALIDATE_BACKOFF", datetime.timedelta(minutes=5))
+        return self.revalidation_failed is not None and self.revalidation_failed > timezone.now() - backoff
+
+    def revalidate(self):
+        """Make this cache valid, unless another cache already fetched a result for the same parameters."""
+        # Any complete result for our parameters will do, including one that someone else is computing now
+        if not self.attach_result():
+            refresh_caches([self], requested=timezone.make_aware(EPOCH))
+
+    def attach_result(self):
+        """
+        Point this cache to an existing complete result for its current parameters, for example one
+        computed for another page. Returns True if such a result was found.
+        """
+        try:
+            result = QueryResult.objects.get(tag=self.get_query_tag())
+        except QueryResult.DoesNotExist:
+            return False
+
+        if not result.is_complete:
+            return False
+
+        previous, self.result = self.result_id, result
+        self.save()
+        if previous is not None and previous != result.id:
+            QueryResult.delete_unused([previous])
+        return True
 
     def poll_once(self, uuid=None):
         if uuid is None:
@@ -291,60 +578,64 @@ class QueryCache(models.Model):
         status, result = session.get_task_result(uuid)
         return status, result
 
-    def poll(self, uuid=None, save_result=False):
-        """ Poll for """
+    def poll(self, uuid=None, save_result=False, tag=None, cancel=None):
+        """
+        Wait for task `uuid`, and return its result as (CompressedContent, mimetype). The result is compressed
+        while it is downloaded, so it is never in memory as a whole uncompressed.
+        """
         if uuid is None:
             uuid = self.cache_uuid
 
         if uuid is None:
             raise ValueError("Can't wait when uuid=None")
 
-        result = poll(get_session(self.query.system), uuid)
+        result = poll(get_session(self.query.system), uuid, cancel=cancel, stream=True)
 
-        cache = result.content.decode('utf-8')
         mimetype = result.headers.get("Content-Type")
+        content = compress_chunks(iter_content(result))
         if save_result:
-            self.cache_tag = self.get_query_tag()
-            self.cache = cache
-            self.cache_timestamp = datetime.datetime.now()
-            self.cache_mimetype = mimetype
+            self.result = QueryResult.store(tag or self.get_query_tag(), uuid, content, mimetype)
             self.save()
+            result_cache.put(self)
 
-        return cache, mimetype
+        return content, mimetype
 
     def start_task(self, query_override=None, extra_options=None, extra_filters=None, date_override=None):
         # We need to fetch it from an amcat instance
         s = get_session(self.system)
 
         # Start job
-        s.headers["Content-Type"] = "application/x-www-form-urlencoded"
         url = self.Urls.task.format(**self.query.get_url_kwargs())
         query_params = self.get_parameters(query_override=query_override, extra_options=extra_options, extra_filters=extra_filters, date_override=date_override)
 
         data = urlencode(query_params, True)
 
-        response = s.post(url, data=data)
+        response = s.post(url, data=data, headers=FORM_HEADERS)
         response.raise_for_status()
         uuid = json.loads(response.content.decode("utf-8"))["uuid"]
         return uuid
 
-    def refresh_cache(self):
-        uuid = self.start_task()
-        self.cache_uuid = uuid
-        self.save()
+    def refresh_cache(self, tag=None):
+        """
+        Run the AmCAT task of this cache and store its result. This does not check whether someone else is
+        refreshing the same result: use refresh_caches() for that.
+        """
+        # Determine the tag before starting, as parameters may change while we wait for the result
+        tag = tag or self.get_query_tag()
+        with limiter.task_slot(self.query.system.hostname):
+            uuid = self.start_task()
 
-        # We need to wait for the result..
-        self.poll(save_result=True)
+            # We need to wait for the result..
+            self.poll(uuid, save_result=True, tag=tag)
+        return self.result
 
     def clear_cache(self):
-        self.cache = None
-        self.cache_timestamp = EPOCH
-        self.cache_mimetype = None
-        self.cache_uuid = None
+        result_cache.invalidate(self.query_id, self.page_id)
+        self.result = None
 
     @property
     def content_size(self):
-        return len(self.cache) if self.cache else 0
+        return self.result.length if self.result is not None else 0
 
     def __repr__(self):
         return "<{} {} query={}>".format(self.__class__.__name__, self.id, self.query_id)
@@ -359,3 +650,82 @@ class QueryCache(models.Model):
     class Meta:
         app_label = "dashboard"
         unique_together = ("query", "page")
+
+
+def get_refresh_timeout():
+    """After this long, a refresh has certainly failed (its process died), and its claim expires."""
+    return datetime.timedelta(seconds=getattr(settings, "DASHBOARD_POLL_TIMEOUT", 600) +
+                                      getattr(settings, "DASHBOARD_API_QUEUE_TIMEOUT", 60) + 60)
+
+
+# Seconds between checks of whether a refresh by someone else has finished
+REFRESH_WAIT_INTERVAL = 1
+
+
+def claim_refresh(tag, since):
+    """
+    Claim the refresh of the result for `tag` (see QueryResult.claim_refresh). If someone else is refreshing
+    it, wait until they're done and use their result; if they failed, claim it after all.
+    """
+    result = QueryResult.claim_refresh(tag, since)
+    while not result.claimed and result.is_refreshing():
+        time.sleep(REFRESH_WAIT_INTERVAL)
+        result = QueryResult.claim_refresh(tag, since)
+    return result
+
+
+def attach_caches(query_caches, result):
+    """Point the given QueryCaches to `result`, and delete the results they pointed to if no longer used."""
+    previous = {query_cache.result_id for query_cache in query_caches} - {None, result.id}
+    for query_cache in query_caches:
+        query_cache.result = result
+    query_caches = QueryCache.objects.filter(id__in=[c.id for c in query_caches])
+    query_caches.update(result=result)
+    result_cache.invalidate_many(query_caches)
+    if previous:
+        QueryResult.delete_unused(previous)
+
+
+def refresh_caches(query_caches, requested=None):
+    """
+    Refresh the given QueryCaches, running a single AmCAT task for each distinct set of parameters.
+    A refresh is claimed on the QueryResult of its parameters (see claim_refresh), so that concurrent
+    refreshes of the same parameters run only one task: the others wait for its result and use that. The
+    task runs outside of a transaction; the row of the result is only locked to claim it.
+
+    @param requested: when the refresh was asked for (default: now). Results stored since are used as they are.
+    """
+    caches_by_tag = OrderedDict()
+    for query_cache in query_caches:
+        caches_by_tag.setdefault(query_cache.get_query_tag(), []).append(query_cache)
+
+    for tag, tag_caches in caches_by_tag.items():
+        result = claim_refresh(tag, requested or timezone.now())
+        if result.claimed:
+            try:
+                result = tag_caches[0].refresh_cache(tag=tag)
+            except BaseException:
+                result.release()
+                raise
+        attach_caches(tag_caches, result)
+
+
+def refresh_query_caches(query_cache_ids, requested=None):
+    """Refresh the QueryCaches with the given ids, see refresh_caches. This is the handler of 'refresh' jobs."""
+    query_caches = QueryCache.objects.filter(id__in=query_cache_ids).select_related("result", "query__system", "page")
+    refresh_caches(query_caches, requested=parse_datetime(requested) if requested else None)
+
+
+def enqueue_refresh(query_caches, priority):
+    """
+    Queue a 'refresh' job for each distinct set of parameters of the given QueryCaches. If such a job is
+    already queued, caches that are not part of it find its result with QueryCache.attach_result().
+    """
+    from dashboard.models.job import Job
+
+    caches_by_tag = OrderedDict()
+    for query_cache in query_caches:
+        caches_by_tag.setdefault(query_cache.get_query_tag(), []).append(query_cache.id)
+    requested = timezone.now().isoformat()
+    return [Job.enqueue("refresh", {"query_cache_ids": ids, "requested": requested}, key=tag, priority=priority)
+            for tag, ids in caches_by_tag.items()]
@@ -0,0 +1,112 @@
+import datetime
+import json
+import logging
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from django.conf import settings
+from django.db import connection, models
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from dashboard.models.query import refresh_caches
+from dashboard.util import limiter, metrics
+
+log = logging.getLogger(__name__)
+
+
+class RefreshRun(models.Model):
+    """
+    A run of the scheduled refreshes of one cron trigger. The distinct results are refreshed by a pool of
+    DASHBOARD_REFRESH_WORKERS threads (each AmCAT host also limits its own tasks, see dashboard.util.limiter),
+    and the summary tells per query how long its refreshes took and which failed.
+    """
+    scheduled_for = models.DateTimeField()
+    started = models.DateTimeField(auto_now_add=True)
+    finished = models.DateTimeField(null=True)
+
+    # JSON: {query id: {"due": scheduled time of its refresh, "seconds": time spent refreshing,
+    #                    "results": number of AmCAT tasks, "errors": [...]}}
+    summary = models.TextField(default="{}")
+
+    @classmethod
+    def create(cls, scheduled_for, due):
+        """Create a run for the minute `scheduled_for`, of queries that were due at {query id: datetime}."""
+        summary = {str(query_id): {"due": timestamp.isoformat()} for query_id, timestamp in due.items()}
+        return cls.objects.create(scheduled_for=scheduled_for, summary=json.dumps(summary, sort_keys=True))
+
+    @classmethod
+    def delete_old(cls, age: datetime.timedelta):
+        return cls.objects.filter(started__lt=timezone.now() - age).delete()
+
+    def get_summary(self):
+        return json.loads(self.summary)
+
+    @property
+    def failures(self):
+        return sum(len(query.get("errors", ())) for query in self.get_summary().values())
+
+    def execute(self, query_caches, workers=None):
+        """Refresh the given QueryCaches, running a single AmCAT task for each distinct set of parameters."""
+        if workers is None:
+            workers = getattr(settings, "DASHBOARD_REFRESH_WORKERS", 4)
+
+        caches_by_tag = OrderedDict()
+        for query_cache in query_caches:
+            caches_by_tag.setdefault(query_cache.get_query_tag(), []).append(query_cache)
+
+        # Number of distinct results still to refresh per query, to know when a query is done
+        remaining = {}
+        for tag_caches in caches_by_tag.values():
+            for query_id in {query_cache.query_id for query_cache in tag_caches}:
+                remaining[query_id] = remaining.get(query_id, 0) + 1
+
+        summary = self.get_summary()
+        for query_id in remaining:
+            summary[str(query_id)] = dict({"seconds": 0, "results": 0, "errors": []}, **summary.get(str(query_id), {}))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(_refresh, tag_caches, self.started): tag_caches
+                       for tag_caches in caches_by_tag.values()}
+            for future in as_completed(futures):
+                duration, error = future.result()
+                for query_id in {query_cache.query_id for query_cache in futures[future]}:
+                    query_summary = summary[str(query_id)]
+                    query_summary["seconds"] = round(query_summary["seconds"] + duration, 3)
+                    query_summary["results"] += 1
+                    if error is not None:
+                        query_summary["errors"].append(error)
+
+                    remaining[query_id] -= 1
+                    if not remaining[query_id]:
+                        due = parse_datetime(query_summary["due"]) if "due" in query_summary else self.scheduled_for
+                        metrics.observe("dashboard_refresh_lag_seconds", (timezone.now() - due).total_seconds())
+
+                self.summary = json.dumps(summary, sort_keys=True)
+                self.save(update_fields=["summary"])
+
+        self.finished = timezone.now()
+        self.save(update_fields=["finished"])
+
+    def __repr__(self):
+        return "<{} {} scheduled_for={}>".format(self.__class__.__name__, self.id, self.scheduled_for)
+
+    class Meta:
+        app_label = "dashboard"
+
+
+def _refresh(query_caches, requested):
+    """Refresh QueryCaches with the same parameters in a worker. Returns (duration, error message or None)."""
+    start = time.monotonic()
+    error = None
+    try:
+        with limiter.priority(limiter.BACKGROUND):
+            # Results refreshed since the run started (e.g. by an overlapping run) are used as they are
+            refresh_caches(query_caches, requested=requested)
+    except Exception as e:
+        log.exception("Refreshing {} failed".format(query_caches[0]))
+        error = "{}: {}".format(type(e).__name__, e)
+    finally:
+        # Every thread of the pool has its own database connection
+        connection.close()
+    return time.monotonic() - start, error
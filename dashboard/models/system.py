@@ -7,9 +7,13 @@ from amcatclient import AmcatAPI
 from amcatclient.amcatclient import Unauthorized, APIError
 from django.core.cache import caches
 from django.db import models
+from django.db.models import F
 from django.utils.translation import gettext as _
 
 from dashboard.models import Query
+from dashboard.models.query import QueryCache
+from dashboard.util import result_cache
+from dashboard.util.api import get_session
 
 
 class System(models.Model):
@@ -20,10 +24,13 @@ class System(models.Model):
     amcat_token = models.TextField(null=True)
     hide_menu = models.BooleanField(default=False, help_text="Hide left hand menu for non super user")
 
+    # Incremented on every change to the global filters, which invalidates compiled query parameters
+    filters_version = models.PositiveIntegerField(default=0, editable=False)
+
     def synchronise_queries(self):
         url = "projects/{project}/querys/".format(project=self.project_id)
         remaining_ids = set(Query.objects.filter(system=self).values_list('amcat_query_id', flat=True))
-        for api_query in self.get_api().get_pages(url):
+        for api_query in get_session(self).api.get_pages(url):
             amcat_query_id = api_query["id"]
             remaining_ids -= {amcat_query_id}
             try:
@@ -52,6 +59,12 @@ class System(models.Model):
 
         super(System, self).save(*args, **kwargs)
 
+    @classmethod
+    def increment_filters_version(cls, system_id):
+        cls.objects.filter(pk=system_id).update(filters_version=F("filters_version") + 1)
+        # Global filters are part of every cache tag of this system
+        result_cache.invalidate_many(QueryCache.objects.filter(query__system_id=system_id))
+
     def get_global_filters(self):
         filterdict = defaultdict(list)
         for filter in self.filter_set.all():
@@ -111,4 +124,14 @@ class System(models.Model):
         project_name = "{{}}: {}".format(self.project_name) if self.project_name is not None else "Project {}"
         project_name = project_name.format(self.project_id)
         return "{}, {}".format(project_name, self.hostname)
-    
\ No newline at end of file
+    
+
+
+class ApiRateBudget(models.Model):
+    """Token bucket of AmCAT requests per host, see dashboard.util.limiter."""
+    hostname = models.TextField(unique=True)
+    tokens = models.FloatField()
+    updated = models.FloatField(help_text="Unix time of the last update of tokens")
+
+    class Meta:
+        app_label = "dashboard"
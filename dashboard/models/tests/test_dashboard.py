@@ -0,0 +1,44 @@
+import datetime
+
+from django.test import TestCase
+from django.utils import timezone
+
+from dashboard.models import System, Page, FilterVariant
+
+
+class TestFilterVariant(TestCase):
+    def setUp(self):
+        self.system = System.objects.create(hostname="http://amcat.test", project_id=1, project_name="test")
+        self.page = Page.objects.create(system=self.system, name="page", ordernr=0)
+
+    def test_popular(self):
+        week = (None, {}, "Laatste week")
+        publishers = (None, {"publisher": ["a", "b"]}, None)
+        for variant in [week, publishers, week, ("x", {}, None), week, publishers]:
+            FilterVariant.record(self.page.id, *variant)
+        # Requests are counted in memory until they are flushed
+        self.assertFalse(FilterVariant.objects.exists())
+        FilterVariant.flush()
+
+        popular = FilterVariant.get_popular(self.page.id, 2, datetime.timedelta(days=1))
+        self.assertEqual([(v.query_override, v.extra_filters, v.date_override) for v in popular],
+                         [week, publishers])
+        self.assertEqual([v.hits for v in popular], [3, 2])
+
+        other_page = Page.objects.create(system=self.system, name="other", ordernr=1)
+        self.assertFalse(FilterVariant.get_popular(other_page.id, 2, datetime.timedelta(days=1)).exists())
+
+        # Counts are added to those written before
+        FilterVariant.record(self.page.id, *publishers)
+        FilterVariant.record(self.page.id, *publishers)
+        FilterVariant.flush()
+        self.assertEqual(FilterVariant.objects.get(key=FilterVariant.get_key(*publishers)).hits, 4)
+
+    def test_delete_stale(self):
+        FilterVariant.record(self.page.id, "x", {}, None)
+        FilterVariant.record(self.page.id, "y", {}, None)
+        FilterVariant.flush()
+        FilterVariant.objects.filter(query_override="x").update(last_access=timezone.now() - datetime.timedelta(days=2))
+
+        FilterVariant.delete_stale(datetime.timedelta(days=1))
+        self.assertEqual([v.query_override for v in FilterVariant.objects.all()], ["y"])
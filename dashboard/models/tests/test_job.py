@@ -0,0 +1,75 @@
+import datetime
+from unittest import mock
+
+from django.test import TestCase
+from django.utils import timezone
+
+from dashboard.models import Job
+from dashboard.models.job import HANDLERS, PRIORITY_INTERACTIVE
+
+calls = []
+
+
+def handler(fail=False, **arguments):
+    calls.append(arguments)
+    if fail:
+        raise ValueError("failed")
+
+
+@mock.patch.dict(HANDLERS, {"test": __name__ + ".handler"})
+class TestJob(TestCase):
+    def setUp(self):
+        calls.clear()
+
+    def test_deduplicate(self):
+        job = Job.enqueue("test", {"x": 1}, key="tag")
+        self.assertEqual(Job.enqueue("test", {"x": 2}, key="tag"), job)
+        self.assertEqual(Job.objects.count(), 1)
+
+        # Asking for it with a higher priority raises the priority of the existing job
+        Job.enqueue("test", key="tag", priority=PRIORITY_INTERACTIVE)
+        self.assertEqual(Job.objects.get().priority, PRIORITY_INTERACTIVE)
+
+        # Once it ran, a new job is queued
+        Job.claim("worker", 60).run()
+        self.assertNotEqual(Job.enqueue("test", key="tag"), job)
+        self.assertRaises(ValueError, Job.enqueue, "unknown")
+
+    def test_claim(self):
+        low = Job.enqueue("test", {"x": 1})
+        high = Job.enqueue("test", {"x": 2}, priority=PRIORITY_INTERACTIVE)
+        later = Job.enqueue("test", {"x": 3})
+        Job.objects.filter(pk=later.pk).update(run_after=timezone.now() + datetime.timedelta(hours=1))
+
+        self.assertEqual(Job.claim("a", 60), high)
+        self.assertEqual(Job.claim("b", 60), low)
+        self.assertIsNone(Job.claim("c", 60))
+
+        # A job whose worker stopped renewing its lease is taken over
+        Job.objects.filter(pk=low.pk).update(lease_expires=timezone.now() - datetime.timedelta(seconds=1))
+        self.assertEqual(Job.heartbeat("a", [high.pk, low.pk], 60), 1)
+        job = Job.claim("c", 60)
+        self.assertEqual((job, job.worker, job.attempts), (low, "c", 2))
+
+        # The first worker can't finish it anymore
+        low.run()
+        self.assertEqual(Job.objects.get(pk=low.pk).state, Job.RUNNING)
+        job.run()
+        self.assertEqual(Job.objects.get(pk=low.pk).state, Job.DONE)
+        self.assertEqual(calls, [{"x": 1}, {"x": 1}])
+
+    def test_retry(self):
+        job = Job.enqueue("test", {"fail": True}, max_attempts=2)
+        self.assertFalse(Job.claim("worker", 60).run())
+        job = Job.objects.get(pk=job.pk)
+        self.assertEqual((job.state, job.attempts), (Job.QUEUED, 1))
+        self.assertIn("ValueError", job.error)
+        self.assertGreater(job.run_after, timezone.now() + datetime.timedelta(seconds=9))
+
+        # Not due until the backoff has passed
+        self.assertIsNone(Job.claim("worker", 60))
+        Job.objects.filter(pk=job.pk).update(run_after=timezone.now())
+        self.assertFalse(Job.claim("worker", 60).run())
+        job = Job.objects.get(pk=job.pk)
+        self.assertEqual((job.state, job.attempts), (Job.FAILED, 2))
+        self.assertIsNotNone(job.finished)
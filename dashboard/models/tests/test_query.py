@@ -0,0 +1,202 @@
+import datetime
+import io
+import json
+from unittest import mock
+
+import requests
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from dashboard.models import System, Page, Query, QueryCache, QueryResult
+from dashboard.models.dashboard import Filter
+from dashboard.models.query import refresh_caches
+
+PARAMETERS = json.dumps({"script": "aggregation", "articlesets": [1], "output_type": "application/json"})
+
+
+@override_settings(DASHBOARD_API_MAX_TASKS=None, DASHBOARD_API_RATE=None)
+class TestQueryCache(TestCase):
+    def setUp(self):
+        self.system = System.objects.create(hostname="http://amcat.test", project_id=1, project_name="test")
+        self.pages = [Page.objects.create(system=self.system, name=str(i), ordernr=i) for i in range(3)]
+        self.query = Query.objects.create(system=self.system, amcat_query_id=1, amcat_name="q",
+                                          amcat_parameters=PARAMETERS, amcat_archived=False)
+
+    def get_caches(self):
+        return [QueryCache.objects.create(query=self.query, page=page) for page in self.pages]
+
+    @mock.patch.object(QueryCache, "start_task", return_value="uuid")
+    @mock.patch("dashboard.models.query.get_session")
+    @mock.patch("dashboard.models.query.poll")
+    def test_refresh_shared(self, poll, get_session, start_task):
+        response = requests.Response()
+        response.raw, response.headers["Content-Type"] = io.BytesIO(b"[1]"), "application/json"
+        poll.return_value = response
+        caches = self.get_caches()
+        refresh_caches(caches)
+
+        self.assertEqual(start_task.call_count, 1)
+        self.assertEqual(QueryResult.objects.count(), 1)
+        for cache in QueryCache.objects.filter(query=self.query):
+            self.assertTrue(cache.is_valid())
+            self.assertEqual(cache.cache, "[1]")
+
+    @mock.patch.object(QueryCache, "start_task", return_value="uuid")
+    def test_refresh_concurrent(self, start_task):
+        # Another refresh of these parameters stored its result while we were waiting for the lock
+        caches = self.get_caches()
+        result = QueryResult.store(caches[0].get_query_tag(), "uuid", "[2]", "application/json")
+        QueryResult.objects.filter(pk=result.pk).update(timestamp=timezone.now() + datetime.timedelta(seconds=1))
+        refresh_caches(caches)
+
+        self.assertFalse(start_task.called)
+        for cache in QueryCache.objects.filter(query=self.query):
+            self.assertEqual(cache.result_id, result.id)
+            self.assertEqual(cache.cache, "[2]")
+
+    @mock.patch.object(QueryCache, "start_task", return_value="uuid")
+    @mock.patch("dashboard.models.query.time.sleep")
+    def test_refresh_waits(self, sleep, start_task):
+        # Another refresh of these parameters is running, so we wait for its result instead of starting a task
+        caches = self.get_caches()
+        tag = caches[0].get_query_tag()
+        QueryResult.objects.create(tag=tag, refreshing_since=timezone.now())
+        sleep.side_effect = lambda seconds: QueryResult.store(tag, "uuid", "[3]", "application/json")
+        refresh_caches(caches)
+
+        self.assertEqual(sleep.call_count, 1)
+        self.assertFalse(start_task.called)
+        self.assertEqual(caches[0].cache, "[3]")
+        result = QueryResult.objects.get(tag=tag)
+        self.assertIsNone(result.refreshing_since)
+
+        # A claim of a refresh that died expires, and failed refreshes give up their claim
+        QueryResult.objects.filter(tag=tag).update(uuid=None, refreshing_since=timezone.now() - datetime.timedelta(days=1))
+        start_task.side_effect = ValueError("AmCAT is down")
+        self.assertRaises(ValueError, refresh_caches, caches)
+        self.assertEqual(start_task.call_count, 1)
+        self.assertIsNone(QueryResult.objects.get(tag=tag).refreshing_since)
+
+    @mock.patch.object(QueryCache, "start_task", return_value="uuid")
+    @mock.patch("dashboard.models.query.time.sleep")
+    def test_revalidate_waits(self, sleep, start_task):
+        # Another revalidation of these parameters is running, and its result will do for us as well
+        cache = self.get_caches()[0]
+        tag = cache.get_query_tag()
+        QueryResult.objects.create(tag=tag, refreshing_since=timezone.now())
+        sleep.side_effect = lambda seconds: QueryResult.store(tag, "uuid", "[4]", "application/json")
+        cache.revalidate()
+
+        self.assertFalse(start_task.called)
+        self.assertTrue(cache.is_valid())
+        self.assertEqual(cache.cache, "[4]")
+
+    def test_attach_result(self):
+        cache = self.get_caches()[0]
+        self.assertFalse(cache.attach_result())
+
+        QueryResult.store(cache.get_query_tag(), "uuid", "[1]", "application/json")
+        self.assertTrue(cache.attach_result())
+        self.assertTrue(cache.is_valid())
+
+    def test_empty_result(self):
+        # An empty result is a result, and should not be fetched again on every request
+        cache = self.get_caches()[0]
+        QueryResult.store(cache.get_query_tag(), "uuid", "", "text/csv")
+        self.assertTrue(cache.attach_result())
+        self.assertTrue(cache.is_valid())
+        self.assertEqual(cache.cache, "")
+
+    @mock.patch.object(QueryCache, "start_task", return_value="uuid")
+    @mock.patch("dashboard.models.query.get_session")
+    @mock.patch("dashboard.models.query.poll")
+    def test_delete_unused(self, poll, get_session, start_task):
+        caches = self.get_caches()
+        old = QueryResult.store("old", "uuid", "[1]", "application/json")
+        QueryResult.objects.filter(pk=old.pk).update(timestamp=timezone.now() - datetime.timedelta(days=1))
+        QueryCache.objects.filter(query=self.query).update(result=old)
+        caches = list(QueryCache.objects.filter(query=self.query))
+
+        # The parameters changed: once the caches point to the new result, the old one is deleted
+        response = requests.Response()
+        response.raw, response.headers["Content-Type"] = io.BytesIO(b"[2]"), "application/json"
+        poll.return_value = response
+        refresh_caches(caches)
+        self.assertEqual(list(QueryResult.objects.values_list("tag", flat=True)), [caches[0].get_query_tag()])
+
+        # Results that are being refreshed (or were just stored) are kept, even if no cache points to them yet
+        QueryResult.objects.update(timestamp=timezone.now() - datetime.timedelta(days=1))
+        refreshing = QueryResult.objects.create(tag="refreshing", refreshing_since=timezone.now())
+        QueryResult.objects.create(tag="orphan")
+        QueryCache.objects.filter(query=self.query).delete()
+        QueryResult.delete_unused()
+        self.assertEqual(list(QueryResult.objects.values_list("id", flat=True)), [refreshing.id])
+
+    def test_clear_cache_keeps_content(self):
+        cache = self.get_caches()[0]
+        QueryResult.store(cache.get_query_tag(), "uuid", "[1]", "application/json")
+        cache.attach_result()
+
+        self.query.clear_cache()
+        cache = QueryCache.objects.get(pk=cache.pk)
+        self.assertFalse(cache.is_valid())
+        self.assertEqual(cache.cache, "[1]")
+
+        with self.settings(DASHBOARD_STALE_WHILE_REVALIDATE=datetime.timedelta(days=1)):
+            self.assertTrue(cache.can_serve_stale())
+        with self.settings(DASHBOARD_STALE_WHILE_REVALIDATE=None):
+            self.assertFalse(cache.can_serve_stale())
+
+    def test_global_filters_change_tag(self):
+        cache = self.get_caches()[0]
+        tag = cache.get_query_tag()
+        self.assertEqual(cache.get_query_tag(), tag)
+        self.assertNotEqual(cache.get_query_tag(extra_filters={"medium": "y"}), tag)
+
+        Filter.objects.create(system=self.system, field="medium", value="x")
+        cache = QueryCache.objects.get(pk=cache.pk)
+        self.assertEqual(cache.query.get_filters(), {"medium": ["x"]})
+        self.assertNotEqual(cache.get_query_tag(), tag)
+
+    @override_settings(DASHBOARD_REFRESH_JITTER=0)
+    def test_schedule(self):
+        self.assertIsNone(self.query.next_refresh_at)
+
+        self.query.refresh_interval = "*/15 * * * *"
+        self.query.save()
+        now = timezone.now()
+        self.assertGreater(self.query.next_refresh_at, now)
+        self.assertLessEqual(self.query.next_refresh_at, now + datetime.timedelta(minutes=15))
+        self.assertEqual(self.query.next_refresh_at.minute % 15, 0)
+
+        self.assertFalse(Query.get_due(now).exists())
+        self.assertTrue(Query.get_due(self.query.next_refresh_at).exists())
+
+        # Queries loaded with only their schedule (as when editing a page) are rescheduled too
+        query = Query.objects.only("id", "refresh_interval").get(pk=self.query.pk)
+        query.refresh_interval = ""
+        query.save()
+        self.assertIsNone(Query.objects.get(pk=self.query.pk).next_refresh_at)
+
+    @override_settings(DASHBOARD_REFRESH_JITTER=3600)
+    def test_jitter(self):
+        queries = [Query.objects.create(system=self.system, amcat_query_id=i, amcat_name="q", amcat_archived=False,
+                                        amcat_parameters=PARAMETERS, refresh_interval="0 * * * *")
+                   for i in range(10, 30)]
+
+        # Hourly refreshes are spread over the hour, the same way every hour
+        minutes = {query.next_refresh_at.minute for query in queries}
+        self.assertGreater(len(minutes), 10)
+        query = queries[0]
+        due = query.next_refresh_at
+        query.schedule_next(due)
+        self.assertEqual(query.next_refresh_at, due + datetime.timedelta(hours=1))
+
+        # Missed refreshes are run only once: the next one is in the future
+        query.schedule_next(due + datetime.timedelta(hours=5, minutes=1))
+        self.assertEqual(query.next_refresh_at, due + datetime.timedelta(hours=6))
+
+        # The jitter is never more than the time between refreshes
+        query.refresh_interval = "*/5 * * * *"
+        query.save()
+        self.assertLess(query.next_refresh_at, timezone.now() + datetime.timedelta(minutes=10))
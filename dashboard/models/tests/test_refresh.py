@@ -0,0 +1,43 @@
+import json
+from unittest import mock
+
+from django.test import TransactionTestCase
+from django.utils import timezone
+
+from dashboard.models import System, Page, Query, QueryCache, RefreshRun
+
+PARAMETERS = {"script": "aggregation", "articlesets": [1], "output_type": "application/json"}
+
+
+class TestRefreshRun(TransactionTestCase):
+    def setUp(self):
+        system = System.objects.create(hostname="http://amcat.test", project_id=1, project_name="test")
+        pages = [Page.objects.create(system=system, name=str(i), ordernr=i) for i in range(2)]
+        self.queries = [Query.objects.create(system=system, amcat_query_id=i, amcat_name=str(i), amcat_archived=False,
+                                             amcat_parameters=json.dumps(dict(PARAMETERS, articlesets=[i])))
+                        for i in range(3)]
+        self.query_caches = [QueryCache.objects.create(query=query, page=page)
+                             for query in self.queries for page in pages]
+
+    @mock.patch("dashboard.models.refresh.refresh_caches")
+    def test_execute(self, refresh_caches):
+        def refresh(query_caches, requested=None):
+            if query_caches[0].query_id == self.queries[1].id:
+                raise ValueError("AmCAT is down")
+        refresh_caches.side_effect = refresh
+
+        run = RefreshRun.objects.create(scheduled_for=timezone.now())
+        run.execute(self.query_caches, workers=2)
+
+        # The caches of each query share their parameters, so that is one refresh per query
+        self.assertEqual(refresh_caches.call_count, 3)
+        self.assertEqual(sorted(len(call[0][0]) for call in refresh_caches.call_args_list), [2, 2, 2])
+
+        run = RefreshRun.objects.get(pk=run.pk)
+        self.assertIsNotNone(run.finished)
+        self.assertEqual(run.failures, 1)
+        summary = run.get_summary()
+        self.assertEqual(set(summary), {str(query.id) for query in self.queries})
+        self.assertEqual(summary[str(self.queries[0].id)]["errors"], [])
+        self.assertEqual(summary[str(self.queries[1].id)]["errors"], ["ValueError: AmCAT is down"])
+        self.assertEqual(summary[str(self.queries[2].id)]["results"], 1)
@@ -180,9 +180,11 @@ define(["jquery", "pnotify", "bootstrap-multiselect", "jquery.cookie", "query/ut
                     .addClass('glyphicon-floppy-disk'), 1000);
 
                 new PNotify({text: "Saving OK", type: "success", delay: 200})
-            }).fail(function () {
+            }).fail(function (xhr) {
                 $save.removeClass("disabled").find("i").removeClass("fa-spin");
-                new PNotify({text: "Saving failed", type: "error"})
+                var errors = xhr.responseJSON && xhr.responseJSON.errors;
+                var text = errors ? "Saving failed: " + [].concat.apply([], Object.values(errors)).join(" ") : "Saving failed";
+                new PNotify({text: text, type: "error"})
             })
         };
 
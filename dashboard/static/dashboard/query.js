@@ -62,10 +62,26 @@ define([
     }
 
     function get(url, options) {
-        return fetch(url, {
+        return fetch(url, Object.assign({
             credentials: "same-origin",
             cache: "no-cache",
-        });
+        }, options));
+    }
+
+    // Set by the server when it serves an outdated result while fetching a new one
+    const STALE_HEADER = "X-Dashboard-Stale";
+    const STALE_POLL_INTERVAL = 5000;
+    const STALE_POLL_MAX_INTERVAL = 60000;
+    const STALE_POLL_ATTEMPTS = 10;
+
+    // Asking again for a result that is being computed
+    const PENDING_POLL_INTERVAL = 500;
+    const PENDING_POLL_MAX_INTERVAL = 10000;
+    const PENDING_POLL_ATTEMPTS = 30;
+
+    // Exponential backoff: the time to wait before the given attempt (counting from 0)
+    function backoff(interval, maxInterval, attempt) {
+        return Math.min(interval * Math.pow(2, attempt), maxInterval);
     }
 
     function getJSON(url) {
@@ -85,6 +101,7 @@ define([
             this.link = this.container.data('link');
             this.customizeArgs = this.container.data('customize');
             this.url = this.container.data('saved-query-src');
+            this.staleUrl = null;
         }
 
         async onQueryFetched(query) {
@@ -155,6 +172,21 @@ define([
             this.bindEvents(this.container, query);
             await this.onQueryFetched(query);
             this.container.find(".if-downloadable").toggle(query.is_downloadable);
+            if (this.staleUrl !== null) {
+                this.awaitRevalidation();
+            }
+        }
+
+        async awaitRevalidation() {
+            // Re-render the tile as soon as the server stops serving the outdated result. If it doesn't get a
+            // new one for a while (e.g. because refreshing it fails), give up and keep showing the outdated one.
+            for (let attempt = 0; attempt < STALE_POLL_ATTEMPTS; attempt++) {
+                await sleep(backoff(STALE_POLL_INTERVAL, STALE_POLL_MAX_INTERVAL, attempt));
+                const response = await get(this.staleUrl, {method: "HEAD"});
+                if (response.ok && !response.headers.has(STALE_HEADER)) {
+                    return await this.render();
+                }
+            }
         }
 
         bindEvents(container, query) {
@@ -204,7 +236,7 @@ define([
             });
         }
 
-        async fetchQueryResult(query) {
+        async fetchQueryResult(query, attempt = 0) {
             let qparams = {}
 
             if(this.filterForm !== undefined){
@@ -219,18 +251,32 @@ define([
             let querystr = $.param(qparams, true);
             if (querystr) querystr = `?${querystr}`;
             console.log(querystr);
-            const response = await get(`${query.result_url}${querystr}`);
+            const url = `${query.result_url}${querystr}`;
+            const response = await get(url);
+            if(response.status === 202){
+                // The result is being computed by a worker
+                await this.awaitPending(attempt);
+                return await this.fetchQueryResult(query, attempt + 1);
+            }
+            this.staleUrl = response.headers.has(STALE_HEADER) ? url : null;
             if(query.output_type.indexOf('json') >= 0){
                 const data = await response.json();
                 if(data.status === "pending"){
-                    await sleep(500);
-                    return await this.fetchQueryResult(query);
+                    await this.awaitPending(attempt);
+                    return await this.fetchQueryResult(query, attempt + 1);
                 }
                 return data;
             }
             return await response.text();
         }
 
+        async awaitPending(attempt) {
+            if (attempt >= PENDING_POLL_ATTEMPTS) {
+                throw new Error("The result is taking too long, please try again later.");
+            }
+            await sleep(backoff(PENDING_POLL_INTERVAL, PENDING_POLL_MAX_INTERVAL, attempt));
+        }
+
         get chartExportingOptions(){
             return {
                 exporting: {chartOptions: {title: {text: this.title}}}
@@ -2,7 +2,7 @@ from django.conf.urls import url
 
 import dashboard.views.highcharts_theme
 import dashboard.views.settings
-from dashboard.views import dashboard_edit, amcat_api, cron
+from dashboard.views import dashboard_edit, amcat_api, cron, metrics
 from dashboard.views import dashboard_view
 from dashboard.views import settings
 
@@ -47,4 +47,6 @@ urlpatterns = [
     url("^menu/$", dashboard_edit.menu, name="edit-menu"),
     url("^save_menu/$", dashboard_edit.save_menu, name="save-menu"),
     url("^cron-trigger/(?P<secret>\w+)$", cron.trigger, name="cron-trigger"),
+    url("^cron-run/(?P<run_id>[0-9]+)/(?P<secret>\w+)$", cron.run_summary, name="cron-run"),
+    url("^metrics/(?P<secret>\w+)$", metrics.metrics, name="metrics"),
 ]
@@ -2,7 +2,11 @@ from __future__ import absolute_import
 
 import functools
 import json
-from time import sleep
+import logging
+import os
+import random
+import threading
+import time
 from typing import Iterable, FrozenSet, TYPE_CHECKING
 
 if TYPE_CHECKING:
@@ -14,11 +18,37 @@ except ImportError:
     from urllib import urlencode
 
 import requests
+from amcatclient import AmcatAPI
+from amcatclient.amcatclient import check
+from django.conf import settings
+from django.utils.http import parse_http_date_safe
+from requests.adapters import HTTPAdapter
 
+from dashboard.util import limiter, metrics, profiling
+
+log = logging.getLogger(__name__)
 
 TASK_URL = "{host}/api/v4/task?uuid={uuid}&format=json"
 TASKRESULT_URL = "{host}/api/v4/taskresult/{uuid}?format=json"
 
+FORM_HEADERS = {"Content-Type": "application/x-www-form-urlencoded"}
+
+# Bytes read at a time from streamed task results
+RESULT_CHUNK_SIZE = 64 * 1024
+
+
+# Seconds between status checks of a task: doubles after every check, up to the maximum
+POLL_DELAY = 0.25
+POLL_MAX_DELAY = 5
+
+
+class PollCancelled(Exception):
+    pass
+
+
+class CircuitOpen(Exception):
+    """Raised instead of sending a request to an AmCAT host that is failing, see CircuitBreaker."""
+
 
 class STATUS:
     INPROGRESS = "INPROGRESS"
@@ -27,49 +57,156 @@ class STATUS:
     PENDING = "PENDING"
 
 
+class CircuitBreaker:
+    """
+    Keeps track of the health of an AmCAT host in this process. After DASHBOARD_BREAKER_FAILURES consecutive
+    failed requests (errors, 5xx responses, or responses slower than DASHBOARD_BREAKER_SLOW_REQUEST seconds)
+    the breaker opens: requests fail right away with CircuitOpen, so viewers get the last result we have
+    instead of waiting for a host that doesn't answer. After DASHBOARD_BREAKER_RESET seconds, a single
+    request is let through as a probe. If it succeeds the breaker closes, otherwise it stays open.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, name):
+        self.name = name
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def _probe_due(self):
+        reset = getattr(settings, "DASHBOARD_BREAKER_RESET", 30)
+        return self.state == self.OPEN and time.monotonic() - self.opened_at >= reset
+
+    def is_open(self):
+        """Whether a request would be refused right now."""
+        with self._lock:
+            return self.state != self.CLOSED and not self._probe_due()
+
+    def before_request(self):
+        """Raises CircuitOpen if no request should be sent now. Otherwise, call record() when it is done."""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            if self._probe_due():
+                self.state = self.HALF_OPEN
+                return
+            raise CircuitOpen("Not sending requests to {} for now, as it is failing.".format(self.name))
+
+    def record(self, success: bool, duration=0):
+        """Record the outcome of a request, which took `duration` seconds."""
+        if duration > getattr(settings, "DASHBOARD_BREAKER_SLOW_REQUEST", 10):
+            success = False
+
+        with self._lock:
+            if success:
+                if self.state != self.CLOSED:
+                    log.info("{} is answering again, closing circuit breaker".format(self.name))
+                self.state, self.failures = self.CLOSED, 0
+                return
+
+            self.failures += 1
+            max_failures = getattr(settings, "DASHBOARD_BREAKER_FAILURES", 5)
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= max_failures):
+                if self.state == self.CLOSED:
+                    log.warning("{} failed {} requests in a row, opening circuit breaker".format(
+                        self.name, self.failures))
+                self.state, self.opened_at = self.OPEN, time.monotonic()
+
+
 class ApiSession(requests.Session):
+    """
+    A session with an AmCAT server, keeping its connections alive. Sessions are long-lived and shared
+    between threads (see get_session), so don't change their state (e.g., headers) per request.
+
+    The token of the system is assumed to be valid until AmCAT responds with 401 Unauthorized, at which
+    point it is renewed once and the request is retried.
+    """
     def __init__(self, *, system: 'System'):
         super().__init__()
         self.system = system
-        token = system.get_api().token  # refreshes token as side effect
+        self.token = system.amcat_token
+        self.pid = os.getpid()
+        self.credentials = (system.hostname, system.amcat_token)
+        self._auth_lock = threading.Lock()
+        self.breaker = get_breaker(system)
+
+        pool_size = getattr(settings, "DASHBOARD_API_POOL_SIZE", 10)
+        for prefix in ("http://", "https://"):
+            self.mount(prefix, HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
 
         self.headers["X-CSRFTOKEN"] = self.cookies.get("csrftoken")
-        self.headers["AUTHORIZATION"] = "Token {}".format(token)
+        self.headers["AUTHORIZATION"] = "Token {}".format(self.token)
 
-    def poll(self, uuid, timeout=0.2, max_timeout=2):
-        response = self.get(TASK_URL.format(uuid=uuid, host=self.system.hostname))
-        if response.status_code in (503, 429):  # rate limited
-            sleep(1)
-            return self.poll(uuid, timeout=min(timeout * 2, max_timeout))
-        elif response.status_code == 500: # Error
-            open("/tmp/test.html", "wb").write(response.content)
-            raise Exception("API Error")
-        else:
-            task = json.loads(response.content.decode("utf-8"))
-            status = task["results"][0]["status"]
-
-        if status in (STATUS.INPROGRESS, STATUS.PENDING):
-            return self.poll(uuid, timeout=min(timeout * 2, max_timeout))
-        elif status == STATUS.FAILED:
-            raise ValueError("Task {!r} failed.".format(uuid))
-        elif status == STATUS.SUCCESS:
-            return self.get_task_result(uuid)
-        else:
-            raise ValueError("Unknown status value {!r} returned.".format(status))
+    def request(self, method, url, *args, **kwargs):
+        token = self.token
+        kwargs.setdefault("timeout", getattr(settings, "DASHBOARD_API_TIMEOUT", None))
+        response = self._send(method, url, *args, **kwargs)
+        if response.status_code == 401 and self.authenticate(token):
+            response = self._send(method, url, *args, **kwargs)
+        return response
+
+    def _send(self, method, url, *args, **kwargs):
+        limiter.acquire_request(self.system.hostname)
+        self.breaker.before_request()
+        start = time.monotonic()
+        try:
+            response = super().request(method, url, *args, **kwargs)
+        except Exception:
+            self.breaker.record(False)
+            record_request(method, url, "error", time.monotonic() - start)
+            raise
+        duration = time.monotonic() - start
+        self.breaker.record(response.status_code < 500, duration)
+        record_request(method, url, response.status_code, duration)
+        return response
+
+    def authenticate(self, rejected_token):
+        """
+        Renew the token after `rejected_token` was rejected. Returns whether we have a new token to try.
+        """
+        with self._auth_lock:
+            if self.token != rejected_token:
+                return True  # another thread renewed it while we waited
+
+            token = renew_token(self.system, rejected_token)
+            if token is None:
+                return False
+
+            self.token = token
+            self.credentials = (self.system.hostname, token)
+            self.headers["AUTHORIZATION"] = "Token {}".format(self.token)
+            return True
+
+    @property
+    def api(self) -> AmcatAPI:
+        """An AmcatAPI client (for its helpers, such as get_pages) that makes its requests through this session."""
+        return SessionAmcatAPI(self)
 
     def poll_once(self, uuid):
         response = self.get(TASK_URL.format(uuid=uuid, host=self.system.hostname))
-        print(response)
         task = json.loads(response.content.decode("utf-8"))
         status = task["results"][0]["status"]
         return status, task
 
-    def get_task_result(self, uuid):
-        return self.get(TASKRESULT_URL.format(uuid=uuid, host=self.system.hostname))
+    def get_task_result(self, uuid, stream=False):
+        """
+        Returns the response with the result of a finished task. With stream=True, the body is not read
+        yet: use iter_content() to read it in chunks.
+        """
+        response = self.get(TASKRESULT_URL.format(uuid=uuid, host=self.system.hostname), stream=stream)
+        if stream:
+            try:
+                response.raise_for_status()
+            except requests.HTTPError:
+                response.close()
+                raise
+        return response
 
     def start_task(self, query):
         # Start job
-        self.headers["Content-Type"] = "application/x-www-form-urlencoded"
         url = "{host}/api/v4/query/{script}?format=json&project={project}&sets={sets}".format(**{
             "sets": ",".join(map(str, query.get_articleset_ids())),
             "project": query.amcat_project_id,
@@ -78,27 +215,172 @@ class ApiSession(requests.Session):
             "host": self.system.hostname
         })
 
-        response = self.post(url, data=urlencode(query.get_parameters(), True))
+        response = self.post(url, data=urlencode(query.get_parameters(), True), headers=FORM_HEADERS)
         response.raise_for_status()
         uuid = json.loads(response.content.decode("utf-8"))["uuid"]
 
         return uuid
 
 
-def poll(session: ApiSession, *args, **kwargs):
-    return session.poll(*args, **kwargs)
+class SessionAmcatAPI(AmcatAPI):
+    """AmcatAPI that sends its requests through an ApiSession, instead of authenticating on construction."""
+
+    def __init__(self, session: ApiSession):
+        self.session = session
+        self.host = session.system.hostname
+
+    @property
+    def token(self):
+        return self.session.token
+
+    def request(self, url, method="get", format="json", data=None,
+                expected_status=None, headers=None, use_xpost=True, **options):
+        # Mirrors AmcatAPI.request
+        if expected_status is None:
+            if method == "get":
+                expected_status = 200
+            elif method == "post":
+                expected_status = 201
+            else:
+                raise ValueError("No expected status supplied and method unknown.")
+
+        if not url.startswith("http"):
+            url = "{self.host}/api/v4/{url}".format(**locals())
+
+        if format is not None:
+            options = dict({'format': format}, **options)
+        options = {field: value for field, value in options.items() if value is not None}
+        headers = dict(headers or {})
+
+        if method == "get" and use_xpost:
+            # Send the options as POST data, to allow for a large number of them
+            assert data is None
+            headers["X-HTTP-METHOD-OVERRIDE"] = method
+            data, options, method = options, None, "post"
+
+        response = self.session.request(method, url, data=data, params=options, headers=headers)
+        return check(response, expected_status=expected_status)
+
+
+def renew_token(system: 'System', rejected_token):
+    """
+    Returns a token to replace `rejected_token` of `system`, or None if there is none. A rejected token can't
+    be used to get a new one, so this uses the token of the System if it was replaced since (e.g., in its
+    settings), or else logs in with the credentials in ~/.amcatauth or AMCAT_USER / AMCAT_PASSWORD, if any,
+    and saves the new token on the System for other processes.
+    """
+    from dashboard.models import System
+
+    token = System.objects.filter(pk=system.pk).values_list("amcat_token", flat=True).first()
+    if token and token != rejected_token:
+        return token
+
+    try:
+        token = AmcatAPI(host=system.hostname).token
+    except Exception as e:
+        log.error("AmCAT at {} rejected the token of this system, and no credentials to get a new one are "
+                  "configured. Set a new token in the system settings. ({})".format(system.hostname, e))
+        return None
+
+    # Unless someone else replaced it in the meantime
+    System.objects.filter(pk=system.pk, amcat_token=rejected_token).update(amcat_token=token)
+    log.info("Renewed the token of {}".format(system.hostname))
+    return token
+
+
+def record_request(method, url, status, duration):
+    endpoint = metrics.endpoint_name(url)
+    metrics.inc("dashboard_amcat_requests_total", endpoint=endpoint, method=method.upper(), status=status)
+    metrics.observe("dashboard_amcat_request_seconds", duration, endpoint=endpoint, method=method.upper())
+    profiling.add("amcat", duration)
+
+
+def get_retry_after(response):
+    """Returns the number of seconds to wait according to the Retry-After header, if any."""
+    retry_after = response.headers.get("Retry-After")
+    if retry_after is None:
+        return None
+    try:
+        return max(0, int(retry_after))
+    except ValueError:
+        date = parse_http_date_safe(retry_after)
+        return max(0, date - time.time()) if date is not None else None
+
+
+class Backoff:
+    """
+    Delays between checks of a task's status: exponential (with jitter) from `delay` up to `max_delay`
+    seconds, or as long as AmCAT asks with Retry-After when it is busy.
+    """
+
+    def __init__(self, delay=None, max_delay=None):
+        self.delay = POLL_DELAY if delay is None else delay
+        self.max_delay = POLL_MAX_DELAY if max_delay is None else max_delay
+
+    def next(self, response=None):
+        """Returns the number of seconds to wait before the next check, given the response of this one."""
+        wait = get_retry_after(response) if response is not None else None
+        if wait is None:
+            wait = random.uniform(self.delay / 2, self.delay)
+            self.delay = min(self.delay * 2, self.max_delay)
+        return wait
+
+
+def iter_content(response: requests.Response):
+    """Yields the body of a streamed response in chunks, and releases its connection when done."""
+    try:
+        yield from response.iter_content(RESULT_CHUNK_SIZE)
+    finally:
+        response.close()
+
+
+def poll(session: ApiSession, uuid, timeout=None, cancel: threading.Event=None, stream=False):
+    """
+    Wait for a task through the shared poller of this process (see dashboard.util.poller), and return the
+    response with its result. See TaskWatch.wait and ApiSession.get_task_result for the arguments.
+    """
+    from dashboard.util.poller import poller
+    poller.watch(session.system, uuid).wait(timeout=timeout, cancel=cancel)
+    return session.get_task_result(uuid, stream=stream)
 
 
 def start_task(session: ApiSession, *args, **kwargs):
     return session.start_task(*args, **kwargs)
 
 
-def get_session(system: 'System'):
-    return ApiSession(system=system)
+# system id -> ApiSession, shared by all threads of this process
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+# system id -> CircuitBreaker, which outlive sessions
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(system: 'System') -> CircuitBreaker:
+    with _breakers_lock:
+        breaker = _breakers.get(system.id)
+        if breaker is None:
+            breaker = _breakers[system.id] = CircuitBreaker(system.hostname)
+        return breaker
+
+
+def get_session(system: 'System') -> ApiSession:
+    """
+    Returns the session of this process for the given system. A new session is started if the system's
+    host or token changed.
+    """
+    with _sessions_lock:
+        session = _sessions.get(system.id)
+        credentials = (system.hostname, system.amcat_token)
+        if session is None or session.pid != os.getpid() or session.credentials != credentials:
+            session = ApiSession(system=system)
+            _sessions[system.id] = session
+        return session
 
 
 def search(system_: 'System', cols_=None, page_size_=None, page_=None, method_='get', **filters):
-    api = system_.get_api()
+    api = get_session(system_).api
     path = 'search'
 
     params = dict(filters, project=system_.project_id, format='json')
@@ -0,0 +1,323 @@
+"""
+Asyncio counterpart of dashboard.util.api, for starting and waiting for many AmCAT tasks at once.
+
+AsyncApiSession offers the same operations as ApiSession over a single aiohttp connection pool, so a
+bulk refresh takes as long as its slowest task instead of the sum of all of them. Blocking callers
+(management commands, cron) can use refresh_caches(), which runs its own event loop.
+
+This requires aiohttp, which is an optional dependency (it is not in requirements.txt): pip install aiohttp.
+"""
+import asyncio
+import itertools
+import json
+import logging
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from amcatclient.amcatclient import APIError
+from django.conf import settings
+from django.utils import timezone
+
+from dashboard.util import limiter, metrics
+from dashboard.util.api import (FORM_HEADERS, RESULT_CHUNK_SIZE, STATUS, TASK_URL, TASKRESULT_URL, Backoff,
+                                get_breaker, record_request, renew_token)
+from dashboard.util.compression import Compressor
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+try:
+    from urllib.parse import urlencode
+except ImportError:
+    from urllib import urlencode
+
+log = logging.getLogger(__name__)
+
+class AsyncApiSession:
+    """
+    A session with an AmCAT server for use in an event loop. Like ApiSession, it renews its token
+    only when AmCAT responds with 401 Unauthorized. Use it as an async context manager:
+
+        async with AsyncApiSession(system=system) as session:
+            uuids = await asyncio.gather(*(session.start_task(url, parameters) for ...))
+
+    Waiting for the limiter blocks, so that is done on a pool of `threads` threads of the session. At most
+    that many coroutines should use the session at a time (see fetch_results), so none of them waits for
+    a thread while others are waiting for it.
+    """
+
+    def __init__(self, *, system: 'System', limit=None, threads=None):
+        if aiohttp is None:
+            raise ImportError("AsyncApiSession requires aiohttp")
+        self.system = system
+        self.token = system.amcat_token
+        self.limit = limit or getattr(settings, "DASHBOARD_API_POOL_SIZE", 10)
+        self.threads = threads or self.limit
+        self.breaker = get_breaker(system)
+        self._session = None
+        self._auth_lock = None
+        self._executor = None
+
+    async def __aenter__(self):
+        # Both are bound to the running event loop
+        self._auth_lock = asyncio.Lock()
+        connector = aiohttp.TCPConnector(limit_per_host=self.limit)
+        self._session = aiohttp.ClientSession(connector=connector)
+        self._executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="dashboard-limiter")
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self._session.close()
+        self._executor.shutdown(wait=True)
+
+    async def run_blocking(self, func, *args):
+        """Run a blocking call (e.g., waiting for the limiter) in a thread of this session."""
+        return await run_blocking(func, *args, executor=self._executor)
+
+    def _headers(self, headers=None):
+        return dict(headers or {}, AUTHORIZATION="Token {}".format(self.token))
+
+    async def request(self, method, url, *, headers=None, read=None, **kwargs):
+        """
+        Make a request and return (response, body). The response is released when this returns. The body is
+        read by `await read(response)` if given, or else all at once.
+        """
+        for attempt in range(2):
+            token = self.token
+            await self.run_blocking(limiter.acquire_request, self.system.hostname)
+            self.breaker.before_request()
+            start = time.monotonic()
+            try:
+                async with self._session.request(method, url, headers=self._headers(headers), **kwargs) as response:
+                    body = await read(response) if read is not None else await response.read()
+            except Exception:
+                self.breaker.record(False)
+                record_request(method, url, "error", time.monotonic() - start)
+                raise
+            duration = time.monotonic() - start
+            self.breaker.record(response.status < 500, duration)
+            record_request(method, url, response.status, duration)
+            if response.status != 401 or attempt or not await self.authenticate(token):
+                return response, body
+
+    async def authenticate(self, rejected_token):
+        async with self._auth_lock:
+            if self.token != rejected_token:
+                return True  # renewed by another coroutine while we waited
+
+            token = await self.run_blocking(renew_token, self.system, rejected_token)
+            if token is None:
+                return False
+            self.token = token
+            return True
+
+    async def start_task(self, url, parameters):
+        """Start a task at the given query URL (see QueryCache.Urls.task) and return its uuid."""
+        response, body = await self.request("POST", url, data=urlencode(parameters, True), headers=FORM_HEADERS)
+        response.raise_for_status()
+        return json.loads(body.decode("utf-8"))["uuid"]
+
+    async def poll(self, uuid, timeout=None):
+        """
+        Wait for a task to finish and return its result as (CompressedContent, content type). The status is checked
+        on the same schedule as the poller's (see Backoff); cancel the awaiting asyncio task to stop waiting.
+        """
+        if timeout is None:
+            timeout = getattr(settings, "DASHBOARD_POLL_TIMEOUT", 600)
+        deadline = time.monotonic() + timeout
+        backoff = Backoff()
+
+        for checks in itertools.count(1):
+            response, body = await self.request("GET", TASK_URL.format(uuid=uuid, host=self.system.hostname))
+            if response.status in (503, 429):  # rate limited
+                wait = backoff.next(response)
+            else:
+                response.raise_for_status()
+                status = json.loads(body.decode("utf-8"))["results"][0]["status"]
+                if status == STATUS.SUCCESS:
+                    metrics.observe("dashboard_amcat_task_polls", checks)
+                    return await self.get_task_result(uuid)
+                elif status == STATUS.FAILED:
+                    raise ValueError("Task {!r} failed.".format(uuid))
+                elif status not in (STATUS.INPROGRESS, STATUS.PENDING):
+                    raise ValueError("Unknown status value {!r} returned.".format(status))
+                wait = backoff.next()
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError("Task {!r} did not finish within {} seconds.".format(uuid, timeout))
+            await asyncio.sleep(min(wait, remaining))
+
+    async def get_task_result(self, uuid):
+        """Returns the result of a finished task as (CompressedContent, content type), compressed as it arrives."""
+        async def read(response):
+            if response.status != 200:
+                return await response.read()
+            compressor = Compressor()
+            async for chunk in response.content.iter_chunked(RESULT_CHUNK_SIZE):
+                compressor.update(chunk)
+            return compressor.finish()
+
+        url = TASKRESULT_URL.format(uuid=uuid, host=self.system.hostname)
+        response, content = await self.request("GET", url, read=read)
+        response.raise_for_status()
+        return content, response.headers.get("Content-Type")
+
+    async def get_options(self, url):
+        """Returns the options of the query script at `url` as a JSON string, or None if unavailable."""
+        response, body = await self.request("OPTIONS", url)
+        if response.status >= 400:
+            return None
+        try:
+            text = body.decode("utf-8")
+            json.loads(text)
+        except json.JSONDecodeError:
+            return None
+        return text
+
+    async def api_request(self, path, expected_status=200, **options):
+        """Equivalent of AmcatAPI.request(path, method="get", **options)."""
+        url = path if path.startswith("http") else "{}/api/v4/{}".format(self.system.hostname, path)
+        data = {field: value for field, value in dict(options, format="json").items() if value is not None}
+        headers = dict(FORM_HEADERS, **{"X-HTTP-METHOD-OVERRIDE": "get"})
+        response, body = await self.request("POST", url, data=urlencode(data, True), headers=headers)
+        if response.status != expected_status:
+            raise APIError(response.status, "Request {!r} returned code {}".format(url, response.status), url,
+                           body.decode("utf-8", "replace"))
+        return json.loads(body.decode("utf-8"))
+
+    async def get_pages(self, url, page_size=100, **filters):
+        """Equivalent of AmcatAPI.get_pages, yielding each result of each page."""
+        for page in itertools.count(1):
+            response = await self.api_request(url, page=page, page_size=page_size, **filters)
+            for row in response["results"]:
+                yield row
+            if response["next"] is None:
+                break
+
+    async def search(self, cols_=None, page_size_=None, page_=None, **filters):
+        """Equivalent of dashboard.util.api.search."""
+        return await self.api_request("search", project=self.system.project_id, cols=cols_,
+                                      page_size=page_size_, page=page_, **filters)
+
+
+async def run_blocking(func, *args, executor=None):
+    """Run a blocking call (e.g., waiting for the limiter) in a thread, with the priority of this one."""
+    priority = limiter.get_priority()
+
+    def run():
+        with limiter.priority(priority):
+            return func(*args)
+
+    return await asyncio.get_event_loop().run_in_executor(executor, run)
+
+
+def get_concurrency(hostname, tasks):
+    """The number of tasks to run on `hostname` at a time: as many as the limiter allows, or else all of them."""
+    return limiter.get_limits(hostname)["max_tasks"] or max(tasks, 1)
+
+
+async def fetch_results(session: AsyncApiSession, tasks, concurrency=None):
+    """
+    Start and wait for tasks concurrently, with at most `concurrency` of them running at a time. This is
+    never more than the task slots of the host (see get_concurrency), nor the threads of the session: tasks
+    that can't get a slot would only keep the threads that tasks in a slot need for their requests.
+
+    @param tasks: dict of key -> (url, parameters)
+    @return: dict of key -> (uuid, CompressedContent, content type), or the exception that task raised
+    """
+    limit = min(get_concurrency(session.system.hostname, len(tasks)), session.threads)
+    semaphore = asyncio.Semaphore(min(concurrency or limit, limit))
+
+    async def fetch(url, parameters):
+        async with semaphore:
+            slot = limiter.task_slot(session.system.hostname)
+            await session.run_blocking(slot.__enter__)
+            try:
+                uuid = await session.start_task(url, parameters)
+                content, content_type = await session.poll(uuid)
+            finally:
+                await session.run_blocking(slot.__exit__, None, None, None)
+            return uuid, content, content_type
+
+    keys = list(tasks)
+    results = await asyncio.gather(*(fetch(*tasks[key]) for key in keys), return_exceptions=True)
+    return dict(zip(keys, results))
+
+
+def refresh_caches(query_caches, concurrency=None, requested=None):
+    """
+    Refresh the given QueryCaches like dashboard.models.query.refresh_caches, but with all distinct AmCAT
+    tasks running concurrently: by default as many as the limiter allows per host (see get_concurrency).
+    Refreshes are claimed and stored the same way, so results that are refreshed at the same time by someone
+    else (or since `requested`) are used instead. Returns a dict of tag -> exception for the tasks that failed.
+    """
+    from dashboard.models.query import QueryResult, attach_caches, refresh_caches as refresh_caches_sync
+
+    since = requested or timezone.now()
+    caches_by_system, claimed, busy = OrderedDict(), {}, OrderedDict()
+    for query_cache in query_caches:
+        caches_by_tag = caches_by_system.setdefault(query_cache.query.system, OrderedDict())
+        caches_by_tag.setdefault(query_cache.get_query_tag(), []).append(query_cache)
+
+    errors = {}
+    try:
+        for system, caches_by_tag in caches_by_system.items():
+            for tag, tag_caches in list(caches_by_tag.items()):
+                result = QueryResult.claim_refresh(tag, since)
+                if result.claimed:
+                    claimed[tag] = result
+                    continue
+                del caches_by_tag[tag]
+                if result.is_refreshing():
+                    busy[tag] = tag_caches
+                else:
+                    attach_caches(tag_caches, result)
+
+        async def fetch_all():
+            results = {}
+            for system, caches_by_tag in caches_by_system.items():
+                tasks = OrderedDict()
+                for tag, tag_caches in caches_by_tag.items():
+                    query_cache = tag_caches[0]
+                    url = query_cache.Urls.task.format(**query_cache.query.get_url_kwargs())
+                    tasks[tag] = (url, query_cache.get_parameters())
+                if not tasks:
+                    continue
+                threads = min(concurrency or len(tasks), get_concurrency(system.hostname, len(tasks)))
+                async with AsyncApiSession(system=system, threads=threads) as session:
+                    results.update(await fetch_results(session, tasks, concurrency))
+            return results
+
+        loop = asyncio.new_event_loop()
+        try:
+            with limiter.priority(limiter.BACKGROUND):
+                results = loop.run_until_complete(fetch_all())
+        finally:
+            loop.close()
+
+        for caches_by_tag in caches_by_system.values():
+            for tag, tag_caches in caches_by_tag.items():
+                result = results[tag]
+                if isinstance(result, BaseException):
+                    errors[tag] = result
+                    continue
+                uuid, content, content_type = result
+                attach_caches(tag_caches, QueryResult.store(tag, uuid, content, content_type))
+                del claimed[tag]
+    finally:
+        # Failed refreshes (or all, if we were interrupted) may be claimed by others
+        for result in claimed.values():
+            result.release()
+
+    # Wait for the results others are computing, or compute them ourselves if they fail
+    for tag, tag_caches in busy.items():
+        try:
+            with limiter.priority(limiter.BACKGROUND):
+                refresh_caches_sync(tag_caches, requested=since)
+        except Exception as e:
+            errors[tag] = e
+    return errors
@@ -0,0 +1,45 @@
+"""
+Run work off the request path, in a thread of the current process.
+"""
+import logging
+import threading
+
+from django.db import connection
+
+from dashboard.util import limiter
+
+log = logging.getLogger(__name__)
+
+_running = set()
+_lock = threading.Lock()
+
+
+def run_in_background(func, *args, key=None, **kwargs):
+    """
+    Call func(*args, **kwargs) in a daemon thread. If `key` is given, the call is skipped while
+    another call with the same key is still running in this process.
+
+    @return: True if the call was started, False if it was skipped.
+    """
+    with _lock:
+        if key is not None:
+            if key in _running:
+                return False
+            _running.add(key)
+
+    def run():
+        try:
+            with limiter.priority(limiter.BACKGROUND):
+                func(*args, **kwargs)
+        except Exception:
+            log.exception("Background call to {!r} failed".format(func))
+        finally:
+            # Django opens a database connection per thread, which nobody else will close
+            connection.close()
+            if key is not None:
+                with _lock:
+                    _running.discard(key)
+
+    thread = threading.Thread(target=run, daemon=True, name="dashboard-background-{}".format(key))
+    thread.start()
+    return True
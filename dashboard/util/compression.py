@@ -0,0 +1,131 @@
+"""
+Helpers for storing query results compressed, and serving the compressed bytes as-is.
+
+Results are compressed once when they are stored. Clients that accept the stored
+encoding get those bytes directly with a matching Content-Encoding (which also makes
+@gzip_page leave them alone); only other clients pay for decompression.
+"""
+import gzip
+import re
+import zlib
+from collections import namedtuple
+
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+
+from dashboard.util import profiling
+from dashboard.util.http import set_validators
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 9
+
+CompressedContent = namedtuple("CompressedContent", ("gzip", "brotli", "length"))
+
+_accept_encoding_re = re.compile(r"\s*([^\s;,]+)\s*(?:;\s*q\s*=\s*([0-9.]+))?")
+
+
+def compress(content) -> CompressedContent:
+    """Compress a result (str or bytes) with gzip, and brotli if available."""
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+
+    with profiling.timed("compression"):
+        return CompressedContent(
+            gzip=gzip.compress(content, compresslevel=GZIP_LEVEL),
+            brotli=brotli.compress(content, quality=BROTLI_QUALITY) if brotli is not None else None,
+            length=len(content)
+        )
+
+
+class Compressor:
+    """
+    Compresses a result chunk by chunk, like compress(), so a large result never has to be in memory
+    uncompressed. Feed it with update(), and call finish() for the CompressedContent.
+    """
+
+    def __init__(self):
+        # wbits=31 produces the gzip format
+        self._gzip = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+        self._brotli = brotli.Compressor(quality=BROTLI_QUALITY) if brotli is not None else None
+        self._gzip_chunks, self._brotli_chunks = [], []
+        self.length = 0
+
+    def update(self, chunk: bytes):
+        self.length += len(chunk)
+        with profiling.timed("compression"):
+            self._gzip_chunks.append(self._gzip.compress(chunk))
+            if self._brotli is not None:
+                self._brotli_chunks.append(self._brotli.process(chunk))
+
+    def finish(self) -> CompressedContent:
+        with profiling.timed("compression"):
+            self._gzip_chunks.append(self._gzip.flush())
+            if self._brotli is not None:
+                self._brotli_chunks.append(self._brotli.finish())
+        return CompressedContent(
+            gzip=b"".join(self._gzip_chunks),
+            brotli=b"".join(self._brotli_chunks) if self._brotli is not None else None,
+            length=self.length
+        )
+
+
+def compress_chunks(chunks) -> CompressedContent:
+    """Compress a result given as an iterable of bytes, see Compressor."""
+    compressor = Compressor()
+    for chunk in chunks:
+        compressor.update(chunk)
+    return compressor.finish()
+
+
+def decompress(content: CompressedContent) -> bytes:
+    with profiling.timed("decompression"):
+        if content.gzip is not None:
+            return gzip.decompress(bytes(content.gzip))
+        if content.brotli is not None:
+            return brotli.decompress(bytes(content.brotli))
+        return b""
+
+
+def accepted_encodings(request):
+    """Returns the set of content codings the client accepts according to Accept-Encoding."""
+    accepted = set()
+    for match in _accept_encoding_re.finditer(request.META.get("HTTP_ACCEPT_ENCODING", "")):
+        coding, q = match.group(1).lower(), match.group(2)
+        try:
+            if q is not None and float(q) == 0:
+                continue
+        except ValueError:
+            continue
+        accepted.add(coding)
+    return accepted
+
+
+def compressed_response(request, content: CompressedContent, content_type=None, response_class=HttpResponse,
+                        etag=None, last_modified=None):
+    """
+    Serve `content` in the best encoding the client accepts. If the version of the content is given
+    as `etag` and/or `last_modified`, the response can be used for conditional requests.
+    """
+    accepted = accepted_encodings(request)
+
+    if content.brotli is not None and "br" in accepted:
+        encoding, body = "br", bytes(content.brotli)
+    elif content.gzip is not None and ("gzip" in accepted or "*" in accepted):
+        encoding, body = "gzip", bytes(content.gzip)
+    else:
+        encoding, body = None, decompress(content)
+
+    response = response_class(body, content_type=content_type)
+    if encoding is not None:
+        response["Content-Encoding"] = encoding
+    response["Content-Length"] = str(len(body))
+    patch_vary_headers(response, ("Accept-Encoding",))
+
+    if etag is not None or last_modified is not None:
+        set_validators(response, etag, last_modified, encoding)
+    return response
@@ -0,0 +1,120 @@
+"""
+Cron schedules ("minute hour day-of-month month day-of-week"), compiled once into sets of matching values.
+
+Fields can be `*`, numbers, ranges (`9-17`), steps (`*/15`, `9-17/2`) and lists of those (`0,30`). Months
+and days of the week can also be given by their (English, three letter) names, e.g. `mon-fri` or `jan,jul`.
+Days of the week count from Sunday (0, or 7) as in crontab. As in crontab, a time matches if its day
+matches either the day of the month or the day of the week, when both are restricted.
+
+    schedule = Schedule.parse("0 9-17 * * mon-fri")
+    schedule.next_after(datetime.datetime(2020, 1, 3, 17, 30))  # datetime(2020, 1, 6, 9, 0)
+"""
+import datetime
+import functools
+
+MONTHS = ["jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"]
+DAYS = ["sun", "mon", "tue", "wed", "thu", "fri", "sat"]
+
+# (name, lowest, highest, names)
+FIELDS = [
+    ("minute", 0, 59, None),
+    ("hour", 0, 23, None),
+    ("day of month", 1, 31, None),
+    ("month", 1, 12, {name: i for i, name in enumerate(MONTHS, start=1)}),
+    ("day of week", 0, 7, {name: i for i, name in enumerate(DAYS)}),
+]
+
+# Give up looking for the next time after this many years (e.g. "0 0 31 2 *" never matches)
+MAX_YEARS = 5
+
+
+def _parse_value(value, low, high, names):
+    value = value.strip().lower()
+    if names and value in names:
+        return names[value]
+    if not value.isdigit() or not low <= int(value) <= high:
+        raise ValueError("Invalid value: {!r}, expected {}-{}".format(value, low, high))
+    return int(value)
+
+
+def parse_field(field, low, high, names=None):
+    """Returns the frozenset of values that match a field of a cron expression."""
+    values = set()
+    for item in field.split(","):
+        item, _, step = item.partition("/")
+        if item == "*":
+            start, stop = low, high
+        elif "-" in item:
+            start, stop = (_parse_value(value, low, high, names) for value in item.split("-", 1))
+        else:
+            start = stop = _parse_value(item, low, high, names)
+            # "5/15" means from 5 to the end in steps of 15
+            if step:
+                stop = high
+
+        step = _parse_value(step, 1, high, None) if step else 1
+        if start > stop:
+            raise ValueError("Invalid range: {!r}".format(item))
+        values.update(range(start, stop + 1, step))
+    return frozenset(values)
+
+
+class Schedule:
+    def __init__(self, minutes, hours, days, months, weekdays, any_day, any_weekday):
+        self.minutes = minutes
+        self.hours = hours
+        self.days = days
+        self.months = months
+        self.weekdays = weekdays
+        self.any_day = any_day
+        self.any_weekday = any_weekday
+
+    @classmethod
+    @functools.lru_cache(maxsize=1024)
+    def parse(cls, expression: str) -> "Schedule":
+        """Compile a cron expression, raising ValueError if it is invalid. Compiled schedules are cached."""
+        fields = expression.split()
+        if len(fields) != len(FIELDS):
+            raise ValueError("Invalid cron expression {!r}: expected {} fields".format(expression, len(FIELDS)))
+
+        try:
+            minutes, hours, days, months, weekdays = (parse_field(field, low, high, names)
+                                                      for field, (_, low, high, names) in zip(fields, FIELDS))
+        except ValueError as e:
+            raise ValueError("Invalid cron expression {!r}: {}".format(expression, e))
+
+        # Sunday is both 0 and 7
+        if 7 in weekdays:
+            weekdays = weekdays | {0}
+        return cls(minutes, hours, days, months, weekdays, fields[2] == "*", fields[4] == "*")
+
+    def matches_day(self, date: datetime.date):
+        in_days = date.day in self.days
+        # isoweekday() is 7 for Sunday
+        in_weekdays = date.isoweekday() % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return in_days and in_weekdays
+        return in_days or in_weekdays
+
+    def matches(self, timestamp: datetime.datetime):
+        return (timestamp.minute in self.minutes and timestamp.hour in self.hours and
+                timestamp.month in self.months and self.matches_day(timestamp))
+
+    def next_after(self, timestamp: datetime.datetime):
+        """Returns the first matching minute after `timestamp`, which should be a naive local time."""
+        t = timestamp.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        end = t + datetime.timedelta(days=366 * MAX_YEARS)
+
+        while t < end:
+            if t.month not in self.months:
+                t = (t.replace(day=1, hour=0, minute=0) + datetime.timedelta(days=32)).replace(day=1)
+            elif not self.matches_day(t):
+                t = t.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            elif t.hour not in self.hours:
+                t = t.replace(minute=0) + datetime.timedelta(hours=1)
+            elif t.minute not in self.minutes:
+                later = [minute for minute in self.minutes if minute > t.minute]
+                t = t.replace(minute=min(later)) if later else t.replace(minute=0) + datetime.timedelta(hours=1)
+            else:
+                return t
+        raise ValueError("Schedule never matches within {} years".format(MAX_YEARS))
@@ -0,0 +1,324 @@
+"""
+A size-bounded, on-disk Django cache backend for (filtered) query results.
+
+Values are pickled into blob files, one per key. A SQLite index next to them keeps track of their
+size, expiry and use, so lookups don't touch the directory, eviction doesn't scan it, and the
+total size is known without summing. Blobs are memory-mapped when read.
+
+Configure it like any other cache:
+
+    'query': {
+        'BACKEND': 'dashboard.util.disk_cache.DiskCache',
+        'LOCATION': '/path/to/cache/dir',
+        'OPTIONS': {
+            'MAX_SIZE': 512 * 1024 ** 2,                  # total size of the blobs in bytes
+            'MAX_ENTRIES': 10000,
+            'EVICTION_POLICY': 'least-recently-used',     # or 'least-frequently-used'
+            'CULL_FREQUENCY': 10,                         # evict until 1/CULL_FREQUENCY of space is free
+            'ACCESS_BATCH': 100,                          # see below
+            'ACCESS_INTERVAL': 10,
+        }
+    }
+
+The index and blobs can be shared by all processes on a host. Reads don't take SQLite's (single) write
+lock: the use of entries and the hit/miss counters are recorded in memory, and written to the index
+after ACCESS_BATCH reads or ACCESS_INTERVAL seconds, whichever comes first, and before evicting.
+"""
+import hashlib
+import mmap
+import os
+import pickle
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+LRU = "least-recently-used"
+LFU = "least-frequently-used"
+
+EVICTION_ORDER = {
+    LRU: "accessed",
+    LFU: "hits, accessed",
+}
+
+COUNTERS = ("hits", "misses", "sets", "evictions", "size")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    filename TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    expires REAL,
+    accessed REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed);
+CREATE INDEX IF NOT EXISTS entries_hits ON entries (hits, accessed);
+CREATE INDEX IF NOT EXISTS entries_expires ON entries (expires);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+
+class DiskCache(BaseCache):
+    index_name = "index.sqlite3"
+    blob_dir = "blobs"
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get("OPTIONS", {})
+        self.max_size = int(options.get("MAX_SIZE", 256 * 1024 ** 2))
+        self.eviction_policy = options.get("EVICTION_POLICY", LRU)
+        if self.eviction_policy not in EVICTION_ORDER:
+            raise ValueError("Unknown eviction policy: {!r}".format(self.eviction_policy))
+
+        if self._cull_frequency < 1:
+            raise ValueError("CULL_FREQUENCY must be at least 1, not {!r}".format(self._cull_frequency))
+        self.access_batch = int(options.get("ACCESS_BATCH", 100))
+        self.access_interval = float(options.get("ACCESS_INTERVAL", 10))
+
+        self._dir = os.path.abspath(location)
+        self._local = threading.local()
+
+        # Reads not yet written to the index, see _record_read
+        self._reads_lock = threading.Lock()
+        self._reset_reads()
+
+    # Django cache API
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self._make_key(key, version)
+        with self._transaction() as db:
+            if self._get_entry(db, key) is not None:
+                return False
+        self._set(key, value, timeout)
+        return True
+
+    def get(self, key, default=None, version=None):
+        key = self._make_key(key, version)
+        entry = self._get_entry(self._db(), key)
+        self._record_read(key, entry)
+        if entry is None:
+            return default
+
+        try:
+            return self._read(entry[0])
+        except FileNotFoundError:
+            # Evicted by another process after we looked it up
+            return default
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self._set(self._make_key(key, version), value, timeout)
+
+    def delete(self, key, version=None):
+        key = self._make_key(key, version)
+        with self._transaction() as db:
+            self._delete_entries(db, [key])
+
+    def has_key(self, key, version=None):
+        key = self._make_key(key, version)
+        return self._get_entry(self._db(), key) is not None
+
+    def clear(self):
+        with self._reads_lock:
+            self._reset_reads()
+        with self._transaction() as db:
+            filenames = [filename for (filename,) in db.execute("SELECT filename FROM entries")]
+            db.execute("DELETE FROM entries")
+            db.execute("UPDATE counters SET value = 0 WHERE name = 'size'")
+        for filename in filenames:
+            self._unlink(filename)
+
+    def close(self, **kwargs):
+        # Connections are kept open per thread; Django calls this after every request.
+        pass
+
+    # Statistics
+
+    def stats(self):
+        """Returns the hit/miss/set/eviction counters, total size and number of entries."""
+        with self._transaction() as db:
+            self._write_reads(db)
+            stats = dict.fromkeys(COUNTERS, 0)
+            stats.update(db.execute("SELECT name, value FROM counters"))
+            stats["entries"] = db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        return stats
+
+    # Implementation
+
+    def _make_key(self, key, version):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        return key
+
+    def _connect(self):
+        os.makedirs(os.path.join(self._dir, self.blob_dir), exist_ok=True)
+        db = sqlite3.connect(os.path.join(self._dir, self.index_name), timeout=30, isolation_level=None)
+        db.execute("PRAGMA journal_mode = WAL")
+        db.execute("PRAGMA synchronous = NORMAL")
+        db.executescript(SCHEMA)
+        return db
+
+    def _db(self):
+        # SQLite connections must not be shared between threads, nor survive a fork
+        pid, db = getattr(self._local, "db", (None, None))
+        if pid != os.getpid():
+            db = self._connect()
+            self._local.db = (os.getpid(), db)
+        return db
+
+    @contextmanager
+    def _transaction(self):
+        """Runs a block as a single write transaction, and removes blobs of deleted entries after commit."""
+        db = self._db()
+        self._local.unlinked = []
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+        # Readers that opened a blob before it is unlinked can still read it
+        for filename in self._local.unlinked:
+            self._unlink(filename)
+
+    def _get_entry(self, db, key):
+        """Returns (filename, size) of a live entry, or None if it is missing or has expired."""
+        row = db.execute("SELECT filename, size, expires FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        filename, size, expires = row
+        if expires is not None and expires <= time.time():
+            return None
+        return filename, size
+
+    def _reset_reads(self):
+        self._accessed = {}  # key -> (last access, hits)
+        self._misses = 0
+        self._reads_since = time.monotonic()
+
+    def _record_read(self, key, entry):
+        """Record a hit (or a miss if `entry` is None), and write the reads so far if it is time to."""
+        with self._reads_lock:
+            if entry is None:
+                self._misses += 1
+            else:
+                _, hits = self._accessed.get(key, (None, 0))
+                self._accessed[key] = (time.time(), hits + 1)
+            reads = self._misses + sum(hits for _, hits in self._accessed.values())
+            due = reads >= self.access_batch or time.monotonic() - self._reads_since >= self.access_interval
+
+        if due:
+            with self._transaction() as db:
+                self._write_reads(db)
+
+    def _write_reads(self, db):
+        """Write the recorded reads to the index, and remove entries that were found to be expired."""
+        with self._reads_lock:
+            accessed, misses = self._accessed, self._misses
+            self._reset_reads()
+
+        db.executemany("UPDATE entries SET accessed = MAX(accessed, ?), hits = hits + ? WHERE key = ?",
+                       [(timestamp, hits, key) for key, (timestamp, hits) in accessed.items()])
+        self._count(db, hits=sum(hits for _, hits in accessed.values()), misses=misses)
+
+        expired = [key for (key,) in db.execute("SELECT key FROM entries WHERE expires <= ?", (time.time(),))]
+        self._delete_entries(db, expired)
+
+    def _set(self, key, value, timeout):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        filename = self._write(key, data)
+        now = time.time()
+
+        with self._transaction() as db:
+            old = db.execute("SELECT filename, size FROM entries WHERE key = ?", (key,)).fetchone()
+            if old is not None:
+                self._local.unlinked.append(old[0])
+            db.execute("INSERT OR REPLACE INTO entries (key, filename, size, expires, accessed, hits) "
+                       "VALUES (?, ?, ?, ?, ?, 0)", (key, filename, len(data), self.get_backend_timeout(timeout), now))
+            self._count(db, sets=1, size=len(data) - (old[1] if old else 0))
+            # Evict by up to date use
+            self._write_reads(db)
+            self._cull(db, keep=key)
+
+    def _cull(self, db, keep):
+        """
+        Removes expired entries, then evicts by policy until there's room for new ones. The entry that was
+        just set is kept, as it would always be the first to go with LFU.
+        """
+        size = db.execute("SELECT value FROM counters WHERE name = 'size'").fetchone()[0]
+        count = db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        if size <= self.max_size and count <= self._max_entries:
+            return
+
+        expired = [key for (key,) in db.execute("SELECT key FROM entries WHERE expires <= ?", (time.time(),))]
+        self._delete_entries(db, expired)
+
+        # Make room for a while, rather than evicting a single entry on every set
+        target_size = self.max_size - self.max_size // self._cull_frequency
+        target_count = self._max_entries - self._max_entries // self._cull_frequency
+
+        evicted = []
+        size = db.execute("SELECT value FROM counters WHERE name = 'size'").fetchone()[0]
+        count -= len(expired)
+        order = EVICTION_ORDER[self.eviction_policy]
+        for key, entry_size in db.execute("SELECT key, size FROM entries WHERE key != ? ORDER BY " + order, (keep,)):
+            if size <= target_size and count <= target_count:
+                break
+            evicted.append(key)
+            size -= entry_size
+            count -= 1
+
+        self._delete_entries(db, evicted)
+        self._count(db, evictions=len(evicted))
+
+    def _delete_entries(self, db, keys):
+        for key in keys:
+            row = db.execute("SELECT filename, size FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                continue
+            db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            self._count(db, size=-row[1])
+            self._local.unlinked.append(row[0])
+
+    def _count(self, db, **counts):
+        for name, value in counts.items():
+            db.execute("INSERT OR IGNORE INTO counters (name, value) VALUES (?, 0)", (name,))
+            db.execute("UPDATE counters SET value = value + ? WHERE name = ?", (value, name))
+
+    def _path(self, filename):
+        return os.path.join(self._dir, self.blob_dir, filename[:2], filename)
+
+    def _write(self, key, data):
+        # Every write gets a fresh file, so a blob is never modified once it is in the index
+        filename = "{}-{}".format(hashlib.sha1(key.encode("utf-8")).hexdigest(), os.urandom(4).hex())
+        path = self._path(filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return filename
+
+    def _read(self, filename):
+        with open(self._path(filename), "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return pickle.loads(data)
+
+    def _unlink(self, filename):
+        try:
+            os.remove(self._path(filename))
+        except FileNotFoundError:
+            pass
+
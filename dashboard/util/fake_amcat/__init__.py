@@ -0,0 +1,305 @@
+"""
+A stand-in for an AmCAT server, for developing and benchmarking the dashboard without a live AmCAT.
+
+It implements the parts of the AmCAT API the dashboard uses: token authentication (and renewal), the
+saved queries of a project, query tasks (OPTIONS forms, starting tasks, task status and results) and
+search. Results are made from the fixtures next to this module, repeated up to `result_size` bytes.
+Its behaviour under load can be tuned: how long tasks take, how many requests fail, and how many
+are throttled with 429 Too Many Requests.
+
+Run it with `manage.py fake_amcat`, or from code:
+
+    server = FakeAmcatServer(FakeAmcatConfig(task_duration=0.5)).start()
+    ...
+    server.stop()
+"""
+import csv
+import io
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+import uuid as uuidlib
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+log = logging.getLogger(__name__)
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+
+VERSION = "3.5.0 (fake)"
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES, name), "rb") as f:
+        content = f.read()
+    return json.loads(content.decode("utf-8")) if name.endswith(".json") else content
+
+
+class FakeAmcatConfig:
+    """
+    @param token: token that is accepted from the start. Tokens handed out by get_token are accepted too.
+    @param task_duration: seconds from starting a task until its result is ready
+    @param result_size: repeat the fixture rows until a result is about this many bytes (None: as is)
+    @param error_rate: fraction of requests answered with 500 Internal Server Error
+    @param failure_rate: fraction of tasks that end with status FAILURE
+    @param throttle_rate: fraction of requests answered with 429 Too Many Requests
+    @param retry_after: Retry-After (in seconds) of throttled requests
+    @param seed: seed for the random choices above, for reproducible runs
+    """
+
+    def __init__(self, *, token="fake-token", task_duration=1.0, result_size=None, error_rate=0.0,
+                 failure_rate=0.0, throttle_rate=0.0, retry_after=1, seed=None):
+        self.token = token
+        self.task_duration = task_duration
+        self.result_size = result_size
+        self.error_rate = error_rate
+        self.failure_rate = failure_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.seed = seed
+
+
+class FakeTask:
+    def __init__(self, script, parameters, duration, fails):
+        self.uuid = str(uuidlib.uuid4())
+        self.script = script
+        self.parameters = parameters
+        self.output_type = parameters.get("output_type", "application/json")
+        self.started = time.monotonic()
+        self.duration = duration
+        self.fails = fails
+
+    @property
+    def status(self):
+        elapsed = time.monotonic() - self.started
+        if elapsed >= self.duration:
+            return "FAILURE" if self.fails else "SUCCESS"
+        return "INPROGRESS" if elapsed >= self.duration / 10 else "PENDING"
+
+
+class FakeAmcatServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, config: FakeAmcatConfig=None, address=("127.0.0.1", 0)):
+        super().__init__(address, FakeAmcatHandler)
+        self.config = config or FakeAmcatConfig()
+        self.random = random.Random(self.config.seed)
+        self.tokens = {self.config.token}
+        self.tasks = {}
+        self.lock = threading.Lock()
+        self.requests = 0
+        self._thread = None
+
+        self.queries = load_fixture("queries.json")
+        self.articles = load_fixture("articles.json")
+        self.aggregation = load_fixture("aggregation.json")
+        self.summary = load_fixture("summary.html")
+        self.options = load_fixture("options.json")
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def start(self):
+        """Serve from a background thread. Returns self."""
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True, name="fake-amcat")
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def chance(self, rate):
+        with self.lock:
+            return rate > 0 and self.random.random() < rate
+
+    def start_task(self, script, parameters):
+        task = FakeTask(script, parameters, self.config.task_duration, self.chance(self.config.failure_rate))
+        with self.lock:
+            self.tasks[task.uuid] = task
+        return task
+
+    def get_result(self, task: FakeTask):
+        """Returns (content, content type) of a finished task."""
+        size = self.config.result_size
+        if "csv" in task.output_type:
+            return self._csv(size), "text/csv; charset=utf-8"
+        if task.script == "summary" or "html" in task.output_type:
+            return self._summary(size), "text/html; charset=utf-8"
+        rows = _repeat(self.aggregation, size, len(json.dumps(self.aggregation)))
+        return json.dumps(rows).encode("utf-8"), "application/json; charset=utf-8"
+
+    def _csv(self, size):
+        rows = [[day, label["label"], count] for day, values in self.aggregation for label, count in values]
+        rows = _repeat(rows, size, sum(len(",".join(map(str, row))) + 2 for row in rows))
+        out = io.StringIO()
+        writer = csv.writer(out)
+        writer.writerow(["date", "term", "count"])
+        writer.writerows(rows)
+        return out.getvalue().encode("utf-8")
+
+    def _summary(self, size):
+        if size is None:
+            return self.summary
+        head, items, tail = re.split(b'(?s)(<li.*</li>\\s*)', self.summary, maxsplit=1)
+        items = items * max(1, size // max(1, len(items)))
+        return head + items + tail
+
+
+def _repeat(rows, size, rows_size):
+    if size is None or not rows:
+        return rows
+    return rows * max(1, size // max(1, rows_size))
+
+
+class FakeAmcatHandler(BaseHTTPRequestHandler):
+    server_version = "FakeAmCAT/" + VERSION.split()[0]
+    protocol_version = "HTTP/1.1"
+
+    routes = [
+        ("POST", re.compile(r"^/api/v4/get_token/?$"), "get_token"),
+        ("OPTIONS", re.compile(r"^/api/v4/query/(?P<script>\w+)/?$"), "query_options"),
+        ("POST", re.compile(r"^/api/v4/query/(?P<script>\w+)/?$"), "start_task"),
+        ("GET", re.compile(r"^/api/v4/task/?$"), "task"),
+        ("GET", re.compile(r"^/api/v4/taskresult/(?P<uuid>[\w-]+)/?$"), "task_result"),
+        ("GET", re.compile(r"^/api/v4/projects/(?P<project>\d+)/?$"), "project"),
+        ("GET", re.compile(r"^/api/v4/projects/(?P<project>\d+)/querys/?$"), "queries"),
+        ("GET", re.compile(r"^/api/v4/projects/(?P<project>\d+)/querys/(?P<query>\d+)/?$"), "query"),
+        ("GET", re.compile(r"^/api/v4/search/?$"), "search"),
+    ]
+
+    def log_message(self, format, *args):
+        log.debug("%s " + format, self.address_string(), *args)
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_OPTIONS(self):
+        self.handle_request("OPTIONS")
+
+    def handle_request(self, method):
+        server, config = self.server, self.server.config
+        url = urlsplit(self.path)
+        self.params = parse_qs(url.query)
+
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length).decode("utf-8") if length else ""
+        self.data = parse_qs(body) if "form-urlencoded" in self.headers.get("Content-Type", "") else {}
+
+        # The dashboard sends GETs with many parameters as POST
+        override = self.headers.get("X-HTTP-METHOD-OVERRIDE")
+        if method == "POST" and override:
+            method = override.upper()
+            self.params.update(self.data)
+
+        with server.lock:
+            server.requests += 1
+
+        if server.chance(config.throttle_rate):
+            return self.respond({"detail": "Request was throttled."}, status=429,
+                                headers={"Retry-After": str(config.retry_after)})
+        if server.chance(config.error_rate):
+            return self.respond({"detail": "Internal server error (simulated)."}, status=500)
+
+        for route_method, pattern, name in self.routes:
+            match = pattern.match(url.path)
+            if match and route_method == method:
+                if name != "get_token" and self.get_token_header() not in server.tokens:
+                    return self.respond({"detail": "Invalid token."}, status=401)
+                return getattr(self, name)(**match.groupdict())
+        return self.respond({"detail": "Not found."}, status=404)
+
+    def get_token_header(self):
+        authorization = self.headers.get("Authorization", "")
+        return authorization[len("Token "):] if authorization.startswith("Token ") else None
+
+    def param(self, name, default=None):
+        values = self.params.get(name)
+        return values[0] if values else default
+
+    def respond(self, content, status=200, content_type="application/json", headers=None):
+        if not isinstance(content, bytes):
+            content = json.dumps(content).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(content)
+
+    def paginate(self, results):
+        page, page_size = int(self.param("page", 1)), int(self.param("page_size", 10))
+        start = (page - 1) * page_size
+        next_url = None
+        if start + page_size < len(results):
+            params = {name: values[0] for name, values in self.params.items()}
+            next_url = "{}{}?{}".format(self.server.url, urlsplit(self.path).path, urlencode(dict(params, page=page + 1)))
+        return {"results": results[start:start + page_size], "next": next_url, "total": len(results),
+                "page": page, "per_page": page_size, "pages": -(-len(results) // page_size)}
+
+    # Endpoints
+
+    def get_token(self):
+        token = self.get_token_header()
+        if token is None and not (self.data.get("username") and self.data.get("password")):
+            return self.respond({"detail": "Give a token or username and password."}, status=401)
+        if token is not None and token not in self.server.tokens:
+            return self.respond({"detail": "Invalid token."}, status=401)
+
+        new_token = uuidlib.uuid4().hex
+        with self.server.lock:
+            self.server.tokens.add(new_token)
+        return self.respond({"token": new_token, "version": VERSION})
+
+    def query_options(self, script):
+        return self.respond(self.server.options)
+
+    def start_task(self, script):
+        parameters = {name: values[0] for name, values in self.data.items()}
+        task = self.server.start_task(script, parameters)
+        return self.respond({"uuid": task.uuid, "task_id": task.uuid}, status=201)
+
+    def task(self):
+        task = self.server.tasks.get(self.param("uuid"))
+        if task is None:
+            return self.respond({"detail": "Not found."}, status=404)
+        return self.respond({"results": [{"uuid": task.uuid, "status": task.status, "ready": task.status in ("SUCCESS", "FAILURE"),
+                                          "class_name": task.script}]})
+
+    def task_result(self, uuid):
+        task = self.server.tasks.get(uuid)
+        if task is None or task.status != "SUCCESS":
+            return self.respond({"detail": "Not found."}, status=404)
+        content, content_type = self.server.get_result(task)
+        return self.respond(content, content_type=content_type)
+
+    def project(self, project):
+        return self.respond({"id": int(project), "name": "Fake project {}".format(project), "active": True})
+
+    def queries(self, project):
+        queries = [dict(query, parameters=json.dumps(query["parameters"]), project=int(project))
+                   for query in self.server.queries]
+        return self.respond(self.paginate(queries))
+
+    def query(self, project, query):
+        for saved in self.server.queries:
+            if saved["id"] == int(query):
+                return self.respond(dict(saved, parameters=json.dumps(saved["parameters"]), project=int(project)))
+        return self.respond({"detail": "Not found."}, status=404)
+
+    def search(self):
+        return self.respond(self.paginate(self.server.articles))
@@ -0,0 +1,68 @@
+"""
+Conditional HTTP requests (ETag / Last-Modified / 304) for cached query results.
+
+A result is served in several content codings, each with its own strong ETag: the version of
+the result plus a suffix for the coding. A client holding any of them has the current version,
+so a conditional request matching any of them is answered with 304 Not Modified.
+"""
+from django.http import HttpResponseNotModified
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.http import http_date, parse_http_date_safe
+
+# Content-Encoding -> ETag suffix
+ETAG_SUFFIXES = {None: "", "gzip": "-gzip", "br": "-br"}
+
+
+def quote_etag(etag):
+    return '"{}"'.format(etag)
+
+
+def _parse_etags(header):
+    for etag in header.split(","):
+        etag = etag.strip()
+        if etag.startswith("W/"):
+            etag = etag[2:]  # If-None-Match uses the weak comparison function
+        yield etag.strip('"')
+
+
+def set_validators(response, etag=None, last_modified=None, encoding=None):
+    """
+    Set ETag and Last-Modified on a response for the given version of a result. As versions do not
+    expire, browsers are told to revalidate before reuse.
+    """
+    if etag is not None:
+        response["ETag"] = quote_etag(etag + ETAG_SUFFIXES.get(encoding, ""))
+    if last_modified is not None:
+        response["Last-Modified"] = http_date(last_modified.timestamp())
+    patch_cache_control(response, private=True, no_cache=True)
+
+
+def not_modified(request, etag, last_modified=None):
+    """
+    Returns a 304 response if the client's copy is current according to If-None-Match or, in its
+    absence, If-Modified-Since. Returns None if the full response should be sent.
+    """
+    if request.method not in ("GET", "HEAD"):
+        return None
+
+    if_none_match = request.META.get("HTTP_IF_NONE_MATCH")
+    if if_none_match is not None:
+        variants = {etag + suffix: encoding for encoding, suffix in ETAG_SUFFIXES.items()}
+        for client_etag in _parse_etags(if_none_match):
+            if client_etag == "*" or client_etag in variants:
+                response = HttpResponseNotModified()
+                set_validators(response, etag, last_modified, variants.get(client_etag))
+                patch_vary_headers(response, ("Accept-Encoding",))
+                return response
+        return None
+
+    if_modified_since = parse_http_date_safe(request.META.get("HTTP_IF_MODIFIED_SINCE", ""))
+    if if_modified_since is None or last_modified is None:
+        return None
+    if int(last_modified.timestamp()) > if_modified_since:
+        return None
+
+    response = HttpResponseNotModified()
+    set_validators(response, etag, last_modified)
+    patch_vary_headers(response, ("Accept-Encoding",))
+    return response
@@ -0,0 +1,330 @@
+"""
+Limits on the load we put on each AmCAT host, shared by all worker processes through the database.
+
+* Task slots: at most DASHBOARD_API_MAX_TASKS tasks run on a host at the same time. A slot is a
+  Postgres advisory lock, so slots of crashed workers are released with their connection.
+* Request budget: a token bucket per host (DASHBOARD_API_RATE requests per second, bursts of up to
+  DASHBOARD_API_BURST), stored in the ApiRateBudget table.
+
+Work is either interactive (a viewer is waiting for it) or background (cron, warm-up, revalidation).
+Background work can't use the share of slots and budget reserved by DASHBOARD_API_INTERACTIVE_RESERVE,
+so tile loads don't queue behind a bulk refresh. Time spent waiting is counted in `stats`.
+
+Limits can be overridden per hostname with DASHBOARD_API_HOST_LIMITS, e.g.:
+
+    DASHBOARD_API_HOST_LIMITS = {"https://amcat.example.com": {"max_tasks": 2, "rate": 5}}
+"""
+import atexit
+import logging
+import os
+import threading
+import time
+import zlib
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connections
+
+log = logging.getLogger(__name__)
+
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+
+# Log waits longer than this many seconds
+SLOW_WAIT = 1
+
+# (hostname, priority, name) -> value. Names: slot_acquired, slot_wait_seconds, request_acquired,
+# request_wait_seconds and timeouts.
+stats = Counter()
+_stats_lock = threading.Lock()
+
+_local = threading.local()
+
+
+class QueueTimeout(TimeoutError):
+    pass
+
+
+def get_priority():
+    return getattr(_local, "priority", INTERACTIVE)
+
+
+@contextmanager
+def priority(value):
+    """Run the block with the given priority (INTERACTIVE or BACKGROUND) in this thread."""
+    previous = get_priority()
+    _local.priority = value
+    try:
+        yield
+    finally:
+        _local.priority = previous
+
+
+def get_limits(hostname):
+    limits = {
+        "max_tasks": getattr(settings, "DASHBOARD_API_MAX_TASKS", None),
+        "rate": getattr(settings, "DASHBOARD_API_RATE", None),
+        "burst": getattr(settings, "DASHBOARD_API_BURST", None),
+        "interactive_reserve": getattr(settings, "DASHBOARD_API_INTERACTIVE_RESERVE", 0),
+        "queue_timeout": getattr(settings, "DASHBOARD_API_QUEUE_TIMEOUT", 60),
+    }
+    limits.update(getattr(settings, "DASHBOARD_API_HOST_LIMITS", {}).get(hostname, {}))
+    if limits["burst"] is None and limits["rate"] is not None:
+        limits["burst"] = limits["rate"]
+    return limits
+
+
+def _count(hostname, **values):
+    with _stats_lock:
+        for name, value in values.items():
+            stats[hostname, get_priority(), name] += value
+
+
+def _record_wait(hostname, what, waited):
+    _count(hostname, **{what + "_acquired": 1, what + "_wait_seconds": waited})
+    if waited > SLOW_WAIT:
+        log.warning("Waited {:.1f}s for a {} on {} ({})".format(waited, what, hostname, get_priority()))
+
+
+# Connections of the limiter, outside of Django's (transactional) connection handling, so locks and
+# budget updates are independent of any transaction the caller is in. At most DASHBOARD_API_LIMITER_CONNECTIONS
+# are used at a time for a few statements, and kept open when idle, per process. A held task slot keeps its
+# connection (which holds the lock) until the slot is released, so those are bounded by the max_tasks per host.
+
+_pool = []  # idle connections, as (pid, connection)
+_pool_lock = threading.Lock()
+_in_use = (None, None)  # (pid, semaphore) bounding the connections in use for statements
+
+
+def _pool_size():
+    return getattr(settings, "DASHBOARD_API_LIMITER_CONNECTIONS", 4)
+
+
+def _semaphore():
+    global _in_use
+    with _pool_lock:
+        pid, semaphore = _in_use
+        # Permits taken by threads of a parent process are never given back in this one
+        if pid != os.getpid():
+            semaphore = threading.BoundedSemaphore(_pool_size())
+            _in_use = (os.getpid(), semaphore)
+        return semaphore
+
+
+def _take_connection():
+    import psycopg2
+
+    with _pool_lock:
+        while _pool:
+            pid, connection = _pool.pop()
+            # Connections inherited from a parent process are the parent's to use and close
+            if pid == os.getpid() and not connection.closed:
+                return connection
+    connection = psycopg2.connect(**connections["default"].get_connection_params())
+    connection.autocommit = True
+    return connection
+
+
+def _return_connection(connection):
+    if connection.closed:
+        return
+    with _pool_lock:
+        if len(_pool) < _pool_size():
+            _pool.append((os.getpid(), connection))
+            return
+    connection.close()
+
+
+@contextmanager
+def _connection():
+    import psycopg2
+
+    semaphore = _semaphore()
+    semaphore.acquire()
+    try:
+        connection = _take_connection()
+        try:
+            yield connection
+        except psycopg2.Error:
+            connection.close()
+            raise
+        finally:
+            _return_connection(connection)
+    finally:
+        semaphore.release()
+
+
+def close_connections():
+    """Close the idle connections of the limiter in this process, e.g. when it stops."""
+    with _pool_lock:
+        for pid, connection in _pool:
+            if pid == os.getpid():
+                connection.close()
+        _pool.clear()
+
+
+atexit.register(close_connections)
+
+
+def _host_key(hostname):
+    # Advisory locks are identified by two int4's: the host, and the slot number
+    return zlib.crc32(hostname.encode("utf-8")) - 2 ** 31
+
+
+def _backoff(deadline, wait, hostname, condition=None):
+    """Sleep for `wait` seconds, or until `condition` is notified, but raise QueueTimeout at the deadline."""
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        _count(hostname, timeouts=1)
+        raise QueueTimeout("Timed out waiting for AmCAT host {}".format(hostname))
+    if condition is None:
+        time.sleep(min(wait, remaining))
+    else:
+        with condition:
+            condition.wait(min(wait, remaining))
+
+
+# hostname -> Condition, notified when a thread of this process releases a slot on the host
+_slot_released = defaultdict(threading.Condition)
+_slot_released_lock = threading.Lock()
+
+
+def _get_slot_released(hostname):
+    with _slot_released_lock:
+        return _slot_released[hostname]
+
+
+def _try_slot(key, first_slot, max_tasks):
+    """Lock the first free slot from `first_slot` on. Returns (slot, connection holding the lock) or (None, None)."""
+    import psycopg2
+
+    with _semaphore():
+        connection = _take_connection()
+        try:
+            with connection.cursor() as cursor:
+                for candidate in range(first_slot, max_tasks):
+                    cursor.execute("SELECT pg_try_advisory_lock(%s, %s)", (key, candidate))
+                    if cursor.fetchone()[0]:
+                        return candidate, connection
+        except psycopg2.Error:
+            connection.close()
+            raise
+        _return_connection(connection)
+        return None, None
+
+
+@contextmanager
+def task_slot(hostname):
+    """Run the block (usually: start a task and wait for it) in one of the task slots for `hostname`."""
+    limits = get_limits(hostname)
+    max_tasks = limits["max_tasks"]
+    if not max_tasks:
+        yield
+        return
+
+    # Background work can't take the first slots
+    first_slot = 0
+    if get_priority() == BACKGROUND:
+        first_slot = min(int(max_tasks * limits["interactive_reserve"]), max_tasks - 1)
+
+    key = _host_key(hostname)
+    released = _get_slot_released(hostname)
+    start = time.monotonic()
+    deadline = start + limits["queue_timeout"]
+    wait = 0.05
+    # No connection is held while waiting. Slots released by this process wake us right away, those of
+    # other processes are noticed on the next try.
+    slot, connection = _try_slot(key, first_slot, max_tasks)
+    while slot is None:
+        _backoff(deadline, wait, hostname, released)
+        wait = min(wait * 2, 1)
+        slot, connection = _try_slot(key, first_slot, max_tasks)
+    _record_wait(hostname, "slot", time.monotonic() - start)
+
+    try:
+        yield
+    finally:
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_unlock(%s, %s)", (key, slot))
+        except Exception:
+            # Closing the connection releases the lock as well
+            connection.close()
+            raise
+        finally:
+            _return_connection(connection)
+            with released:
+                released.notify_all()
+
+
+_TAKE_TOKEN = """
+UPDATE dashboard_apiratebudget budget
+SET tokens = current.available - CASE WHEN current.available >= %(need)s THEN 1 ELSE 0 END,
+    updated = current.now
+FROM (
+    SELECT LEAST(%(burst)s, tokens + (EXTRACT(EPOCH FROM clock_timestamp()) - updated) * %(rate)s) AS available,
+           EXTRACT(EPOCH FROM clock_timestamp()) AS now
+    FROM dashboard_apiratebudget WHERE hostname = %(hostname)s FOR UPDATE
+) current
+WHERE budget.hostname = %(hostname)s
+RETURNING current.available
+"""
+
+_CREATE_BUDGET = """
+INSERT INTO dashboard_apiratebudget (hostname, tokens, updated)
+VALUES (%(hostname)s, %(burst)s, EXTRACT(EPOCH FROM clock_timestamp()))
+ON CONFLICT (hostname) DO NOTHING
+"""
+
+
+def try_request(hostname):
+    """
+    Take a request from the budget of `hostname` if possible. Returns 0 if it was taken, or else the
+    number of seconds until it can be.
+    """
+    limits = get_limits(hostname)
+    rate, burst = limits["rate"], limits["burst"]
+    if not rate:
+        return 0
+
+    need = 1
+    if get_priority() == BACKGROUND:
+        # The bucket never holds more than `burst`, so background work must be able to make do with that
+        need = min(burst, need + burst * limits["interactive_reserve"])
+
+    parameters = dict(hostname=hostname, rate=rate, burst=burst, need=need)
+    with _connection() as connection, connection.cursor() as cursor:
+        cursor.execute(_TAKE_TOKEN, parameters)
+        row = cursor.fetchone()
+        if row is None:
+            cursor.execute(_CREATE_BUDGET, parameters)
+            cursor.execute(_TAKE_TOKEN, parameters)
+            row = cursor.fetchone()
+
+    available = row[0]
+    return 0 if available >= need else (need - available) / rate
+
+
+@contextmanager
+def request_taken():
+    """Run the block without taking its requests from the budget, because the caller did (see try_request)."""
+    previous = getattr(_local, "request_taken", False)
+    _local.request_taken = True
+    try:
+        yield
+    finally:
+        _local.request_taken = previous
+
+
+def acquire_request(hostname):
+    """Wait until a request to `hostname` fits in its budget, and take it."""
+    if getattr(_local, "request_taken", False):
+        return
+    start = time.monotonic()
+    deadline = start + get_limits(hostname)["queue_timeout"]
+    wait = try_request(hostname)
+    while wait:
+        _backoff(deadline, wait, hostname)
+        wait = try_request(hostname)
+    _record_wait(hostname, "request", time.monotonic() - start)
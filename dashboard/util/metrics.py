@@ -0,0 +1,190 @@
+"""
+Counters and histograms in the Prometheus text format, aggregated over all worker processes.
+
+Each process counts in memory and adds its counts to a SQLite database shared by all processes on the
+host (DASHBOARD_METRICS_PATH) at most every FLUSH_INTERVAL seconds, and when it exits. Counts of
+processes that are gone are kept, so counters only go up, as Prometheus expects. Set
+DASHBOARD_METRICS_PATH to None to stop counting.
+
+    metrics.inc("dashboard_query_cache_requests_total", cache="saved", outcome="hit")
+    metrics.observe("dashboard_amcat_request_seconds", 0.12, endpoint="task", method="GET")
+
+All metrics are declared in METRICS. Values that can be read at any time (such as cache sizes) are
+passed to render() as gauges instead of being counted.
+"""
+import atexit
+import logging
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+
+log = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = 10
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+COUNT_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 34, 55)
+LAG_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600)
+
+# name -> (type, help, buckets)
+METRICS = {
+    "dashboard_amcat_requests_total": (
+        "counter", "Requests to AmCAT, by endpoint, method and status code (or 'error').", None),
+    "dashboard_amcat_request_seconds": (
+        "histogram", "Duration of requests to AmCAT, by endpoint and method.", LATENCY_BUCKETS),
+    "dashboard_amcat_task_polls": (
+        "histogram", "Status checks of AmCAT tasks until they finished.", COUNT_BUCKETS),
+    "dashboard_query_cache_requests_total": (
+        "counter", "Requests for query results, by cache ('saved' or 'filtered') and outcome.", None),
+    "dashboard_refresh_lag_seconds": (
+        "histogram", "Time from the scheduled slot of a query until its refresh completed.", LAG_BUCKETS),
+    "dashboard_refresh_catch_ups_total": (
+        "counter", "Scheduled refreshes that were missed, and run late by a later cron trigger.", None),
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (
+    name TEXT NOT NULL,
+    labels TEXT NOT NULL,
+    value REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (name, labels)
+);
+"""
+
+
+def _format_labels(labels):
+    """Labels as in the exposition format, e.g. '{a="1",b="x"}'. Labels are sorted, so this is also a key."""
+    if not labels:
+        return ""
+    escaped = ((name, str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+               for name, value in sorted(labels.items()))
+    return "{" + ",".join('{}="{}"'.format(name, value) for name, value in escaped) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(int(value)) if float(value).is_integer() else repr(value)
+
+
+class Registry:
+    def __init__(self):
+        self._counts = defaultdict(float)  # (sample name, formatted labels) -> count since last flush
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        self._local = threading.local()
+        atexit.register(self.flush)
+
+    @property
+    def path(self):
+        return getattr(settings, "DASHBOARD_METRICS_PATH", None)
+
+    def inc(self, name, value=1, **labels):
+        assert METRICS[name][0] == "counter", name
+        self._add([(name, _format_labels(labels), value)])
+
+    def observe(self, name, value, **labels):
+        type, _, buckets = METRICS[name]
+        assert type == "histogram", name
+        samples = [(name + "_bucket", _format_labels(dict(labels, le=_format_value(bound))), 1)
+                   for bound in buckets + (math.inf,) if value <= bound]
+        key = _format_labels(labels)
+        samples += [(name + "_sum", key, value), (name + "_count", key, 1)]
+        self._add(samples)
+
+    def _add(self, samples):
+        if self.path is None:
+            return
+        with self._lock:
+            for name, labels, value in samples:
+                self._counts[name, labels] += value
+            due = time.monotonic() - self._last_flush > FLUSH_INTERVAL
+        if due:
+            self.flush()
+
+    def flush(self):
+        """Add the counts of this process to the shared database."""
+        if self.path is None:
+            return
+        with self._lock:
+            counts, self._counts = self._counts, defaultdict(float)
+            self._last_flush = time.monotonic()
+        if not counts:
+            return
+
+        try:
+            db = self._db()
+            with db:
+                for (name, labels), value in counts.items():
+                    db.execute("INSERT OR IGNORE INTO samples (name, labels) VALUES (?, ?)", (name, labels))
+                    db.execute("UPDATE samples SET value = value + ? WHERE name = ? AND labels = ?",
+                               (value, name, labels))
+        except sqlite3.Error:
+            log.exception("Could not store metrics")
+            # Try again next time
+            with self._lock:
+                for key, value in counts.items():
+                    self._counts[key] += value
+
+    def collect(self):
+        """Returns {(sample name, formatted labels): value} over all processes."""
+        if self.path is None:
+            return {}
+        self.flush()
+        return {(name, labels): value for name, labels, value
+                in self._db().execute("SELECT name, labels, value FROM samples")}
+
+    def render(self, gauges=()):
+        """
+        Returns all metrics in the Prometheus text exposition format.
+
+        @param gauges: (name, help, {labels tuple: value}) for values measured at this time
+        """
+        samples = defaultdict(list)
+        for (sample, labels), value in sorted(self.collect().items()):
+            name = re.sub("_(bucket|sum|count)$", "", sample) if sample not in METRICS else sample
+            samples[name].append((sample, labels, value))
+
+        lines = []
+        for name, (type, help, _) in sorted(METRICS.items()):
+            lines += ["# HELP {} {}".format(name, help), "# TYPE {} {}".format(name, type)]
+            lines += ["{}{} {}".format(*sample[:2], _format_value(sample[2])) for sample in samples[name]]
+        for name, help, values in gauges:
+            lines += ["# HELP {} {}".format(name, help), "# TYPE {} gauge".format(name)]
+            lines += ["{}{} {}".format(name, _format_labels(dict(labels)), _format_value(value))
+                      for labels, value in sorted(values.items())]
+        return "\n".join(lines) + "\n"
+
+    def _db(self):
+        # SQLite connections must not be shared between threads, nor survive a fork
+        path = self.path
+        pid, db_path, db = getattr(self._local, "db", (None, None, None))
+        if pid != os.getpid() or db_path != path:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            db = sqlite3.connect(path, timeout=30)
+            db.execute("PRAGMA journal_mode = WAL")
+            db.execute("PRAGMA synchronous = NORMAL")
+            db.executescript(SCHEMA)
+            self._local.db = (os.getpid(), path, db)
+        return db
+
+
+registry = Registry()
+inc = registry.inc
+observe = registry.observe
+
+
+def endpoint_name(url):
+    """
+    The AmCAT endpoint of a URL, without its host and variable parts, e.g. 'query/aggregation',
+    'taskresult/:uuid' or 'projects/:id/querys/'.
+    """
+    path = url.split("?", 1)[0].split("/api/v4/", 1)[-1]
+    path = re.sub(r"(?<=/)[0-9a-f]{8}-[0-9a-f-]{27}(?=/|$)", ":uuid", path)
+    return re.sub(r"(?<=/)\d+(?=/|$)", ":id", path)
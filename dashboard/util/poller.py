@@ -0,0 +1,243 @@
+"""
+A single thread per process that keeps track of all AmCAT tasks we are waiting for.
+
+Instead of every waiter polling AmCAT by itself, waiters watch a task through the poller, which
+checks each outstanding task on its own backoff schedule and notifies its subscribers when it is
+done. AmCAT traffic thus scales with the number of distinct tasks, not with the number of waiters.
+The due tasks of each host are checked on a thread of their own, so a slow host doesn't delay the others.
+"""
+import json
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+from dashboard.util import limiter, metrics
+from dashboard.util.api import STATUS, TASK_URL, Backoff, CircuitOpen, PollCancelled, get_session
+
+log = logging.getLogger(__name__)
+
+# Stop checking tasks nobody asked about (e.g., a closed download dialog) for this many seconds
+ABANDON_AFTER = 60
+
+# Keep the final status of a task for this many seconds, for repeated questions about it
+KEEP_FINISHED = 60
+
+# Give up on a task after this many consecutive failed checks
+MAX_ERRORS = 3
+
+# Seconds to wait for a response to a status check, which AmCAT should answer right away
+CHECK_TIMEOUT = 10
+
+
+class TaskWatch:
+    """An AmCAT task as tracked by the poller."""
+
+    def __init__(self, system: 'System', uuid: str):
+        self.system = system
+        self.uuid = uuid
+
+        # Last response of AmCAT's task endpoint, and the status therein
+        self.task = None
+        self.status = None
+        self.error = None
+
+        self.checked = threading.Event()
+        self.done = threading.Event()
+
+        self.backoff = Backoff()
+        self.next_check = time.monotonic()
+        self.last_interest = time.monotonic()
+        self.waiters = 0
+        self.errors = 0
+        self.checks = 0
+        self._callbacks = []
+
+    def subscribe(self, callback):
+        """Call callback(task_watch) once the task is done (or right away, if it already is)."""
+        with poller.lock:
+            if not self.done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def wait(self, timeout=None, cancel: threading.Event=None):
+        """
+        Block until the task is done. Raises the error of the task if it failed, TimeoutError if it doesn't
+        finish within `timeout` seconds (default: DASHBOARD_POLL_TIMEOUT), or PollCancelled when `cancel` is set.
+        """
+        if timeout is None:
+            timeout = getattr(settings, "DASHBOARD_POLL_TIMEOUT", 600)
+        deadline = time.monotonic() + timeout
+
+        with poller.lock:
+            self.waiters += 1
+        try:
+            while not self.done.is_set():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError("Task {!r} did not finish within {} seconds.".format(self.uuid, timeout))
+                if cancel is not None and cancel.is_set():
+                    raise PollCancelled("Stopped waiting for task {!r}.".format(self.uuid))
+                # Wake up now and then to look at `cancel`
+                self.done.wait(min(remaining, 1) if cancel is not None else remaining)
+        finally:
+            with poller.lock:
+                self.waiters -= 1
+                self.last_interest = time.monotonic()
+
+        if self.error is not None:
+            raise self.error
+        return self.status
+
+    def _finish(self, error=None):
+        with poller.lock:
+            self.error = error
+            self.checked.set()
+            self.done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        if error is None:
+            metrics.observe("dashboard_amcat_task_polls", self.checks)
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                log.exception("Callback for task {} failed".format(self.uuid))
+
+
+class Poller:
+    def __init__(self):
+        self.lock = threading.Condition()
+        self._tasks = {}  # (system id, uuid) -> TaskWatch
+        self._checking = set()  # hostnames whose tasks are being checked
+        self._thread = None
+        self._stopped = False
+
+    def watch(self, system: 'System', uuid: str) -> TaskWatch:
+        """Start tracking a task, or return the existing watch on it."""
+        with self.lock:
+            key = (system.id, uuid)
+            task = self._tasks.get(key)
+            if task is None:
+                task = self._tasks[key] = TaskWatch(system, uuid)
+                self.lock.notify()
+            task.last_interest = time.monotonic()
+
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True, name="dashboard-poller")
+                self._thread.start()
+            return task
+
+    def stop(self):
+        """Stop checking tasks and end the polling thread, e.g. at the end of a test."""
+        with self.lock:
+            self._stopped = True
+            self.lock.notify()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __len__(self):
+        with self.lock:
+            return sum(1 for task in self._tasks.values() if not task.done.is_set())
+
+    def _run(self):
+        while True:
+            with self.lock:
+                due = self._wait_for_due()
+                if self._stopped:
+                    return
+                by_host = {}
+                for task in due:
+                    by_host.setdefault(task.system.hostname, []).append(task)
+                self._checking.update(by_host)
+
+            # A slow host only holds up the checks of its own tasks
+            for hostname, tasks in by_host.items():
+                threading.Thread(target=self._check_host, args=(hostname, tasks), daemon=True,
+                                 name="dashboard-poller-check").start()
+
+    def _check_host(self, hostname, tasks):
+        try:
+            for task in tasks:
+                try:
+                    self._check(task)
+                except Exception:
+                    log.exception("Checking task {} failed".format(task.uuid))
+        finally:
+            with self.lock:
+                self._checking.discard(hostname)
+                self.lock.notify()
+
+    def _wait_for_due(self):
+        """Waits until at least one task should be checked, and returns those tasks. Call with lock held."""
+        while not self._stopped:
+            now = time.monotonic()
+            for key, task in list(self._tasks.items()):
+                if task.done.is_set():
+                    if now - task.last_interest > KEEP_FINISHED:
+                        del self._tasks[key]
+                elif not task.waiters and now - task.last_interest > ABANDON_AFTER:
+                    log.info("Nobody is waiting for task {} anymore".format(task.uuid))
+                    del self._tasks[key]
+
+            # Tasks of hosts that are being checked are due once that is done
+            pending = [task for task in self._tasks.values()
+                       if not task.done.is_set() and task.system.hostname not in self._checking]
+            due = [task for task in pending if task.next_check <= now]
+            if due:
+                return due
+
+            next_check = min((task.next_check for task in pending), default=None)
+            self.lock.wait(None if next_check is None else next_check - now)
+
+    def _check(self, task: TaskWatch):
+        session = get_session(task.system)
+        try:
+            # Waiting for the request budget here would hold up the checks of all other tasks
+            wait = limiter.try_request(task.system.hostname)
+            if wait:
+                with self.lock:
+                    task.next_check = time.monotonic() + wait
+                return
+            task.checks += 1
+            with limiter.request_taken():
+                response = session.get(TASK_URL.format(uuid=task.uuid, host=task.system.hostname),
+                                       timeout=CHECK_TIMEOUT)
+            if response.status_code in (503, 429):  # rate limited
+                self._schedule(task, response)
+                return
+            response.raise_for_status()
+            result = json.loads(response.content.decode("utf-8"))
+            status = result["results"][0]["status"]
+        except CircuitOpen as e:
+            # Let waiters fall back to what they have, rather than wait for the host to come back
+            task._finish(error=e)
+            return
+        except Exception as e:
+            task.errors += 1
+            if task.errors >= MAX_ERRORS:
+                task._finish(error=e)
+            else:
+                self._schedule(task)
+            return
+
+        task.errors = 0
+        task.task, task.status = result, status
+        task.checked.set()
+
+        if status == STATUS.SUCCESS:
+            task._finish()
+        elif status == STATUS.FAILED:
+            task._finish(error=ValueError("Task {!r} failed.".format(task.uuid)))
+        elif status in (STATUS.INPROGRESS, STATUS.PENDING):
+            self._schedule(task)
+        else:
+            task._finish(error=ValueError("Unknown status value {!r} returned.".format(status)))
+
+    def _schedule(self, task: TaskWatch, response=None):
+        with self.lock:
+            task.next_check = time.monotonic() + task.backoff.next(response)
+
+
+poller = Poller()
@@ -0,0 +1,114 @@
+"""
+Where the time of a request goes, for ProfilingMiddleware (enabled with DASHBOARD_PROFILING).
+
+Code that does something worth knowing about records it on the profile of the current thread:
+
+    with profiling.timed("cache"):
+        result = caches["query"].get(key)
+    profiling.count("cache_hit")
+
+Outside of a profiled request these are no-ops. The middleware adds SQL queries (from Django's
+debug cursor) and reports the totals in a Server-Timing header, which browsers show with the
+request in their developer tools. A sample of requests (DASHBOARD_PROFILING_SAMPLE_RATE), and all
+requests slower than DASHBOARD_PROFILING_SLOW seconds, are written to a rotating log as JSON lines.
+"""
+import json
+import logging
+import logging.handlers
+import os
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from django.conf import settings
+
+_local = threading.local()
+
+
+class Profile:
+    def __init__(self):
+        self.start = time.monotonic()
+        self.durations = Counter()  # category -> seconds
+        self.counts = Counter()  # category -> number of times
+
+    def add(self, category, seconds=0.0, count=1):
+        self.durations[category] += seconds
+        self.counts[category] += count
+
+    def server_timing(self, total):
+        """The Server-Timing header value for this profile."""
+        metrics = []
+        for category in sorted(self.counts):
+            metric = "{};dur={:.1f}".format(category, self.durations[category] * 1000)
+            if category in ("db", "amcat"):
+                metric += ';desc="{} {}"'.format(self.counts[category], "queries" if category == "db" else "calls")
+            metrics.append(metric)
+        metrics.append("total;dur={:.1f}".format(total * 1000))
+        return ", ".join(metrics)
+
+
+def get_profile():
+    return getattr(_local, "profile", None)
+
+
+@contextmanager
+def profile():
+    """Profile the block in this thread. Yields the Profile."""
+    previous = get_profile()
+    _local.profile = Profile()
+    try:
+        yield _local.profile
+    finally:
+        _local.profile = previous
+
+
+def add(category, seconds=0.0, count=1):
+    profile = get_profile()
+    if profile is not None:
+        profile.add(category, seconds, count)
+
+
+def count(category):
+    add(category)
+
+
+@contextmanager
+def timed(category):
+    """Add the duration of the block to `category`."""
+    if get_profile() is None:
+        yield
+        return
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        add(category, time.monotonic() - start)
+
+
+_log = None
+_log_lock = threading.Lock()
+
+
+def get_log():
+    """The logger of profiles, which writes to DASHBOARD_PROFILING_LOG (rotated at DASHBOARD_PROFILING_LOG_SIZE)."""
+    global _log
+    with _log_lock:
+        if _log is None:
+            os.makedirs(os.path.dirname(settings.DASHBOARD_PROFILING_LOG), exist_ok=True)
+            handler = logging.handlers.RotatingFileHandler(
+                settings.DASHBOARD_PROFILING_LOG, delay=True,
+                maxBytes=getattr(settings, "DASHBOARD_PROFILING_LOG_SIZE", 10 * 1024 ** 2),
+                backupCount=getattr(settings, "DASHBOARD_PROFILING_LOG_BACKUPS", 5))
+            _log = logging.getLogger(__name__)
+            _log.addHandler(handler)
+            _log.setLevel(logging.INFO)
+            _log.propagate = False
+        return _log
+
+
+def log_profile(profile: Profile, **fields):
+    record = dict(fields)
+    for category in sorted(profile.counts):
+        record[category] = {"n": profile.counts[category], "ms": round(profile.durations[category] * 1000, 1)}
+    get_log().info(json.dumps(record, sort_keys=True))
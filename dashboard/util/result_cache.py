@@ -0,0 +1,107 @@
+"""
+Read-through cache for saved query results.
+
+Serving a tile from QueryCache costs a get_or_create, a fetch of the (possibly
+multi-megabyte) cache blob and a recomputation of the cache tag. This module
+puts two tiers in front of that:
+
+ * a bounded in-process LRU, keyed by result version, and
+ * a shared tier (the Django cache configured by DASHBOARD_RESULT_CACHE_ALIAS),
+   which holds a small pointer (query, page) -> (version, timestamp) and the results themselves.
+
+A version is the cache tag combined with the cache timestamp, as a refresh with unchanged
+parameters yields the same tag. Like QueryResults, versions are shared between pages. A pointer is only written after the result has been
+validated against QueryCache, and is removed whenever that QueryCache is refreshed or
+cleared, or the filters of its page or system change. As the LRU is keyed by version, other processes never serve an outdated result.
+"""
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.cache import caches
+
+from dashboard.util.lru import LRUCache
+
+CachedResult = namedtuple("CachedResult", ("tag", "content", "mimetype", "timestamp"))
+
+POINTER_KEY = "dashboard:result:{query_id}:{page_id}"
+RESULT_KEY = "dashboard:result:{version}"
+
+
+def _sizeof_result(result: CachedResult):
+    return len(result.content.gzip or b"") + len(result.content.brotli or b"")
+
+
+_local = LRUCache(getattr(settings, "DASHBOARD_RESULT_CACHE_MAX_BYTES", 64 * 1024 ** 2), sizeof=_sizeof_result)
+
+
+def _shared():
+    return caches[getattr(settings, "DASHBOARD_RESULT_CACHE_ALIAS", "results")]
+
+
+def _timeout():
+    return getattr(settings, "DASHBOARD_RESULT_CACHE_TIMEOUT", 300)
+
+
+def get_version(tag, timestamp):
+    """Identifies a result: refreshing with unchanged parameters changes the timestamp, but not the tag."""
+    return "{}-{}".format(tag, int(timestamp.timestamp() * 1000000))
+
+
+def peek(query_id, page_id):
+    """
+    Returns (version, timestamp) of the last validated result for (query, page), without loading it,
+    or None if we need to consult QueryCache.
+    """
+    return _shared().get(POINTER_KEY.format(query_id=query_id, page_id=page_id))
+
+
+def get(version):
+    """Returns the CachedResult with the given version, or None if it is not cached."""
+    result = _local.get(version)
+    if result is not None:
+        return result
+
+    result = _shared().get(RESULT_KEY.format(version=version))
+    if result is None or get_version(result.tag, result.timestamp) != version:
+        return None
+
+    _local.set(version, result)
+    return result
+
+
+def put(query_cache):
+    """Store the (validated) result of a QueryCache in both tiers."""
+    if not query_cache.cache_tag:
+        return
+
+    result = CachedResult(
+        tag=query_cache.cache_tag,
+        content=query_cache.content,
+        mimetype=query_cache.cache_mimetype,
+        timestamp=query_cache.cache_timestamp
+    )
+    version = get_version(result.tag, result.timestamp)
+    _shared().set(RESULT_KEY.format(version=version), result, _timeout())
+    _local.set(version, result)
+    put_pointer(query_cache)
+
+
+def put_pointer(query_cache):
+    """Store only the version of a (validated) QueryCache, which suffices to answer conditional requests."""
+    if not query_cache.cache_tag:
+        return
+
+    version = get_version(query_cache.cache_tag, query_cache.cache_timestamp)
+    pointer = (version, query_cache.cache_timestamp)
+    _shared().set(POINTER_KEY.format(query_id=query_cache.query_id, page_id=query_cache.page_id), pointer, _timeout())
+
+
+def invalidate(query_id, page_id):
+    _shared().delete(POINTER_KEY.format(query_id=query_id, page_id=page_id))
+
+
+def invalidate_many(query_caches):
+    """Invalidate the entries of the given QueryCache queryset."""
+    keys = [POINTER_KEY.format(query_id=query_id, page_id=page_id)
+            for query_id, page_id in query_caches.values_list("query_id", "page_id")]
+    _shared().delete_many(keys)
@@ -0,0 +1,114 @@
+import json
+from unittest import mock
+
+import requests
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from dashboard.models import System
+from dashboard.util import api
+
+
+@override_settings(DASHBOARD_API_MAX_TASKS=None, DASHBOARD_API_RATE=None)
+class TestApiSession(TestCase):
+    def setUp(self):
+        self.system = System.objects.create(hostname="http://amcat.test", project_id=1, project_name="test",
+                                            amcat_token="old")
+
+    def test_get_session(self):
+        session = api.get_session(self.system)
+        self.assertIs(api.get_session(System.objects.get(pk=self.system.pk)), session)
+
+        self.system.amcat_token = "new"
+        self.assertIsNot(api.get_session(self.system), session)
+
+    @mock.patch("dashboard.util.api.AmcatAPI")
+    @mock.patch.object(requests.Session, "request")
+    def test_renew_on_401(self, request, amcat_api):
+        amcat_api.return_value.token = "renewed"
+        request.side_effect = lambda *args, **kwargs: mock.Mock(status_code=200 if session.token == "renewed" else 401)
+
+        session = api.ApiSession(system=self.system)
+        self.assertEqual(session.get("http://amcat.test/api/v4/").status_code, 200)
+        self.assertEqual(session.get("http://amcat.test/api/v4/").status_code, 200)
+
+        self.assertEqual(request.call_count, 3)
+        # The rejected token can't get a new one: log in with the configured credentials, and save the token
+        amcat_api.assert_called_once_with(host="http://amcat.test")
+        self.assertEqual(session.headers["AUTHORIZATION"], "Token renewed")
+        self.assertEqual(System.objects.get().amcat_token, "renewed")
+
+    @mock.patch("dashboard.util.api.AmcatAPI")
+    def test_renew_replaced_token(self, amcat_api):
+        # Someone set a new token in the settings, which this process didn't know about yet
+        System.objects.update(amcat_token="new")
+        self.assertEqual(api.renew_token(self.system, "old"), "new")
+        self.assertFalse(amcat_api.called)
+
+    @mock.patch("dashboard.util.api.AmcatAPI", side_effect=Exception("No authentication info"))
+    def test_renew_failed(self, amcat_api):
+        self.assertIsNone(api.renew_token(self.system, "old"))
+        self.assertEqual(System.objects.get().amcat_token, "old")
+
+
+def task_response(status_code=200, status=None, headers=None):
+    content = json.dumps({"results": [{"status": status}]}).encode("utf-8")
+    response = requests.Response()
+    response.status_code, response._content = status_code, content
+    response.headers.update(headers or {})
+    return response
+
+
+class TestBackoff(SimpleTestCase):
+    def test_backoff(self):
+        backoff = api.Backoff(delay=1, max_delay=8)
+        for delay in [1, 2, 4, 8, 8, 8]:
+            wait = backoff.next()
+            self.assertTrue(delay / 2 <= wait <= delay)
+
+    def test_retry_after(self):
+        backoff = api.Backoff(delay=1, max_delay=8)
+        self.assertEqual(backoff.next(task_response(503, headers={"Retry-After": "7"})), 7)
+        # Waiting as asked doesn't count as backing off
+        self.assertTrue(0.5 <= backoff.next(task_response(503)) <= 1)
+        self.assertTrue(1 <= backoff.next() <= 2)
+
+
+@override_settings(DASHBOARD_API_MAX_TASKS=None, DASHBOARD_API_RATE=None, DASHBOARD_BREAKER_FAILURES=3,
+                   DASHBOARD_BREAKER_SLOW_REQUEST=10, DASHBOARD_BREAKER_RESET=30)
+class TestCircuitBreaker(TestCase):
+    def setUp(self):
+        self.session = api.ApiSession(system=System(id=1, hostname="http://amcat.test", amcat_token="token"))
+        self.session.breaker = api.CircuitBreaker("http://amcat.test")
+
+    @mock.patch.object(requests.Session, "request")
+    def test_open_and_probe(self, request):
+        request.side_effect = requests.ConnectionError()
+        for _ in range(3):
+            with self.assertRaises(requests.ConnectionError):
+                self.session.get("http://amcat.test/api/v4/")
+        self.assertTrue(self.session.breaker.is_open())
+
+        # Requests aren't sent while open
+        with self.assertRaises(api.CircuitOpen):
+            self.session.get("http://amcat.test/api/v4/")
+        self.assertEqual(request.call_count, 3)
+
+        # After a while, a failing probe keeps it open...
+        self.session.breaker.opened_at -= 30
+        with self.assertRaises(requests.ConnectionError):
+            self.session.get("http://amcat.test/api/v4/")
+        self.assertTrue(self.session.breaker.is_open())
+
+        # ...and a succeeding one closes it
+        self.session.breaker.opened_at -= 30
+        request.side_effect = None
+        request.return_value = mock.Mock(status_code=200)
+        self.session.get("http://amcat.test/api/v4/")
+        self.assertEqual(self.session.breaker.state, api.CircuitBreaker.CLOSED)
+
+    def test_failures(self):
+        breaker = self.session.breaker
+        for success, duration in [(False, 0), (True, 0), (False, 0), (False, 0), (True, 11)]:
+            self.assertFalse(breaker.is_open())
+            breaker.record(success, duration)
+        self.assertTrue(breaker.is_open())
@@ -0,0 +1,130 @@
+import asyncio
+import datetime
+import json
+import unittest
+from unittest import mock
+
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from dashboard.models import System, Page, Query, QueryCache, QueryResult
+from dashboard.util import async_api, limiter
+from dashboard.util.compression import compress, decompress
+
+try:
+    from aiohttp import web
+    from aiohttp.test_utils import TestServer
+except ImportError:
+    web = None
+
+
+@unittest.skipIf(web is None, "aiohttp not installed")
+@override_settings(DASHBOARD_API_MAX_TASKS=None, DASHBOARD_API_RATE=None)
+class TestAsyncApiSession(SimpleTestCase):
+    def setUp(self):
+        self.polls = {}
+        self.running = self.max_running = 0
+
+    async def start(self, request):
+        data = await request.post()
+        uuid = "task-{}".format(data["n"])
+        self.polls[uuid] = 0
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        return web.json_response({"uuid": uuid}, status=201)
+
+    async def task(self, request):
+        uuid = request.query["uuid"]
+        if request.headers["AUTHORIZATION"] != "Token renewed":
+            return web.Response(status=401)
+        self.polls[uuid] += 1
+        status = "SUCCESS" if self.polls[uuid] == 3 else "INPROGRESS"
+        if status == "SUCCESS":
+            self.running -= 1
+        return web.json_response({"results": [{"status": status}]})
+
+    async def result(self, request):
+        return web.json_response({"uuid": request.match_info["uuid"]})
+
+    def fetch_results(self, concurrency, threads=None):
+        app = web.Application()
+        app.router.add_post("/api/v4/query/aggregation", self.start)
+        app.router.add_get("/api/v4/task", self.task)
+        app.router.add_get("/api/v4/taskresult/{uuid}", self.result)
+
+        async def run():
+            async with TestServer(app, access_log=None) as server:
+                host = str(server.make_url("")).rstrip("/")
+                system = System(id=1, hostname=host, amcat_token="expired")
+                tasks = {n: (host + "/api/v4/query/aggregation", {"n": n}) for n in range(20)}
+                async with async_api.AsyncApiSession(system=system, threads=threads) as session:
+                    return await async_api.fetch_results(session, tasks, concurrency=concurrency)
+
+        loop = asyncio.new_event_loop()
+        with self.settings(DASHBOARD_POLL_TIMEOUT=30), \
+                mock.patch("dashboard.util.async_api.renew_token", return_value="renewed") as renew_token:
+            results = loop.run_until_complete(run())
+        renew_token.assert_called_once_with(mock.ANY, "expired")
+        loop.close()
+        return results
+
+    def test_fetch_results(self):
+        results = self.fetch_results(concurrency=5)
+
+        for n in range(20):
+            uuid, content, content_type = results[n]
+            self.assertEqual(json.loads(decompress(content).decode("utf-8")), {"uuid": uuid})
+            self.assertEqual(content_type, "application/json; charset=utf-8")
+        self.assertEqual(self.max_running, 5)
+
+    def test_task_slots(self):
+        # Tasks waiting for a slot don't take the threads that tasks in a slot need for their requests
+        self.addCleanup(limiter.close_connections)
+        with self.settings(DASHBOARD_API_MAX_TASKS=2, DASHBOARD_API_RATE=100, DASHBOARD_API_QUEUE_TIMEOUT=10):
+            results = self.fetch_results(concurrency=20, threads=20)
+        self.assertFalse([result for result in results.values() if isinstance(result, Exception)])
+        self.assertEqual(self.max_running, 2)
+
+
+PARAMETERS = json.dumps({"script": "aggregation", "articlesets": [1], "output_type": "application/json"})
+
+
+@unittest.skipIf(web is None, "aiohttp not installed")
+@override_settings(DASHBOARD_API_MAX_TASKS=None, DASHBOARD_API_RATE=None)
+class TestRefreshCaches(TestCase):
+    def setUp(self):
+        system = System.objects.create(hostname="http://amcat.test", project_id=1, project_name="test")
+        page = Page.objects.create(system=system, name="page", ordernr=0)
+        self.caches = {}
+        for name in ("new", "refreshed", "busy", "failing"):
+            query = Query.objects.create(system=system, amcat_query_id=len(self.caches), amcat_name=name,
+                                         amcat_parameters=PARAMETERS.replace("[1]", str([len(self.caches)])),
+                                         amcat_archived=False)
+            self.caches[name] = QueryCache.objects.create(query=query, page=page)
+        self.tags = {name: query_cache.get_query_tag() for name, query_cache in self.caches.items()}
+
+    @mock.patch("dashboard.models.query.refresh_caches")
+    @mock.patch.object(async_api, "fetch_results")
+    def test_refresh_caches(self, fetch_results, refresh_caches):
+        requested = timezone.now() - datetime.timedelta(minutes=1)
+        QueryResult.store(self.tags["refreshed"], "uuid", "[0]", "application/json")
+        QueryResult.objects.create(tag=self.tags["busy"], refreshing_since=timezone.now())
+
+        async def fetch(session, tasks, concurrency=None):
+            return {tag: ValueError("AmCAT is down") if tag == self.tags["failing"] else
+                         ("uuid", compress("[1]"), "application/json") for tag in tasks}
+        fetch_results.side_effect = fetch
+
+        errors = async_api.refresh_caches(self.caches.values(), requested=requested)
+
+        # Only the results that nobody refreshed are fetched, and others wait for the one that is being refreshed
+        self.assertEqual(set(fetch_results.call_args[0][1]), {self.tags["new"], self.tags["failing"]})
+        self.assertEqual(set(errors), {self.tags["failing"]})
+        self.assertEqual([c.query.amcat_name for c in refresh_caches.call_args[0][0]], ["busy"])
+        self.assertEqual(refresh_caches.call_args[1], {"requested": requested})
+
+        self.assertEqual(QueryCache.objects.get(pk=self.caches["new"].pk).cache, "[1]")
+        self.assertEqual(QueryCache.objects.get(pk=self.caches["refreshed"].pk).cache, "[0]")
+        # Failed refreshes are released, so another refresh can claim them
+        failing = QueryResult.objects.get(tag=self.tags["failing"])
+        self.assertFalse(failing.is_complete or failing.is_refreshing())
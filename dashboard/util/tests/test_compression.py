@@ -0,0 +1,22 @@
+import gzip
+
+from django.test import SimpleTestCase
+
+from dashboard.util import compression
+from dashboard.util.compression import compress, compress_chunks, decompress
+
+
+class TestCompression(SimpleTestCase):
+    def test_compress_chunks(self):
+        content = "".join("{},{}\n".format(i, i * i) for i in range(100000)).encode("utf-8")
+        chunks = [content[i:i + 4096] for i in range(0, len(content), 4096)]
+
+        compressed = compress_chunks(iter(chunks))
+        self.assertEqual(compressed.length, len(content))
+        self.assertEqual(gzip.decompress(compressed.gzip), content)
+        self.assertEqual(decompress(compressed), content)
+        if compression.brotli is not None:
+            self.assertEqual(compression.brotli.decompress(compressed.brotli), content)
+
+        self.assertEqual(decompress(compress_chunks([])), b"")
+        self.assertEqual(decompress(compress(content)), content)
@@ -0,0 +1,41 @@
+import datetime
+
+from django.test import SimpleTestCase
+
+from dashboard.util.cron import Schedule, parse_field
+
+
+class TestSchedule(SimpleTestCase):
+    def test_parse_field(self):
+        self.assertEqual(parse_field("*/15", 0, 59), {0, 15, 30, 45})
+        self.assertEqual(parse_field("9-17/4,23", 0, 23), {9, 13, 17, 23})
+        self.assertEqual(parse_field("5/20", 0, 59), {5, 25, 45})
+        self.assertEqual(parse_field("mon-wed,FRI", 0, 7, {"mon": 1, "tue": 2, "wed": 3, "fri": 5}), {1, 2, 3, 5})
+        for invalid in ("60", "5-1", "x", "*/0", ""):
+            self.assertRaises(ValueError, parse_field, invalid, 0, 59)
+
+    def test_parse(self):
+        self.assertIs(Schedule.parse("0 * * * *"), Schedule.parse("0 * * * *"))
+        self.assertEqual(Schedule.parse("0 0 * * 7").weekdays, {0, 7})
+        self.assertRaises(ValueError, Schedule.parse, "0 * * *")
+        self.assertRaises(ValueError, Schedule.parse, "0 24 * * *")
+
+    def test_matches(self):
+        # Friday 3 January 2020
+        friday = datetime.datetime(2020, 1, 3, 9, 0)
+        self.assertTrue(Schedule.parse("0 9-17 * * mon-fri").matches(friday))
+        self.assertFalse(Schedule.parse("0 9-17 * * sat,sun").matches(friday))
+        self.assertTrue(Schedule.parse("0 9 * jan 5").matches(friday))
+        # Either day field matches when both are restricted
+        self.assertTrue(Schedule.parse("0 9 1 * fri").matches(friday))
+        self.assertFalse(Schedule.parse("0 9 1 * *").matches(friday))
+
+    def test_next_after(self):
+        friday = datetime.datetime(2020, 1, 3, 17, 30, 12)
+        self.assertEqual(Schedule.parse("*/15 * * * *").next_after(friday), datetime.datetime(2020, 1, 3, 17, 45))
+        self.assertEqual(Schedule.parse("30 17 * * *").next_after(friday), datetime.datetime(2020, 1, 4, 17, 30))
+        self.assertEqual(Schedule.parse("0 9-17 * * mon-fri").next_after(friday), datetime.datetime(2020, 1, 6, 9, 0))
+        self.assertEqual(Schedule.parse("0 0 29 2 *").next_after(friday), datetime.datetime(2020, 2, 29, 0, 0))
+        self.assertEqual(Schedule.parse("0 0 1 * *").next_after(datetime.datetime(2020, 12, 5)),
+                         datetime.datetime(2021, 1, 1))
+        self.assertRaises(ValueError, Schedule.parse("0 0 31 feb *").next_after, friday)
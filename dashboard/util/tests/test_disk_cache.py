@@ -0,0 +1,104 @@
+import os
+import shutil
+import tempfile
+import time
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from dashboard.util.disk_cache import DiskCache, LFU
+
+
+class TestDiskCache(SimpleTestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def get_cache(self, **options):
+        return DiskCache(self.dir, {"OPTIONS": options})
+
+    def blobs(self):
+        return sum(len(files) for _, _, files in os.walk(os.path.join(self.dir, DiskCache.blob_dir)))
+
+    def test_get_set(self):
+        cache = self.get_cache()
+        self.assertIsNone(cache.get("a"))
+        cache.set("a", {"content": b"x" * 100})
+        self.assertEqual(cache.get("a"), {"content": b"x" * 100})
+        self.assertTrue(cache.has_key("a"))
+        self.assertFalse(cache.add("a", 1))
+
+        cache.set("a", 2)
+        self.assertEqual(cache.get("a"), 2)
+        self.assertEqual(self.blobs(), 1)
+
+        # Another instance (e.g., in another process) shares the index and blobs
+        self.assertEqual(self.get_cache(ACCESS_BATCH=1).get("a"), 2)
+
+        cache.delete("a")
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(self.blobs(), 0)
+
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["sets"]), (3, 2, 2))
+        self.assertEqual((stats["entries"], stats["size"]), (0, 0))
+
+    def test_expiry(self):
+        cache = self.get_cache()
+        with mock.patch("time.time", return_value=1000):
+            cache.set("a", 1, timeout=10)
+            self.assertEqual(cache.get("a"), 1)
+        with mock.patch("time.time", return_value=1011):
+            self.assertIsNone(cache.get("a"))
+            self.assertFalse(cache.has_key("a"))
+        # Expired entries are removed when the reads are written
+        cache.stats()
+        self.assertEqual(self.blobs(), 0)
+
+    def test_batched_reads(self):
+        cache = self.get_cache(ACCESS_BATCH=3)
+        other = self.get_cache()
+        cache.set("a", 1)
+        cache.get("a")
+        cache.get("b")
+        self.assertEqual((other.stats()["hits"], other.stats()["misses"]), (0, 0))
+
+        cache.get("a")
+        self.assertEqual((other.stats()["hits"], other.stats()["misses"]), (2, 1))
+
+        with mock.patch("time.monotonic", return_value=time.monotonic() + 10):
+            cache.get("a")
+        self.assertEqual(other.stats()["hits"], 3)
+
+    def test_cull_frequency(self):
+        self.assertRaises(ValueError, self.get_cache, CULL_FREQUENCY=0)
+
+    def test_lru(self):
+        cache = self.get_cache(MAX_ENTRIES=3, CULL_FREQUENCY=10)
+        for i, key in enumerate("abc"):
+            with mock.patch("time.time", return_value=i):
+                cache.set(key, key, timeout=None)
+        with mock.patch("time.time", return_value=10):
+            cache.get("a")
+        with mock.patch("time.time", return_value=11):
+            cache.set("d", "d", timeout=None)
+
+        self.assertEqual([k for k in "abcd" if cache.has_key(k)], ["a", "c", "d"])
+        self.assertEqual(cache.stats()["evictions"], 1)
+        self.assertEqual(self.blobs(), 3)
+
+    def test_lfu_max_size(self):
+        cache = self.get_cache(MAX_SIZE=4000, CULL_FREQUENCY=10, EVICTION_POLICY=LFU)
+        cache.set("a", b"a" * 1000)
+        cache.set("b", b"b" * 1000)
+        cache.get("a")
+        cache.get("a")
+        cache.get("b")
+        cache.set("c", b"c" * 1000)
+        cache.get("c")
+        cache.get("c")
+
+        # Exceeds MAX_SIZE: evict the least used (except the new one) until a tenth is free
+        cache.set("d", b"d" * 1000)
+        self.assertEqual([k for k in "abcd" if cache.has_key(k)], ["a", "c", "d"])
+        self.assertLessEqual(cache.stats()["size"], 3600)
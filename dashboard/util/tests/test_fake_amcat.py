@@ -0,0 +1,56 @@
+import json
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
+
+from dashboard.models import System
+from dashboard.util import api
+from dashboard.util.fake_amcat import FakeAmcatConfig, FakeAmcatServer
+
+
+@override_settings(DASHBOARD_API_MAX_TASKS=None, DASHBOARD_API_RATE=None)
+class TestFakeAmcat(SimpleTestCase):
+    def start(self, **config):
+        server = FakeAmcatServer(FakeAmcatConfig(**config)).start()
+        self.addCleanup(server.stop)
+        system = System(id=1, hostname=server.url, project_id=1, amcat_token="fake-token")
+        return server, api.ApiSession(system=system)
+
+    def test_task(self):
+        server, session = self.start(task_duration=0.1)
+        url = "{}/api/v4/query/aggregation?format=json&project=1&sets=1&jobs=".format(server.url)
+        response = session.post(url, data={"output_type": "text/json+aggregation+line"}, headers=api.FORM_HEADERS)
+        uuid = json.loads(response.content.decode("utf-8"))["uuid"]
+
+        with mock.patch("dashboard.util.poller.get_session", return_value=session):
+            result = api.poll(session, uuid)
+        self.assertEqual(len(json.loads(result.content.decode("utf-8"))), 31)
+
+        self.assertIsNotNone(json.loads(session.options(url).content.decode("utf-8"))["form"])
+
+    def test_result_size(self):
+        server, session = self.start(task_duration=0, result_size=100000)
+        for output_type, content_type in [("text/csv", "text/csv"), ("text/html+summary", "text/html")]:
+            task = server.start_task("aggregation", {"output_type": output_type})
+            response = session.get_task_result(task.uuid)
+            self.assertTrue(response.headers["Content-Type"].startswith(content_type))
+            self.assertGreater(len(response.content), 90000)
+
+    def test_queries(self):
+        server, session = self.start()
+        queries = list(session.api.get_pages("projects/1/querys/", page_size=3))
+        self.assertEqual([query["id"] for query in queries], [1, 2, 3, 4])
+        self.assertEqual(json.loads(queries[0]["parameters"])["script"], "aggregation")
+        self.assertEqual(api.search(session.system, page_size_=5)["total"], 20)
+
+    def test_auth_and_throttling(self):
+        server, session = self.start(throttle_rate=1, retry_after=3)
+        response = session.get("{}/api/v4/task?uuid=x".format(server.url))
+        self.assertEqual((response.status_code, response.headers["Retry-After"]), (429, "3"))
+
+        server.config.throttle_rate = 0
+        session.token = "wrong"
+        session.headers["AUTHORIZATION"] = "Token wrong"
+        with mock.patch("dashboard.util.api.renew_token", return_value=None) as renew_token:
+            self.assertEqual(session.get("{}/api/v4/projects/1/".format(server.url)).status_code, 401)
+        renew_token.assert_called_once_with(session.system, "wrong")
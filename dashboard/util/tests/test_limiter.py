@@ -0,0 +1,106 @@
+import threading
+
+from django.test import TransactionTestCase, override_settings
+
+from dashboard.util import limiter
+
+HOST = "http://limiter.test"
+
+
+@override_settings(DASHBOARD_API_HOST_LIMITS={HOST: {"max_tasks": 2, "rate": 1, "burst": 2, "queue_timeout": 0.2,
+                                                     "interactive_reserve": 0.5}})
+class TestLimiter(TransactionTestCase):
+    def tearDown(self):
+        limiter.close_connections()
+
+    def test_task_slots(self):
+        with limiter.task_slot(HOST), limiter.task_slot(HOST):
+            with self.assertRaises(limiter.QueueTimeout):
+                with limiter.task_slot(HOST):
+                    pass
+
+        # Slots are released, also when held by another thread
+        acquired = threading.Event()
+        release = threading.Event()
+
+        def hold():
+            with limiter.task_slot(HOST):
+                acquired.set()
+                release.wait(5)
+
+        thread = threading.Thread(target=hold)
+        thread.start()
+        acquired.wait(5)
+        try:
+            with limiter.task_slot(HOST):
+                pass
+        finally:
+            release.set()
+            thread.join()
+
+    def test_interactive_reserve(self):
+        with limiter.priority(limiter.BACKGROUND):
+            with limiter.task_slot(HOST):
+                with self.assertRaises(limiter.QueueTimeout):
+                    with limiter.task_slot(HOST):
+                        pass
+                self.assertEqual(limiter.get_priority(), limiter.BACKGROUND)
+        self.assertEqual(limiter.get_priority(), limiter.INTERACTIVE)
+
+        # Viewers can still use the reserved slot
+        with limiter.priority(limiter.BACKGROUND), limiter.task_slot(HOST):
+            with limiter.priority(limiter.INTERACTIVE), limiter.task_slot(HOST):
+                pass
+
+    def test_request_budget(self):
+        self.assertEqual(limiter.try_request(HOST), 0)
+        with limiter.priority(limiter.BACKGROUND):
+            # Only the interactive reserve is left
+            self.assertGreater(limiter.try_request(HOST), 0)
+        self.assertEqual(limiter.try_request(HOST), 0)
+        wait = limiter.try_request(HOST)
+        self.assertGreater(wait, 0)
+        self.assertLessEqual(wait, 1)
+
+        with self.assertRaises(limiter.QueueTimeout):
+            limiter.acquire_request(HOST)
+        self.assertGreater(limiter.stats[HOST, limiter.INTERACTIVE, "timeouts"], 0)
+
+    @override_settings(DASHBOARD_API_MAX_TASKS=None, DASHBOARD_API_RATE=None)
+    def test_disabled(self):
+        with limiter.task_slot("http://unlimited.test"):
+            self.assertEqual(limiter.try_request("http://unlimited.test"), 0)
+
+    @override_settings(DASHBOARD_API_LIMITER_CONNECTIONS=1)
+    def test_connections(self):
+        limiter.close_connections()
+        threads = [threading.Thread(target=limiter.try_request, args=(HOST,)) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(limiter._pool), 1)
+
+        # The connection of a slot is given back when it is released
+        with limiter.task_slot(HOST):
+            self.assertEqual(len(limiter._pool), 0)
+        self.assertEqual(len(limiter._pool), 1)
+
+        limiter.close_connections()
+        self.assertEqual(limiter._pool, [])
+
+    def test_request_taken(self):
+        with limiter.request_taken():
+            for _ in range(5):
+                limiter.acquire_request(HOST)
+        self.assertEqual(limiter.try_request(HOST), 0)
+
+    @override_settings(DASHBOARD_API_BURST=None,
+                       DASHBOARD_API_HOST_LIMITS={HOST: {"rate": 1, "interactive_reserve": 0.5}})
+    def test_small_burst(self):
+        # With a burst of 1, the reserve can't be kept: background requests may take the last token
+        with limiter.priority(limiter.BACKGROUND):
+            self.assertEqual(limiter.try_request(HOST), 0)
+            wait = limiter.try_request(HOST)
+        self.assertGreater(wait, 0)
+        self.assertLessEqual(wait, 1)
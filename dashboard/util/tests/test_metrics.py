@@ -0,0 +1,58 @@
+import os
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.test import TestCase, override_settings
+
+from dashboard.util import metrics
+from dashboard.util.metrics import Registry, endpoint_name
+
+
+class TestMetrics(TestCase):
+    def setUp(self):
+        # Counts of other tests go elsewhere
+        metrics.registry.flush()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        patcher = override_settings(DASHBOARD_METRICS_PATH=os.path.join(directory, "metrics.sqlite3"))
+        patcher.enable()
+        self.addCleanup(patcher.disable)
+
+    def test_aggregate(self):
+        # Registries of two processes
+        a, b = Registry(), Registry()
+        a.inc("dashboard_query_cache_requests_total", cache="saved", outcome="hit")
+        b.inc("dashboard_query_cache_requests_total", 2, cache="saved", outcome="hit")
+        b.inc("dashboard_query_cache_requests_total", cache="saved", outcome="miss")
+        a.observe("dashboard_amcat_request_seconds", 0.3, endpoint="task", method="GET")
+        b.observe("dashboard_amcat_request_seconds", 7, endpoint="task", method="GET")
+        a.flush()
+
+        values = b.collect()
+        self.assertEqual(values["dashboard_query_cache_requests_total", '{cache="saved",outcome="hit"}'], 3)
+        self.assertEqual(values["dashboard_amcat_request_seconds_bucket", '{endpoint="task",le="0.5",method="GET"}'], 1)
+        self.assertEqual(values["dashboard_amcat_request_seconds_bucket", '{endpoint="task",le="+Inf",method="GET"}'], 2)
+        self.assertEqual(values["dashboard_amcat_request_seconds_sum", '{endpoint="task",method="GET"}'], 7.3)
+
+        text = a.render([("dashboard_test", "A gauge.", {(("x", 'a"b'),): 5})])
+        self.assertIn("# TYPE dashboard_amcat_request_seconds histogram\n", text)
+        self.assertIn('dashboard_query_cache_requests_total{cache="saved",outcome="miss"} 1\n', text)
+        self.assertIn('dashboard_test{x="a\\"b"} 5\n', text)
+
+    def test_endpoint_name(self):
+        self.assertEqual(endpoint_name("http://amcat.test/api/v4/query/aggregation?format=json&sets=1"),
+                         "query/aggregation")
+        self.assertEqual(endpoint_name("http://amcat.test/api/v4/taskresult/0145f01a-9c33-4716-9ca0-b20f81d7d251"),
+                         "taskresult/:uuid")
+        self.assertEqual(endpoint_name("http://amcat.test/api/v4/projects/12/querys/"), "projects/:id/querys/")
+
+    def test_view(self):
+        metrics.inc("dashboard_query_cache_requests_total", cache="filtered", outcome="hit")
+
+        self.assertEqual(self.client.get("/dashboard/metrics/wrong").status_code, 403)
+        response = self.client.get("/dashboard/metrics/{}".format(settings.CRON_SECRET))
+        self.assertEqual(response.status_code, 200)
+        text = response.content.decode("utf-8")
+        self.assertIn('dashboard_query_cache_requests_total{cache="filtered",outcome="hit"} 1\n', text)
+        self.assertIn("dashboard_query_results 0\n", text)
@@ -0,0 +1,97 @@
+import threading
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
+
+from dashboard.models import System
+from dashboard.util import api, limiter, poller
+from dashboard.util.poller import Poller
+from dashboard.util.tests.test_api import task_response
+
+
+@mock.patch("dashboard.util.api.POLL_DELAY", 0.01)
+@mock.patch("dashboard.util.api.POLL_MAX_DELAY", 0.01)
+@override_settings(DASHBOARD_API_MAX_TASKS=None, DASHBOARD_API_RATE=None)
+class TestPoller(SimpleTestCase):
+    def setUp(self):
+        self.system = System(id=1, hostname="http://amcat.test", amcat_token="token")
+        self.session = mock.Mock()
+        patcher = mock.patch("dashboard.util.poller.get_session", return_value=self.session)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.poller = Poller()
+        patcher = mock.patch("dashboard.util.poller.poller", self.poller)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.poller.stop)
+
+    def test_shared_task(self):
+        self.session.get.side_effect = [task_response(status="PENDING")] * 3 + [task_response(status="SUCCESS")]
+
+        statuses = []
+        waiters = [threading.Thread(target=lambda: statuses.append(self.poller.watch(self.system, "a").wait(5)))
+                   for _ in range(10)]
+        for waiter in waiters:
+            waiter.start()
+        for waiter in waiters:
+            waiter.join()
+
+        self.assertEqual(statuses, [api.STATUS.SUCCESS] * 10)
+        self.assertEqual(self.session.get.call_count, 4)
+
+        done = []
+        self.poller.watch(self.system, "a").subscribe(done.append)
+        self.assertEqual([task.uuid for task in done], ["a"])
+        self.assertEqual(self.session.get.call_count, 4)
+
+    def test_failure(self):
+        self.session.get.side_effect = [task_response(status="FAILURE")]
+        with self.assertRaises(ValueError):
+            self.poller.watch(self.system, "b").wait(5)
+
+    def test_cancel(self):
+        self.session.get.side_effect = lambda url, **kwargs: task_response(status="INPROGRESS")
+        cancel = threading.Event()
+        cancel.set()
+        with self.assertRaises(api.PollCancelled):
+            self.poller.watch(self.system, "c").wait(5, cancel=cancel)
+
+    def test_circuit_open(self):
+        self.session.get.side_effect = api.CircuitOpen()
+        with self.assertRaises(api.CircuitOpen):
+            self.poller.watch(self.system, "a").wait(5)
+        self.assertEqual(self.session.get.call_count, 1)
+
+    def test_request_budget(self):
+        budgeted = []
+
+        def get(url, **kwargs):
+            budgeted.append(getattr(limiter._local, "request_taken", False))
+            return task_response(status="SUCCESS")
+
+        self.session.get.side_effect = get
+        with mock.patch("dashboard.util.limiter.try_request", side_effect=[0.05, 0]) as try_request:
+            self.assertEqual(self.poller.watch(self.system, "d").wait(5), api.STATUS.SUCCESS)
+        # The poller doesn't wait for the budget, but checks again once it allows for a request, which it then uses
+        self.assertEqual(try_request.call_count, 2)
+        self.assertEqual(budgeted, [True])
+
+    def test_slow_host(self):
+        # A host that doesn't answer doesn't hold up the checks of tasks on other hosts
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def get(url, **kwargs):
+            if url.startswith("http://slow.test"):
+                release.wait(5)
+            return task_response(status="SUCCESS")
+
+        self.session.get.side_effect = get
+        slow = System(id=2, hostname="http://slow.test", amcat_token="token")
+        self.poller.watch(slow, "e")
+        self.assertEqual(self.poller.watch(self.system, "f").wait(2), api.STATUS.SUCCESS)
+        self.assertEqual(self.session.get.call_args[1]["timeout"], poller.CHECK_TIMEOUT)
+
+        release.set()
+        self.assertEqual(self.poller.watch(slow, "e").wait(2), api.STATUS.SUCCESS)
@@ -0,0 +1,74 @@
+import json
+import os
+import shutil
+import tempfile
+
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, override_settings
+
+from dashboard.middleware import ProfilingMiddleware
+from dashboard.models import System
+from dashboard.util import profiling
+from dashboard.util.compression import compress
+
+
+class TestProfiling(TestCase):
+    def test_no_profile(self):
+        # Outside a profiled request, nothing is recorded (or fails)
+        with profiling.timed("cache"):
+            profiling.count("cache_hit")
+        self.assertIsNone(profiling.get_profile())
+
+    def test_profile(self):
+        with profiling.profile() as profile:
+            with profiling.timed("cache"):
+                pass
+            profiling.add("amcat", 0.25)
+            profiling.add("amcat", 0.5)
+            profiling.count("cache_hit")
+        self.assertIsNone(profiling.get_profile())
+        self.assertEqual(profile.counts, {"cache": 1, "amcat": 2, "cache_hit": 1})
+        self.assertEqual(profile.durations["amcat"], 0.75)
+        self.assertEqual(profile.server_timing(1), 'amcat;dur=750.0;desc="2 calls", cache;dur=0.0, '
+                                                   'cache_hit;dur=0.0, total;dur=1000.0')
+
+    @override_settings(DASHBOARD_PROFILING=False)
+    def test_disabled(self):
+        self.assertRaises(MiddlewareNotUsed, ProfilingMiddleware)
+
+    @override_settings(DASHBOARD_PROFILING=True, DASHBOARD_PROFILING_SAMPLE_RATE=1)
+    def test_middleware(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.addCleanup(setattr, profiling, "_log", None)
+        log_path = os.path.join(directory, "profiling.log")
+
+        with override_settings(DASHBOARD_PROFILING_LOG=log_path):
+            profiling._log = None
+            middleware = ProfilingMiddleware()
+            request = RequestFactory().get("/dashboard/page/1/")
+            middleware.process_request(request)
+            list(System.objects.all())
+            profiling.add("amcat", 0.1)
+            compress("x" * 1000)
+            response = middleware.process_response(request, HttpResponse("result"))
+            for handler in list(profiling.get_log().handlers):
+                handler.close()
+                profiling.get_log().removeHandler(handler)
+
+            with open(log_path) as f:
+                record = json.loads(f.read())
+
+        timing = response["Server-Timing"]
+        self.assertIn('db;dur=', timing)
+        self.assertIn('desc="1 queries"', timing)
+        self.assertIn('amcat;dur=100.0;desc="1 calls"', timing)
+        self.assertIn('compression;dur=', timing)
+        self.assertIn('total;dur=', timing)
+
+        self.assertEqual(record["path"], "/dashboard/page/1/")
+        self.assertEqual(record["size"], 6)
+        self.assertEqual(record["db"]["n"], 1)
+        self.assertEqual(record["amcat"], {"n": 1, "ms": 100.0})
+        self.assertIsNone(profiling.get_profile())
@@ -0,0 +1,73 @@
+import datetime
+
+from django.test import TestCase, override_settings
+
+from dashboard.models import System, Page, Query, QueryCache, QueryResult
+from dashboard.models.dashboard import Filter
+from dashboard.util import result_cache
+from dashboard.util.compression import compress, decompress
+from dashboard.util.lru import LRUCache
+
+LOCMEM_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'results': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'test-results'},
+}
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class TestResultCache(TestCase):
+    def setUp(self):
+        system = System.objects.create(hostname="http://amcat.test", project_id=1, project_name="test")
+        page = Page.objects.create(system=system, name="page", ordernr=0)
+        query = Query.objects.create(system=system, amcat_query_id=1, amcat_name="q", amcat_parameters="{}",
+                                     amcat_archived=False)
+        result = QueryResult.objects.create(tag="a" * 36, uuid="x", mimetype="application/json",
+                                            content=compress("[1, 2]"), timestamp=datetime.datetime(2020, 1, 1))
+        self.cache = QueryCache.objects.create(query=query, page=page, result=result)
+
+    def lookup(self):
+        pointer = result_cache.peek(self.cache.query_id, self.cache.page_id)
+        return result_cache.get(pointer[0]) if pointer is not None else None
+
+    def test_lookup(self):
+        self.assertIsNone(self.lookup())
+        result_cache.put(self.cache)
+        result = self.lookup()
+        self.assertEqual(decompress(result.content), b"[1, 2]")
+        self.assertEqual(result.mimetype, "application/json")
+
+    def test_invalidate(self):
+        result_cache.put(self.cache)
+        self.cache.clear_cache()
+        self.assertIsNone(self.lookup())
+
+        result_cache.put(self.cache)
+        self.cache.query.clear_cache()
+        self.assertIsNone(self.lookup())
+
+    def test_invalidate_filters(self):
+        # Changed filters change the cache tags of the system's or page's tiles
+        result_cache.put(self.cache)
+        Filter.objects.create(system=self.cache.query.system, field="medium", value="x")
+        self.assertIsNone(self.lookup())
+
+        result_cache.put(self.cache)
+        self.cache.page.save()
+        self.assertIsNone(self.lookup())
+
+    def test_refresh_same_tag(self):
+        result_cache.put(self.cache)
+        self.cache.result.content = compress("[3]")
+        self.cache.result.timestamp = datetime.datetime(2020, 1, 2)
+        result_cache.put(self.cache)
+        self.assertEqual(decompress(self.lookup().content), b"[3]")
+
+    def test_lru_bounded(self):
+        lru = LRUCache(10)
+        lru.set("a", "12345")
+        lru.set("b", "12345")
+        lru.get("a")
+        lru.set("c", "12345")
+        self.assertIn("a", lru)
+        self.assertNotIn("b", lru)
+        self.assertEqual(lru.size, 10)
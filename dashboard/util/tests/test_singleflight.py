@@ -0,0 +1,88 @@
+import threading
+import time
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from dashboard.util import singleflight
+from dashboard.util.singleflight import SingleFlight
+
+THREADS = 5
+
+
+class _WaitCountingEvent(threading.Event):
+    def __init__(self):
+        super().__init__()
+        self.waiting = 0
+
+    def wait(self, timeout=None):
+        self.waiting += 1
+        return super().wait(timeout)
+
+
+class _Call(singleflight._Call):
+    instances = []
+
+    def __init__(self):
+        super().__init__()
+        self.done = _WaitCountingEvent()
+        self.instances.append(self)
+
+
+@mock.patch.object(singleflight, "_Call", _Call)
+class TestSingleFlight(SimpleTestCase):
+    def setUp(self):
+        _Call.instances.clear()
+
+    def do_concurrently(self, result):
+        """
+        Call SingleFlight.do with the same key from THREADS threads, and return the number of calls of the function
+        and what each thread got (or raised). The function returns (or raises) `result` once all threads wait for it.
+        """
+        single_flight = SingleFlight()
+        calls = []
+
+        def func():
+            calls.append(threading.current_thread().name)
+            deadline = time.monotonic() + 5
+            while _Call.instances[0].done.waiting < THREADS - 1 and time.monotonic() < deadline:
+                time.sleep(0.001)
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        results = [None] * THREADS
+
+        def call(i):
+            try:
+                results[i] = single_flight.do("key", func)
+            except Exception as e:
+                results[i] = e
+
+        threads = [threading.Thread(target=call, args=(i,)) for i in range(THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        self.assertFalse(single_flight._calls)
+        return len(calls), results
+
+    def test_shared_result(self):
+        result = object()
+        calls, results = self.do_concurrently(result)
+        self.assertEqual(calls, 1)
+        self.assertEqual(len(_Call.instances), 1)
+        self.assertTrue(all(r is result for r in results))
+
+    def test_shared_exception(self):
+        error = ValueError("AmCAT is down")
+        calls, results = self.do_concurrently(error)
+        self.assertEqual(calls, 1)
+        self.assertTrue(all(r is error for r in results))
+
+    def test_sequential(self):
+        # Calls are only coalesced while they are in flight
+        single_flight = SingleFlight()
+        self.assertEqual(single_flight.do("key", lambda: 1), 1)
+        self.assertEqual(single_flight.do("key", lambda: 2), 2)
+        self.assertEqual(single_flight.do("other", lambda x: x, 3), 3)
@@ -1,18 +1,95 @@
 import datetime
+import logging
 
-from django.http import HttpResponse, HttpResponseForbidden
+from django.db import transaction
+from django.http import HttpResponse, HttpResponseForbidden, JsonResponse, Http404
 from django.conf import settings
+from django.utils import timezone
 
-from dashboard.models import Query
+from dashboard.models import Query, QueryCache, QueryResult, RefreshRun
+from dashboard.models.job import Job, queue_enabled
+from dashboard.util import metrics
+from dashboard.util.background import run_in_background
+from dashboard.views.dashboard_view import prewarm_filter_variants
+
+log = logging.getLogger(__name__)
+
+# cron-trigger runs every minute, so refreshes that were due longer ago than this were missed
+CATCH_UP_AFTER = datetime.timedelta(minutes=1)
+
+# Runs are kept this long, for their summaries
+KEEP_RUNS = datetime.timedelta(days=7)
 
 
 def trigger(request, secret):
+    """
+    Start refreshing the queries scheduled for this minute in the background, and respond with the run's id
+    (or with 204 No Content if no query is due).
+    """
+    if secret != settings.CRON_SECRET:
+        return HttpResponseForbidden()
+
+    now = timezone.now()
+    due = {}
+    with transaction.atomic():
+        # Concurrent triggers don't run the same refreshes: the second waits, and then finds nothing due
+        queries = list(Query.get_due(now).select_for_update().only("id", "refresh_interval", "next_refresh_at"))
+        for query in queries:
+            due[query.id] = query.next_refresh_at
+            # Refreshes that should have run before the previous minute were missed (the trigger didn't run, or
+            # ran late). They are run now, once, however many times they were missed.
+            if query.next_refresh_at < now - CATCH_UP_AFTER:
+                log.info("Catching up on the refresh of {!r} due at {}".format(query, query.next_refresh_at))
+                metrics.inc("dashboard_refresh_catch_ups_total")
+            query.schedule_next(now)
+            query.save(update_fields=["next_refresh_at"])
+
+    if not due:
+        return HttpResponse(status=204)
+
+    RefreshRun.delete_old(KEEP_RUNS)
+    run = RefreshRun.create(now.replace(second=0, microsecond=0), due)
+    query_ids = list(due)
+    if queue_enabled():
+        Job.enqueue("refresh_run", {"run_id": run.id, "query_ids": query_ids})
+    else:
+        run_in_background(run_scheduled, run.id, query_ids, key="refresh-run-{}".format(run.id))
+
+    return HttpResponse(str(run.id), status=200, content_type="text/plain")
+
+
+def run_scheduled(run_id, query_ids):
+    run = RefreshRun.objects.get(id=run_id)
+
+    # Queries with equal parameters share their results, so refresh them together
+    query_caches = list(QueryCache.objects.filter(query__in=query_ids).select_related("result", "query__system", "page"))
+    run.execute(query_caches)
+
+    # Results of caches that were deleted, or whose parameters changed
+    QueryResult.delete_unused()
+
+    # Popular filter combinations of these tiles are outdated now as well
+    query_cache_ids = [query_cache.id for query_cache in query_caches]
+    if queue_enabled():
+        Job.enqueue("prewarm", {"query_cache_ids": query_cache_ids})
+    else:
+        run_in_background(prewarm_filter_variants, query_cache_ids, key="prewarm-{}".format(run_id))
+
+
+def run_summary(request, run_id, secret):
     if secret != settings.CRON_SECRET:
         return HttpResponseForbidden()
 
-    queries = Query.get_scheduled_for(datetime.datetime.now())
-    for query in queries:
-        query.refresh_cache()
-        query.save()
+    try:
+        run = RefreshRun.objects.get(id=run_id)
+    except RefreshRun.DoesNotExist:
+        raise Http404("No such run")
 
-    return HttpResponse("OK", status=200)
+    return JsonResponse({
+        "id": run.id,
+        "scheduled_for": run.scheduled_for.isoformat(),
+        "started": run.started.isoformat(),
+        "finished": run.finished and run.finished.isoformat(),
+        "failures": run.failures,
+        "queries": run.get_summary(),
+    })
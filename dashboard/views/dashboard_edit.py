@@ -4,10 +4,11 @@ from operator import itemgetter
 
 from django import forms
 from django.contrib.auth.decorators import user_passes_test
+from django.core.exceptions import ValidationError
 from django.core.urlresolvers import reverse
 from django.db import transaction
 from django.db.models import Q
-from django.http import HttpResponse, Http404
+from django.http import HttpResponse, Http404, JsonResponse
 from django.shortcuts import redirect, render
 from django.views.decorators.http import require_http_methods, require_POST
 from django.views.generic import FormView
@@ -48,6 +49,13 @@ def save_rows(request, page_id):
 
     rows = json.loads(request.body.decode("utf-8"))
 
+    # Check the schedules before changing anything, rather than failing halfway
+    try:
+        for col in chain(*rows):
+            Query(refresh_interval=col["refresh_interval"]).clean()
+    except ValidationError as e:
+        return JsonResponse({"errors": e.message_dict}, status=400)
+
     # Remove existing rows and cells
     row_ids = set(page.cells.values_list("row__id", flat=True))
     Row.objects.filter(id__in=row_ids).delete()
@@ -1,15 +1,25 @@
 import datetime
 import json
 import csv
+import logging
+from hashlib import sha1
+from itertools import groupby
 from django.core.cache import caches
 from django.db import transaction
-from django.db.models.expressions import RawSQL
+from django.db.models import BooleanField, Case, Value, When
 from django.template.response import TemplateResponse
+from django.utils import timezone
 from django.views.decorators.gzip import gzip_page
 from django.views.decorators.http import require_http_methods
 from requests import HTTPError
 
-from dashboard.models.query import QueryCache, merge_filters
+from dashboard.models.job import PRIORITY_INTERACTIVE, PRIORITY_USER, Job, queue_enabled
+from dashboard.models.query import QueryCache, enqueue_refresh, merge_filters
+from dashboard.util import limiter, metrics, profiling, result_cache
+from dashboard.util.background import run_in_background
+from dashboard.util.singleflight import SingleFlight
+from dashboard.util.compression import compressed_response
+from dashboard.util.http import not_modified, set_validators
 from dashboard.util.shortcuts import redirect_referrer, safe_referrer
 
 try:
@@ -20,15 +30,24 @@ except ImportError:
 from django.core.urlresolvers import reverse
 from django.conf import settings
 
-from django.http import HttpResponse, Http404, JsonResponse
+from django.http import HttpResponse, Http404, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render, redirect
 from django.views.generic import TemplateView
 
-from dashboard.models import Query, Page, HighchartsTheme
-from dashboard.util.api import start_task, get_session
+from dashboard.models import Query, Page, HighchartsTheme, FilterVariant
+from dashboard.util.api import STATUS, CircuitOpen, start_task, get_breaker, get_session, iter_content, poll
+from dashboard.util.poller import poller
 
 from dashboard.models.user import EPOCH
 
+log = logging.getLogger(__name__)
+
+# Seconds a download status request may wait for the first status of its task
+POLL_FIRST_CHECK_TIMEOUT = 5
+
+# Set on responses serving an outdated result, while a new one is being fetched
+STALE_HEADER = "X-Dashboard-Stale"
+
 class MenuViewMixin(object):
     pass
 
@@ -106,11 +125,11 @@ def clear_cache(request, query_id):
         query.save()
 
     try:
-        if request.POST.get('refresh', False):
-            for cache in query.querycache_set.all():
-                with transaction.atomic():
-                    cache = QueryCache.objects.select_for_update().get(pk=cache.id)
-                    cache.refresh_cache()
+        if request.POST.get('refresh', False) and queue_enabled():
+            enqueue_refresh(QueryCache.objects.filter(query=query).select_related("query__system", "page"),
+                            priority=PRIORITY_USER)
+        elif request.POST.get('refresh', False):
+            query.refresh_cache()
         else:
             start_task(get_session(query.system), query)
 
@@ -143,13 +162,12 @@ def download_query(request, query_id, page_id):
     except QueryCache.DoesNotExist:
         raise Http404("No such object")
 
-    uuid = cache.start_task(extra_options={"output_type": "text/csv"})
-    cache.uuid = uuid
-    cache.save()
-
-    content, content_type = cache.poll(uuid)
+    session = get_session(cache.query.system)
+    with limiter.task_slot(cache.query.system.hostname):
+        uuid = cache.start_task(extra_options={"output_type": "text/csv"})
+        result = poll(session, uuid, stream=True)
 
-    return HttpResponse(content_type=content_type, content=content)
+    return StreamingHttpResponse(iter_content(result), content_type=result.headers.get("Content-Type"))
 
 
 @gzip_page
@@ -159,10 +177,8 @@ def download_query_results(request, *, page_id, query_id, uuid):
     except Query.DoesNotExist:
         raise Http404("No such object")
 
-    response = get_session(query.system).get_task_result(uuid)
-    content = response.content.decode('utf-8')
-    content_type = response.headers.get("Content-Type")
-    return HttpResponse(content=content, content_type=content_type)
+    result = get_session(query.system).get_task_result(uuid, stream=True)
+    return StreamingHttpResponse(iter_content(result), content_type=result.headers.get("Content-Type"))
 
 
 @gzip_page
@@ -172,7 +188,16 @@ def poll_query_by_uuid(request, *, query_id, page_id, query_uuid):
     except QueryCache.DoesNotExist:
         raise Http404("No such object")
 
-    status, result = cache.poll_once(query_uuid)
+    # The browser asks every 500ms, but AmCAT is only asked by the poller of this process
+    task = poller.watch(cache.query.system, query_uuid)
+    task.checked.wait(POLL_FIRST_CHECK_TIMEOUT)
+
+    if task.task is not None:
+        result = dict(task.task)
+    elif task.error is not None:
+        result = {"results": [{"status": STATUS.FAILED, "error": {"exc_message": str(task.error)}}]}
+    else:
+        result = {"results": [{"status": STATUS.PENDING}]}
     result["result_url"] = reverse("dashboard:download-query-results", args=(page_id, query_id, query_uuid))
     return JsonResponse(result)
 
@@ -203,7 +228,7 @@ def get_saved_query(request, query_id, page_id):
     amcat_parameters = query.get_parameters(query_override=query_override, date_override=date_override)
     filters = merge_filters(json.loads(amcat_parameters['filters']), extra_filters)
     amcat_parameters['filters'] = json.dumps(filters, ensure_ascii=True, sort_keys=True)
-    return HttpResponse(content_type="application/json", content=json.dumps({
+    content = json.dumps({
         "id": query.id,
         "amcat_project_id": query.amcat_project_id,
         "amcat_query_id": query.amcat_query_id,
@@ -219,7 +244,14 @@ def get_saved_query(request, query_id, page_id):
         "output_type": query.get_output_type(),
         "articleset_ids": query.get_articleset_ids(),
         "result_url": reverse('dashboard:get-saved-query-result', args=[page_id, query.id])
-    }))
+    })
+
+    etag = sha1(content.encode("utf-8")).hexdigest()
+    response = not_modified(request, etag)
+    if response is None:
+        response = HttpResponse(content_type="application/json", content=content)
+        set_validators(response, etag)
+    return response
 
 
 @gzip_page
@@ -229,12 +261,6 @@ def get_saved_query_result(request, query_id, page_id):
     code is not thread-safe.
     """
 
-    try:
-        defaults = dict(query_id=query_id, page_id=page_id)
-        cache, created = QueryCache.objects.get_or_create(defaults=defaults, **defaults)
-    except QueryCache.DoesNotExist:
-        raise Http404("No such object")
-
     query_override, extra_filters, date_override = None, {}, None
     if DashboardPageView.query_param in request.GET:
         query_override = request.GET.get(DashboardPageView.query_param).strip()
@@ -242,51 +268,229 @@ def get_saved_query_result(request, query_id, page_id):
         extra_filters["publisher"] = request.GET.getlist(DashboardPageView.medium_param)
     if DashboardPageView.date_param in request.GET:
         date_override = request.GET.get(DashboardPageView.date_param).strip()
+    is_filtered = bool(query_override or extra_filters or date_override)
+
+    if not is_filtered:
+        pointer = result_cache.peek(query_id, page_id)
+        if pointer is not None:
+            version, timestamp = pointer
+            response = not_modified(request, version, timestamp)
+            if response is not None:
+                count_request("saved", "not_modified")
+                return response
+
+            with profiling.timed("cache"):
+                cached = result_cache.get(version)
+            if cached is not None:
+                count_request("saved", "hit")
+                return compressed_response(request, cached.content, cached.mimetype,
+                                           etag=version, last_modified=timestamp)
+
+    try:
+        defaults = dict(query_id=query_id, page_id=page_id)
+        # Don't load the result itself until we know we have to send it
+        cache, created = QueryCache.objects.select_related("result", "page", "query__system") \
+            .defer("result__gzip", "result__brotli") \
+            .get_or_create(defaults=defaults, **defaults)
+    except QueryCache.DoesNotExist:
+        raise Http404("No such object")
 
-    if query_override or extra_filters or date_override:
-        check = get_filtered_query_result(request, cache, query_override, extra_filters, date_override)
+    if is_filtered:
         return get_filtered_query_result(request, cache, query_override, extra_filters, date_override)
 
-    # If we've still got one in cache, use that one
-    if cache.is_valid():
-        return HttpResponse(cache.cache, content_type=cache.cache_mimetype)
-
-    # We need to fetch it from an amcat instance
-    if not cache.is_valid():
-        # Nothing in cache, start querying.
-        # using a transaction to prevent multiple updates for the same query.
-        with transaction.atomic():
-            mut_query = QueryCache.objects.select_for_update().get(pk=cache.pk)
-            # We weren't in a transaction before. Better check again
-            if not cache.is_valid():
-                mut_query.clear_cache()
-                mut_query.refresh_cache()
-                mut_query.save()
-                cache = mut_query
+    # If we've still got one in cache (or another page holds one for the same parameters), use that one
+    if cache.is_valid() or cache.attach_result():
+        count_request("saved", "hit")
+        return saved_query_result_response(request, cache)
+
+    # Serve the outdated result, and let the client know we're fetching a new one
+    if cache.can_serve_stale():
+        if not get_breaker(cache.query.system).is_open() and not cache.revalidation_failed_recently():
+            revalidate_in_background(cache)
+        count_request("saved", "stale")
+        return stale_response(request, cache.content, cache.cache_mimetype)
+
+    # We need to fetch it from an amcat instance. With a job queue, a worker does that while the client polls.
+    if queue_enabled():
+        # Don't queue another job for a result that just failed, but serve what we have
+        if cache.revalidation_failed_recently():
+            if not cache.content_size:
+                count_request("saved", "unavailable")
+                return unavailable_response()
+            count_request("saved", "stale")
+            return stale_response(request, cache.content, cache.cache_mimetype)
+        Job.enqueue("revalidate", {"query_cache_id": cache.pk}, key=cache.get_query_tag(),
+                    priority=PRIORITY_INTERACTIVE)
+        count_request("saved", "queued")
+        return pending_response()
 
-            else:
-                # Another request already initiated a refresh, tell the client to try again later..
-                r = JsonResponse({"status": "pending"})
-                r['Etag'] = ""
+    try:
+        cache.revalidate()
+    except CircuitOpen:
+        # AmCAT is failing: fall back to the last result we have, however old
+        if not cache.content_size:
+            count_request("saved", "unavailable")
+            return unavailable_response()
+        count_request("saved", "stale")
+        return stale_response(request, cache.content, cache.cache_mimetype)
+    count_request("saved", "miss")
 
     # Return cached result
-    return HttpResponse(cache.cache, content_type=cache.cache_mimetype)
+    return saved_query_result_response(request, cache)
+
+
+def saved_query_result_response(request, query_cache: QueryCache):
+    """Respond with the (valid) result of a QueryCache, or with 304 Not Modified if the client has it."""
+    version = result_cache.get_version(query_cache.cache_tag, query_cache.cache_timestamp)
+    response = not_modified(request, version, query_cache.cache_timestamp)
+    if response is not None:
+        result_cache.put_pointer(query_cache)
+        return response
+
+    result_cache.put(query_cache)
+    return compressed_response(request, query_cache.content, query_cache.cache_mimetype,
+                               etag=version, last_modified=query_cache.cache_timestamp)
+
+
+def count_request(cache, outcome):
+    metrics.inc("dashboard_query_cache_requests_total", cache=cache, outcome=outcome)
+    profiling.count("cache_" + outcome)
+
+
+def stale_response(request, content, mimetype):
+    """Respond with an outdated result, marked as such with STALE_HEADER."""
+    response = compressed_response(request, content, mimetype)
+    response[STALE_HEADER] = "1"
+    return response
+
+
+def pending_response():
+    """Tell the client its result is being computed, and to ask again."""
+    response = JsonResponse({"status": "pending"}, status=202)
+    response["Retry-After"] = "1"
+    return response
+
+
+def unavailable_response():
+    retry_after = getattr(settings, "DASHBOARD_BREAKER_RESET", 30)
+    response = HttpResponse("AmCAT is unavailable, and there is no earlier result.", status=503,
+                            content_type="text/plain")
+    response["Retry-After"] = str(retry_after)
+    return response
+
+
+def revalidate_cache(query_cache_id):
+    """Revalidate a cache in the background, and record when that fails. This is the handler of 'revalidate' jobs."""
+    query_cache = QueryCache.objects.select_related("query__system", "page").get(pk=query_cache_id)
+    try:
+        query_cache.revalidate()
+    except Exception:
+        QueryCache.objects.filter(pk=query_cache_id).update(revalidation_failed=timezone.now())
+        raise
+    if query_cache.revalidation_failed is not None:
+        QueryCache.objects.filter(pk=query_cache_id).update(revalidation_failed=None)
+
+
+def revalidate_in_background(query_cache: QueryCache):
+    """Revalidate the cache in a worker if we have a job queue, or else in a thread of this process."""
+    if queue_enabled():
+        Job.enqueue("revalidate", {"query_cache_id": query_cache.pk}, key=query_cache.get_query_tag(),
+                    priority=PRIORITY_USER)
+    else:
+        run_in_background(revalidate_cache, query_cache.pk, key=("revalidate", query_cache.pk))
+
+
+# Concurrent requests for the same filtered result in this process wait for a single AmCAT task
+_filtered_results = SingleFlight()
+
+
+def _is_fresh(timestamp, query_cache: QueryCache):
+    return timestamp and timestamp.replace(tzinfo=datetime.timezone.utc) >= query_cache.cache_timestamp.astimezone()
 
 
 def get_filtered_query_result(request, query_cache: QueryCache, query_override: str, extra_filters: dict, date_override: str):
+    if getattr(settings, "DASHBOARD_PREWARM_VARIANTS", 0):
+        FilterVariant.record(query_cache.page_id, query_override, extra_filters, date_override)
+
     cache_key = query_cache.get_query_tag(query_override=query_override, extra_filters=extra_filters, date_override=date_override)
-    cached = caches['query'].get(cache_key)
 
-    if not cached or cached['timestamp'].replace(tzinfo=datetime.timezone.utc) < query_cache.cache_timestamp.astimezone():
-        uuid = query_cache.start_task(query_override=query_override, extra_filters=extra_filters, date_override=date_override)
+    timestamp = caches['query'].get(cache_key + ":timestamp")
+    if _is_fresh(timestamp, query_cache):
+        etag = result_cache.get_version(cache_key, timestamp)
+        response = not_modified(request, etag, timestamp)
+        if response is not None:
+            count_request("filtered", "not_modified")
+            return response
+
+    with profiling.timed("cache"):
+        cached = caches['query'].get(cache_key) if _is_fresh(timestamp, query_cache) else None
+    if cached is None:
+        try:
+            cached = _filtered_results.do(cache_key, fetch_filtered_query_result, query_cache, cache_key,
+                                          query_override, extra_filters, date_override)
+        except CircuitOpen:
+            # AmCAT is failing: fall back to an outdated result for these filters, if we have one
+            cached = caches['query'].get(cache_key)
+            if cached is None:
+                count_request("filtered", "unavailable")
+                return unavailable_response()
+            count_request("filtered", "stale")
+            return stale_response(request, cached['content'], cached['content_type'])
+        count_request("filtered", "miss")
+    else:
+        count_request("filtered", "hit")
+
+    etag = result_cache.get_version(cache_key, cached['timestamp'])
+    return compressed_response(request, cached['content'], cached['content_type'],
+                               etag=etag, last_modified=cached['timestamp'])
+
+
+def fetch_filtered_query_result(query_cache: QueryCache, cache_key: str, query_override: str, extra_filters: dict, date_override: str):
+    # A call that finished just before ours started might have stored it already
+    if _is_fresh(caches['query'].get(cache_key + ":timestamp"), query_cache):
+        cached = caches['query'].get(cache_key)
+        if cached is not None:
+            return cached
+
+    with limiter.task_slot(query_cache.query.system.hostname):
+        uuid = query_cache.start_task(query_override=query_override, extra_filters=extra_filters,
+                                      date_override=date_override)
         content, content_type = query_cache.poll(uuid, save_result=False)
-        caches['query'].set(cache_key, {
-            "content": content,
-            "content_type": content_type,
-            "timestamp": datetime.datetime.now(tz=datetime.timezone.utc)
-        })
-        return HttpResponse(content, content_type=content_type)
-    return HttpResponse(cached['content'], content_type=cached['content_type'])
+    cached = {
+        "content": content,
+        "content_type": content_type,
+        "timestamp": datetime.datetime.now(tz=datetime.timezone.utc)
+    }
+    caches['query'].set(cache_key, cached)
+    caches['query'].set(cache_key + ":timestamp", cached['timestamp'])
+    return cached
+
+
+def prewarm_filter_variants(query_cache_ids):
+    """
+    Compute the most popular filter variants (see FilterVariant) of the given QueryCaches, after their
+    results have been refreshed. Configured by DASHBOARD_PREWARM_VARIANTS and DASHBOARD_PREWARM_WINDOW.
+    """
+    n = getattr(settings, "DASHBOARD_PREWARM_VARIANTS", 0)
+    window = getattr(settings, "DASHBOARD_PREWARM_WINDOW", datetime.timedelta(days=14))
+    if not n:
+        return
+
+    FilterVariant.flush()
+    FilterVariant.delete_stale(window)
+
+    query_caches = QueryCache.objects.filter(id__in=query_cache_ids).select_related("result", "page", "query__system") \
+        .defer("result__gzip", "result__brotli").order_by("page_id")
+    for page_id, page_caches in groupby(query_caches, key=lambda query_cache: query_cache.page_id):
+        page_caches = [query_cache for query_cache in page_caches if query_cache.is_valid()]
+        for variant in FilterVariant.get_popular(page_id, n, window):
+            for query_cache in page_caches:
+                args = (variant.query_override, variant.extra_filters, variant.date_override)
+                cache_key = query_cache.get_query_tag(*args)
+                try:
+                    _filtered_results.do(cache_key, fetch_filtered_query_result, query_cache, cache_key, *args)
+                except Exception:
+                    log.exception("Could not prewarm {} for {!r}".format(variant.key, query_cache))
 
 
 def empty(request):
@@ -306,14 +510,18 @@ def queries(request, system_id):
     server_port = request.META["SERVER_PORT"]
     epoch = EPOCH + datetime.timedelta(minutes=1)
 
-    # Order by -has_cache, cache_timestamp to sort in order of [older cache, newer cache, no cache]
+    has_cache = Case(When(result__timestamp__gt=epoch, then=Value(True)), default=Value(False),
+                     output_field=BooleanField())
+
+    # Order by -has_cache, result__timestamp to sort in order of [older cache, newer cache, no cache]
     caches = QueryCache.objects.filter(query__system_id=system_id) \
-        .annotate(has_cache=RawSQL('cache_timestamp > %s', (epoch.isoformat(),))) \
-        .order_by('query_id', '-has_cache', 'cache_timestamp') \
+        .annotate(has_cache=has_cache) \
+        .order_by('query_id', '-has_cache', 'result__timestamp') \
         .distinct('query_id').values('pk')
 
     caches = QueryCache.objects.filter(pk__in=caches) \
-        .annotate(has_cache=RawSQL('cache_timestamp > %s', (epoch.isoformat(),)))\
+        .annotate(has_cache=has_cache) \
+        .select_related('query', 'result').defer('result__gzip', 'result__brotli') \
         .order_by('query__amcat_query_id')
 
     uncached = Query.objects.filter(system_id=system_id,querycache=None).order_by('amcat_query_id')
@@ -0,0 +1,39 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Count, Sum
+from django.db.models.functions import Length
+from django.http import HttpResponse, HttpResponseForbidden
+
+from dashboard.models import QueryResult
+from dashboard.util.metrics import registry
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def get_gauges():
+    """Values measured at scrape time, see Registry.render."""
+    results = QueryResult.objects.aggregate(count=Count("id"), identity=Sum("length"), gzip=Sum(Length("gzip")),
+                                            brotli=Sum(Length("brotli")))
+    gauges = [
+        ("dashboard_query_results", "Number of stored query results.", {(): results.pop("count")}),
+        ("dashboard_query_results_bytes", "Total size of stored query results, by encoding.",
+         {(("encoding", encoding),): size or 0 for encoding, size in results.items()}),
+    ]
+
+    # The DiskCache keeps its counters in its (shared) index
+    stats = getattr(caches["query"], "stats", None)
+    if stats is not None:
+        stats = stats()
+        gauges += [
+            ("dashboard_filtered_cache_operations", "Operations on the cache of filtered results since it was created.",
+             {(("operation", name),): stats[name] for name in ("hits", "misses", "sets", "evictions")}),
+            ("dashboard_filtered_cache_bytes", "Total size of the cache of filtered results.", {(): stats["size"]}),
+            ("dashboard_filtered_cache_entries", "Number of filtered results in the cache.", {(): stats["entries"]}),
+        ]
+    return gauges
+
+
+def metrics(request, secret):
+    if secret != settings.CRON_SECRET:
+        return HttpResponseForbidden()
+    return HttpResponse(registry.render(get_gauges()), content_type=CONTENT_TYPE)
@@ -0,0 +1,58 @@
+import json
+from unittest import mock
+
+from django.test import RequestFactory, TestCase, override_settings
+from django.utils import timezone
+
+from dashboard.models import Job, Query, RefreshRun, System
+from dashboard.views import cron
+
+PARAMETERS = json.dumps({"script": "aggregation", "articlesets": [1], "output_type": "application/json"})
+
+
+@override_settings(CRON_SECRET="secret", DASHBOARD_JOB_QUEUE=False, DASHBOARD_REFRESH_JITTER=0)
+@mock.patch("dashboard.views.cron.run_in_background")
+class TestTrigger(TestCase):
+    def trigger(self):
+        return cron.trigger(RequestFactory().get("/"), secret="secret")
+
+    def test_nothing_due(self, run_in_background):
+        response = self.trigger()
+        self.assertEqual(response.status_code, 204)
+        self.assertFalse(RefreshRun.objects.exists())
+        run_in_background.assert_not_called()
+
+    def test_delete_old_runs(self, run_in_background):
+        system = System.objects.create(hostname="http://amcat.test", project_id=1, project_name="test")
+        query = Query.objects.create(system=system, amcat_query_id=1, amcat_name="q", amcat_parameters=PARAMETERS,
+                                     amcat_archived=False, refresh_interval="* * * * *")
+        Query.objects.filter(pk=query.pk).update(next_refresh_at=timezone.now())
+        old = RefreshRun.objects.create(scheduled_for=timezone.now())
+        RefreshRun.objects.filter(pk=old.pk).update(started=timezone.now() - cron.KEEP_RUNS * 2)
+
+        response = self.trigger()
+        self.assertEqual(response.status_code, 200)
+        run = RefreshRun.objects.get()
+        self.assertEqual(response.content.decode("utf-8"), str(run.id))
+        self.assertEqual(list(map(int, run.get_summary())), [query.id])
+        run_in_background.assert_called_once_with(cron.run_scheduled, run.id, [query.id],
+                                                  key="refresh-run-{}".format(run.id))
+
+
+@mock.patch.object(RefreshRun, "execute")
+class TestRunScheduled(TestCase):
+    @override_settings(DASHBOARD_JOB_QUEUE=False)
+    @mock.patch("dashboard.views.cron.run_in_background")
+    def test_prewarm(self, run_in_background, execute):
+        # Overlapping runs each prewarm their own tiles
+        runs = [RefreshRun.objects.create(scheduled_for=timezone.now()) for _ in range(2)]
+        for run in runs:
+            cron.run_scheduled(run.id, [])
+        keys = [call[1]["key"] for call in run_in_background.call_args_list]
+        self.assertEqual(len(set(keys)), 2)
+
+    @override_settings(DASHBOARD_JOB_QUEUE=True)
+    def test_prewarm_job(self, execute):
+        run = RefreshRun.objects.create(scheduled_for=timezone.now())
+        cron.run_scheduled(run.id, [])
+        self.assertEqual(list(Job.objects.values_list("kind", flat=True)), ["prewarm"])
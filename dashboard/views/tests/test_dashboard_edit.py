@@ -0,0 +1,41 @@
+import json
+from unittest import mock
+
+from django.test import RequestFactory, TestCase
+
+from dashboard.models import System, Page, Query, Cell, Row
+from dashboard.views.dashboard_edit import save_rows
+
+PARAMETERS = json.dumps({"script": "aggregation", "articlesets": [1], "output_type": "application/json"})
+
+
+class TestSaveRows(TestCase):
+    def setUp(self):
+        system = System.objects.create(hostname="http://amcat.test", project_id=1, project_name="test")
+        self.page = Page.objects.create(system=system, name="page", ordernr=0)
+        self.query = Query.objects.create(system=system, amcat_query_id=1, amcat_name="q", amcat_archived=False,
+                                          amcat_parameters=PARAMETERS, refresh_interval="0 * * * *")
+
+    def save(self, refresh_interval):
+        rows = [[{"query_id": self.query.id, "link": None, "theme_id": None, "width": 6, "customize": {},
+                  "title": "tile", "refresh_interval": refresh_interval}]]
+        request = RequestFactory().post("/", json.dumps(rows), content_type="application/json")
+        request.user = mock.Mock(is_superuser=True)
+        return save_rows(request, page_id=self.page.id)
+
+    def test_refresh_interval(self):
+        self.assertEqual(self.save("*/15 * * * *").status_code, 201)
+        self.assertEqual(Query.objects.get().refresh_interval, "*/15 * * * *")
+        self.assertIsNotNone(Query.objects.get().next_refresh_at)
+
+    def test_invalid_refresh_interval(self):
+        self.assertEqual(self.save("0 * * * *").status_code, 201)
+
+        response = self.save("61 * * * *")
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("refresh_interval", json.loads(response.content.decode("utf-8"))["errors"])
+
+        # The page is left as it was
+        self.assertEqual(Query.objects.get().refresh_interval, "0 * * * *")
+        self.assertEqual(Cell.objects.filter(page=self.page).count(), 1)
+        self.assertEqual(Row.objects.count(), 1)
@@ -0,0 +1,159 @@
+import datetime
+import json
+from unittest import mock
+
+from django.core.cache import caches
+from django.test import RequestFactory, TestCase, override_settings
+from django.utils import timezone
+from django.utils.http import http_date
+
+from dashboard.models import System, Page, Query, QueryCache, QueryResult
+from dashboard.util import result_cache
+from dashboard.util.compression import compress
+from dashboard.views.dashboard_view import get_saved_query, get_saved_query_result, revalidate_cache, \
+    STALE_HEADER
+
+LOCMEM_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'results': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'test-view-results'},
+    'query': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'test-view-query'},
+}
+
+PARAMETERS = json.dumps({"script": "aggregation", "articlesets": [1], "output_type": "application/json", "query": "a"})
+
+
+@override_settings(CACHES=LOCMEM_CACHES, DASHBOARD_PREWARM_VARIANTS=0)
+class TestConditionalRequests(TestCase):
+    def setUp(self):
+        system = System.objects.create(hostname="http://amcat.test", project_id=1, project_name="test")
+        self.page = Page.objects.create(system=system, name="page", ordernr=0)
+        self.query = Query.objects.create(system=system, amcat_query_id=1, amcat_name="q", amcat_archived=False,
+                                          amcat_parameters=PARAMETERS, amcat_options="{}")
+        query_cache = QueryCache.objects.create(query=self.query, page=self.page)
+        self.timestamp = timezone.now().replace(microsecond=0) - datetime.timedelta(hours=1)
+        QueryResult.store(query_cache.get_query_tag(), "uuid", "[1, 2, 3]", "application/json")
+        QueryResult.objects.update(timestamp=self.timestamp)
+        self.version = result_cache.get_version(query_cache.get_query_tag(), self.timestamp)
+        caches['results'].clear()
+        caches['query'].clear()
+
+    def get_result(self, data=None, **headers):
+        request = RequestFactory().get("/", data, **headers)
+        return get_saved_query_result(request, query_id=self.query.id, page_id=self.page.id)
+
+    def assertNotModified(self, response):
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b"")
+
+    def test_etag(self):
+        response = self.get_result(HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["ETag"], '"{}-gzip"'.format(self.version))
+        self.assertEqual(response["Last-Modified"], http_date(self.timestamp.timestamp()))
+
+        # A copy in any encoding is the current version
+        for etag in ["{}-gzip", "{}-br", "{}"]:
+            response = self.get_result(HTTP_IF_NONE_MATCH='"{}"'.format(etag.format(self.version)))
+            self.assertNotModified(response)
+            self.assertEqual(response["ETag"], '"{}"'.format(etag.format(self.version)))
+
+        self.assertNotModified(self.get_result(HTTP_IF_NONE_MATCH='"other", "{}-br"'.format(self.version)))
+        self.assertEqual(self.get_result(HTTP_IF_NONE_MATCH='"{}-deflate"'.format(self.version)).status_code, 200)
+        self.assertEqual(self.get_result(HTTP_IF_NONE_MATCH='"other"').status_code, 200)
+
+    def test_star_and_weak_etags(self):
+        self.assertNotModified(self.get_result(HTTP_IF_NONE_MATCH="*"))
+        # If-None-Match uses the weak comparison, so a weak ETag matches as well (e.g. after a proxy recompressed it)
+        self.assertNotModified(self.get_result(HTTP_IF_NONE_MATCH='W/"{}-gzip"'.format(self.version)))
+
+    def test_if_modified_since(self):
+        self.assertNotModified(self.get_result(HTTP_IF_MODIFIED_SINCE=http_date(self.timestamp.timestamp())))
+        later = self.timestamp + datetime.timedelta(minutes=1)
+        self.assertNotModified(self.get_result(HTTP_IF_MODIFIED_SINCE=http_date(later.timestamp())))
+        earlier = self.timestamp - datetime.timedelta(minutes=1)
+        self.assertEqual(self.get_result(HTTP_IF_MODIFIED_SINCE=http_date(earlier.timestamp())).status_code, 200)
+
+        # If-None-Match takes precedence
+        response = self.get_result(HTTP_IF_NONE_MATCH='"other"', HTTP_IF_MODIFIED_SINCE=http_date(later.timestamp()))
+        self.assertEqual(response.status_code, 200)
+
+    def test_refreshed(self):
+        etag = '"{}-gzip"'.format(self.version)
+        self.assertNotModified(self.get_result(HTTP_IF_NONE_MATCH=etag))
+
+        # A new version of the result doesn't match the old ETag
+        QueryResult.store(QueryCache.objects.get().get_query_tag(), "uuid2", "[4]", "application/json")
+        response = self.get_result(HTTP_IF_NONE_MATCH=etag, HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_filtered(self):
+        query_cache = QueryCache.objects.get()
+        tag = query_cache.get_query_tag(query_override="x")
+        timestamp = timezone.now().replace(microsecond=0)
+        caches['query'].set(tag, {"content": compress("[1]"), "content_type": "application/json",
+                                  "timestamp": timestamp})
+        caches['query'].set(tag + ":timestamp", timestamp)
+        version = result_cache.get_version(tag, timestamp)
+
+        response = self.get_result({"q": "x"}, HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["ETag"], '"{}-gzip"'.format(version))
+
+        self.assertNotModified(self.get_result({"q": "x"}, HTTP_IF_NONE_MATCH='W/"{}"'.format(version)))
+        self.assertNotModified(self.get_result({"q": "x"}, HTTP_IF_MODIFIED_SINCE=http_date(timestamp.timestamp())))
+        # The ETag of the unfiltered result is another version
+        self.assertEqual(self.get_result({"q": "x"}, HTTP_IF_NONE_MATCH='"{}"'.format(self.version)).status_code, 200)
+
+    def test_saved_query(self):
+        request = RequestFactory().get("/")
+        response = get_saved_query(request, query_id=self.query.id, page_id=self.page.id)
+        self.assertEqual(response.status_code, 200)
+
+        request = RequestFactory().get("/", HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertNotModified(get_saved_query(request, query_id=self.query.id, page_id=self.page.id))
+
+
+@override_settings(CACHES=LOCMEM_CACHES, DASHBOARD_PREWARM_VARIANTS=0, DASHBOARD_JOB_QUEUE=False,
+                   DASHBOARD_STALE_WHILE_REVALIDATE=datetime.timedelta(days=1),
+                   DASHBOARD_REVALIDATE_BACKOFF=datetime.timedelta(minutes=5))
+@mock.patch("dashboard.views.dashboard_view.run_in_background")
+class TestRevalidation(TestCase):
+    def setUp(self):
+        system = System.objects.create(hostname="http://amcat.test", project_id=1, project_name="test")
+        page = Page.objects.create(system=system, name="page", ordernr=0)
+        query = Query.objects.create(system=system, amcat_query_id=1, amcat_name="q", amcat_archived=False,
+                                     amcat_parameters=PARAMETERS, amcat_options="{}")
+        self.query_cache = QueryCache.objects.create(query=query, page=page)
+        # An outdated result
+        result = QueryResult.store(self.query_cache.get_query_tag(), "uuid", "[1]", "application/json")
+        QueryCache.objects.update(result=result)
+        QueryResult.objects.update(uuid=None)
+        caches['results'].clear()
+        caches['query'].clear()
+
+    def get_result(self):
+        request = RequestFactory().get("/")
+        return get_saved_query_result(request, query_id=self.query_cache.query_id, page_id=self.query_cache.page_id)
+
+    def test_stale(self, run_in_background):
+        self.assertEqual(self.get_result()[STALE_HEADER], "1")
+        self.assertEqual(run_in_background.call_count, 1)
+
+    def test_failed(self, run_in_background):
+        with mock.patch.object(QueryCache, "revalidate", side_effect=ValueError("Invalid query")):
+            with self.assertRaises(ValueError):
+                revalidate_cache(self.query_cache.id)
+        self.assertTrue(QueryCache.objects.get().revalidation_failed_recently())
+
+        # Requests keep getting the outdated result, without trying again for a while
+        self.assertEqual(self.get_result()[STALE_HEADER], "1")
+        self.assertFalse(run_in_background.called)
+
+        QueryCache.objects.update(revalidation_failed=timezone.now() - datetime.timedelta(minutes=10))
+        self.get_result()
+        self.assertEqual(run_in_background.call_count, 1)
+
+        with mock.patch.object(QueryCache, "revalidate"):
+            revalidate_cache(self.query_cache.id)
+        self.assertIsNone(QueryCache.objects.get().revalidation_failed)